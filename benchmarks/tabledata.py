@@ -0,0 +1,91 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Compare the vectorized TABLEDATA decoder with the astropy parser.
+
+    python benchmarks/tabledata.py [--rows 100000] [--columns 20] [--referenced 5] [--repeat 3] [--workers N]
+
+A table of `columns` int, double and char FIELDs is serialized as TABLEDATA, and `referenced` of its FIELDs are
+decoded by both decoders from the same DATA section. With --workers, the rama decoder is also timed with a pool
+of N processes.
+"""
+import argparse
+import timeit
+from io import BytesIO
+
+import numpy
+from astropy.io.votable import from_table
+from astropy.table import QTable, Table
+
+from rama.reader.buffer import InputBuffer
+from rama.reader.votable.decoder import decode_table
+from rama.reader.votable.loader import AnnotationLoader
+from rama.reader.votable.tabledata import decode_tabledata
+
+
+def make_document(rows, columns):
+    random = numpy.random.default_rng(0)
+    values = []
+    for index in range(columns):
+        if index % 3 == 0:
+            values.append(random.integers(-1000, 1000, rows, dtype="int32"))
+        elif index % 3 == 1:
+            values.append(random.normal(size=rows))
+        else:
+            values.append(numpy.char.mod("src-%d", random.integers(0, 10 ** 6, rows)))
+    output = BytesIO()
+    from_table(Table(values, names=[f"c{index}" for index in range(columns)])).to_xml(output)
+    return output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--referenced", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    buffer = InputBuffer(BytesIO(make_document(args.rows, args.columns)))
+    loader = AnnotationLoader()
+    loader.load(buffer.open())
+    table_info = loader.tables[0]
+    field_ids = [f"c{index}" for index in range(args.referenced)]
+
+    decoders = {
+        "astropy": lambda: QTable(decode_table(buffer, table_info, field_ids).to_table(), copy=False),
+        "rama": lambda: decode_tabledata(buffer, table_info, field_ids),
+    }
+    if args.workers:
+        decoders[f"rama x{args.workers}"] = lambda: decode_tabledata(buffer, table_info, field_ids, args.workers)
+    print(f"{args.rows} rows, {args.columns} FIELDs, {args.referenced} decoded, {len(buffer) / 1e6:.1f} MB")
+    timings = {}
+    for name, decode in decoders.items():
+        timings[name] = min(timeit.repeat(decode, number=1, repeat=args.repeat))
+        print(f"{name:>8}: {timings[name]:.3f} s")
+    for name in list(timings)[1:]:
+        print(f"{'speedup':>8}: {timings['astropy'] / timings[name]:.1f}x ({name})")
+
+
+if __name__ == "__main__":
+    main()
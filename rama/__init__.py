@@ -20,17 +20,29 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------------------------------
+import asyncio
 import logging
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+from urllib.parse import urlsplit
 
-import io
 import requests
+import requests.adapters
 from pkg_resources import iter_entry_points
 
+from rama.framework import BaseType
 from rama.reader import Reader
+from rama.reader.buffer import READ_CHUNK_SIZE
 from rama.reader.votable import Votable
+from rama.utils.http_cache import ResponseCache
 
 LOG = logging.getLogger(__name__)
 
+# Session used by read_url, keeping the connections to the services alive between calls
+SESSION = requests.Session()
+
 for entry_point in iter_entry_points(group='vo.dm.models', name=None):
     try:
         __import__(entry_point.module_name, globals(), locals())
@@ -39,7 +51,7 @@ for entry_point in iter_entry_points(group='vo.dm.models', name=None):
         LOG.warning(f"Cannot import vodml model package {entry_point.name}")
 
 
-def read(filename, fmt='votable'):
+def read(filename, fmt='votable', workers=None):
     formats = {
         'votable': Votable,
     }
@@ -47,14 +59,133 @@ def read(filename, fmt='votable'):
     if fmt not in formats:
         raise AttributeError(f"No such format: {fmt}. Available formats: {formats.keys()}")
 
-    return Reader(formats[fmt](filename))
-
-
-def read_url(base_url, params, fmt='votable'):
-    response = requests.get(base_url, params=params)
-
-    xml = io.BytesIO(response.content)
-    return read(xml, fmt=fmt)
+    return Reader(formats[fmt](filename), workers=workers)
+
+
+def read_url(base_url, params, fmt='votable', session=None, chunk_size=READ_CHUNK_SIZE, cache=None, workers=None):
+    """
+    Read a document from a URL. The response is streamed into the document buffer in chunks of `chunk_size` bytes.
+
+    Connections are pooled by `session`, a requests.Session, which defaults to the module level SESSION.
+
+    If `cache` is given, either a ResponseCache or a directory name, the response is stored on disk and revalidated
+    on later calls, so that unchanged documents are not downloaded again. Cached documents are mapped by the reader.
+
+    `workers` is the number of processes decoding large tables, see Reader.
+    """
+    session = session if session is not None else SESSION
+    if cache is not None:
+        if not isinstance(cache, ResponseCache):
+            cache = ResponseCache(cache)
+        # The document is mapped before the entry can be evicted by other reads
+        with cache.use(session, base_url, params, chunk_size=chunk_size) as path:
+            return read(path, fmt=fmt, workers=workers)
+
+    with session.get(base_url, params=params, stream=True) as response:
+        response.raise_for_status()
+        return read(response.iter_content(chunk_size), fmt=fmt, workers=workers)
+
+
+async def read_async(source, fmt='votable', workers=None, params=None, session=None, chunk_size=READ_CHUNK_SIZE,
+                     cache=None):
+    """
+    Awaitable wrapper of `read` and `read_url`. `source` is read with `read_url` if it is an http(s) URL, and with
+    `read` otherwise.
+
+    This is a convenience for code running in an event loop, not a non-blocking reader: the blocking `read` or
+    `read_url` call is offloaded to the default executor of the loop, and still downloads with requests and parses
+    in a thread. The loop stays responsive meanwhile, and the number of documents read at the same time is bounded
+    by the threads of the executor. The `params`, `session`, `chunk_size` and `cache` arguments only apply to URLs,
+    see `read_url`.
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(source, str) and urlsplit(source).scheme in ('http', 'https'):
+        return await loop.run_in_executor(None, partial(read_url, source, params, fmt=fmt, session=session,
+                                                        chunk_size=chunk_size, cache=cache, workers=workers))
+    return await loop.run_in_executor(None, partial(read, source, fmt=fmt, workers=workers))
+
+
+ReadResult = namedtuple('ReadResult', ['index', 'base_url', 'params', 'reader', 'error'])
+ReadResult.__doc__ = """
+Outcome of one of the read_urls queries: `reader` is None and `error` is the exception raised if the read failed.
+"""
+
+
+def read_urls(queries, max_concurrency=8, fmt='votable', session=None, chunk_size=READ_CHUNK_SIZE, cache=None):
+    """
+    Read the documents of many URLs concurrently, yielding a ReadResult for each one as soon as it is read.
+
+    Inputs:
+      o queries         - iterable of (base_url, params) pairs, as passed to read_url
+      o max_concurrency - maximum number of documents downloaded and parsed at the same time
+      o fmt, chunk_size, cache - see read_url
+      o session         - requests.Session shared by the downloads. By default a session with a connection pool
+                          of `max_concurrency` connections is used for the batch.
+
+    Results are yielded in completion order, their `index` is the position of the query in `queries`.
+    A failed read does not interrupt the others, its exception is reported in the `error` of its result.
+    """
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def read_query(index, base_url, params):
+        try:
+            reader = read_url(base_url, params, fmt=fmt, session=session, chunk_size=chunk_size, cache=cache)
+        except Exception as exc:
+            LOG.warning(f"Cannot read {base_url} with parameters {params}: {exc}")
+            return ReadResult(index, base_url, params, None, exc)
+        return ReadResult(index, base_url, params, reader, None)
+
+    queries = iter(enumerate(queries))
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        # Only submit a few queries ahead, so that long query iterables are not loaded all at once
+        pending = {executor.submit(read_query, index, *query)
+                   for index, query in islice(queries, 2 * max_concurrency)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for index, query in islice(queries, len(done)):
+                pending.add(executor.submit(read_query, index, *query))
+            for future in done:
+                yield future.result()
+    finally:
+        # When the caller stops iterating early, the queries that have not started yet are dropped
+        executor.shutdown(wait=True, cancel_futures=True)
+        if own_session:
+            session.close()
+
+
+def read_many(paths, cls, workers=None, chunksize=1, fmt='votable'):
+    """
+    Find the instances of `cls` in many documents, reading them in a pool of processes.
+
+    Inputs:
+      o paths     - file names of the documents
+      o cls       - class of the instances to find, as passed to Reader.find_instances
+      o workers   - number of processes, defaults to the number of CPUs. With 1 the documents are read in order
+                    in the current process.
+      o chunksize - number of documents sent to a process at once, larger chunks reduce the overhead of
+                    dispatching many small documents
+
+    Returns a list with the list of instances found in each document, in the order of `paths`.
+    The instances are pickled back from the workers: their columns are decoded there and only the values they
+    use are sent, template instances keep their values in columns.
+    """
+    find = partial(_find_instances, cls=cls, fmt=fmt)
+    if workers == 1:
+        return [find(path) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(find, paths, chunksize=chunksize))
+
+
+def _find_instances(path, cls, fmt):
+    # The reader is not closed, the lazy columns of the instances still read from its buffer
+    return read(path, fmt=fmt).find_instances(cls)
 
 
 def is_template(instance):
@@ -77,9 +208,17 @@ def count(template_instance):
     raise ValueError("Instance is not an adapter or a data model type (BaseType)")
 
 
-def unroll(template_instance):
+def unroll(template_instance, materialize=False):
+    """
+    Split a template instance into one instance per row. Data model instances are split into lazy row views,
+    unless `materialize` is set, see BaseType.unroll.
+    """
     if hasattr(template_instance, "__vo_object__"):
-        return [template_instance.__class__(instance) for instance in unroll(template_instance.__vo_object__)]
+        return [template_instance.__class__(instance)
+                for instance in unroll(template_instance.__vo_object__, materialize=materialize)]
+
+    if isinstance(template_instance, BaseType):
+        return template_instance.unroll(materialize=materialize)
 
     if hasattr(template_instance, "unroll"):
         return template_instance.unroll()
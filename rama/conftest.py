@@ -20,7 +20,10 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import os
+from io import BytesIO
+
 import pytest
+from astropy.io import votable
 
 
 @pytest.fixture
@@ -30,3 +33,30 @@ def make_data_path(request):
         return os.path.join(basedir, 'data', filename)
 
     return make_data_path
+
+
+@pytest.fixture
+def make_binary_copy(tmp_path):
+    """
+    Copy an annotated document, with the rows of one of its TABLEs serialized as BINARY or BINARY2. Only the DATA
+    section is replaced, so the TABLE has no nrows attribute.
+    """
+    def make_binary_copy(path, tabledata_format, table_id):
+        votable_file = votable.parse(path)
+        votable_file.get_table_by_id(table_id).format = tabledata_format
+        output = BytesIO()
+        votable_file.to_xml(output)
+
+        def find_data(document):
+            start = document.index(b"<DATA>", document.index(f'ID="{table_id}"'.encode()))
+            return start, document.index(b"</DATA>", start) + len(b"</DATA>")
+
+        with open(path, "rb") as stream:
+            document = stream.read()
+        start, end = find_data(document)
+        data_start, data_end = find_data(output.getvalue())
+        copy_path = tmp_path / os.path.basename(path)
+        copy_path.write_bytes(document[:start] + output.getvalue()[data_start:data_end] + document[end:])
+        return str(copy_path)
+
+    return make_binary_copy
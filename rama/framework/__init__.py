@@ -19,11 +19,11 @@
 # SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-import inspect
 import logging
 from abc import ABCMeta
+from collections import namedtuple
+from collections.abc import Sequence
 from pprint import pprint, pformat
-from weakref import WeakKeyDictionary
 
 import numpy
 from astropy.table import Column
@@ -34,10 +34,28 @@ from astropy.coordinates import SkyCoord
 LOG = logging.getLogger(__name__)
 
 
+class _Unset:
+    """
+    Marks the fields of an instance that have not been set
+    """
+    def __repr__(self):
+        return "<unset>"
+
+    def __reduce__(self):
+        return "_UNSET"
+
+
+_UNSET = _Unset()
+
+
 class VodmlDescriptor:
     """
     Basis for VODML Meta Model elements which form the building blocks
     for the Data Model Object Class contents.
+
+    The values of the field are stored by the instances, in their `__field_values__` list, at the `index` that
+    BaseType assigns to the descriptor when the class is created, unless the class of the instance extends several
+    classes with fields and maps the field to another place (see `slot`). `values` gives access to them by instance.
     """
     def __init__(self, vodml_id, min_occurs=0, max_occurs=1):
         self.vodml_id = vodml_id
@@ -45,15 +63,18 @@ class VodmlDescriptor:
         self.min = min_occurs
         self.max = max_occurs
         self.name = None
-        self.values = WeakKeyDictionary()
+        self.index = None
+        self.values = FieldValues(self)
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
-        return self.values.get(instance, self.default)
+        slots = instance.__field_slots__
+        value = instance.__field_values__[self.index if slots is None else slots[self]]
+        return self.default if value is _UNSET else value
 
     def __set__(self, instance, value):
-        self.values[instance] = value
+        instance.__field_values__[self.slot(instance)] = value
         if hasattr(value, "__parent__"):
             value.__parent__ = instance
 
@@ -63,6 +84,19 @@ class VodmlDescriptor:
     def __set_name__(self, owner, name):
         self.name = name
 
+    def slot(self, instance):
+        """
+        Index of the value of the field in the `__field_values__` of `instance`
+        """
+        slots = instance.__field_slots__
+        return self.index if slots is None else slots[self]
+
+    def get_state(self, instance):
+        """
+        Value of the field for `instance`, in a form that can be pickled
+        """
+        return self.values[instance]
+
     def select_return_value(self, values):
         # MCD NOTE: Having problem here with array Attribute as Column
         #   - element has max > 1
@@ -111,6 +145,13 @@ class Composition(VodmlDescriptor):
 
 
 class Attribute(VodmlDescriptor):
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        slots = instance.__field_slots__
+        value = instance.__field_values__[self.index if slots is None else slots[self]]
+        return self._load_columns(instance, self.default if value is _UNSET else value)
+
     def __set__(self, instance, value):
         VodmlDescriptor.__set__(self, instance, value)
 
@@ -120,6 +161,9 @@ class Attribute(VodmlDescriptor):
 
         if hasattr(value, 'cardinality'):  # BaseTypes
             instance.cardinality = max(instance.cardinality, value.cardinality)
+        elif isinstance(value, LazyColumn):
+            # Column metadata is enough, the column is not decoded yet
+            instance.cardinality = max(instance.cardinality, len(value))
         elif isinstance(value, Quantity) and not value.isscalar or isinstance(value, Column):
             instance.cardinality = max(instance.cardinality, len(value))
         elif isinstance(value, Time) and not value.isscalar:
@@ -131,7 +175,7 @@ class Attribute(VodmlDescriptor):
 
 
     def get_index(self, instance, instance_index):
-        value = self.values[instance]
+        value = self._load_columns(instance, self.values[instance])
         result = None
         if _is_basetype(value):
             result = value.__class__._unroll(value, instance_index)
@@ -148,6 +192,24 @@ class Attribute(VodmlDescriptor):
                     result = value
         return result
 
+    def get_state(self, instance):
+        value = self._load_columns(instance, self.values[instance])
+        if _is_list(value):
+            return [_detach_column(item) for item in value]
+        return _detach_column(value)
+
+    def _load_columns(self, instance, value):
+        """
+        Replace the lazy columns held by the attribute with the decoded columns
+        """
+        if isinstance(value, LazyColumn):
+            value = value.load()
+            self.values[instance] = value
+        elif _is_list(value) and any(isinstance(item, LazyColumn) for item in value):
+            value = [item.load() if isinstance(item, LazyColumn) else item for item in value]
+            self.values[instance] = value
+        return value
+
 class Reference(VodmlDescriptor):
     def get_index(self, instance, instance_index):
         """
@@ -166,7 +228,35 @@ class Reference(VodmlDescriptor):
             set_value = SingleReferenceWrapper(value)
         else:
             set_value = value
-        self.values[instance] = set_value
+        instance.__field_values__[self.slot(instance)] = set_value
+
+
+class FieldValues:
+    """
+    Values of a field, by instance
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __getitem__(self, instance):
+        value = instance.__field_values__[self.field.slot(instance)]
+        if value is _UNSET:
+            raise KeyError(instance)
+        return value
+
+    def __setitem__(self, instance, value):
+        instance.__field_values__[self.field.slot(instance)] = value
+
+    def __delitem__(self, instance):
+        self[instance]
+        instance.__field_values__[self.field.slot(instance)] = _UNSET
+
+    def __contains__(self, instance):
+        return instance.__field_values__[self.field.slot(instance)] is not _UNSET
+
+    def get(self, instance, default=None):
+        value = instance.__field_values__[self.field.slot(instance)]
+        return default if value is _UNSET else value
 
 
 class ReferenceWrapper(metaclass=ABCMeta):
@@ -197,10 +287,43 @@ class BaseType:
     Basis for Data Model Object Classes
     """
     vodml_id = None
+    __field_count__ = 0
+    __field_layout__ = ()
+    __field_slots__ = None
+    __vodml_fields__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Lay out the values of the fields of the class, and collect the metadata of all its fields in
+        `__vodml_fields__`.
+
+        The fields of the first base class with fields keep their place, the fields of the other base classes and
+        the fields declared by the class follow. The fields stored elsewhere than at their own index, when the
+        class extends several classes with fields, are mapped to their place in `__field_slots__`.
+        """
+        super().__init_subclass__(**kwargs)
+        bases = [base for base in cls.__bases__ if issubclass(base, BaseType)]
+        if len(bases) > 1:
+            _check_field_names(cls)
+        layout = []
+        for base in bases:
+            for field in base.__field_layout__:
+                if field not in layout:
+                    layout.append(field)
+        for field in vars(cls).values():
+            if isinstance(field, VodmlDescriptor):
+                field.index = len(layout)
+                layout.append(field)
+        slots = {field: index for index, field in enumerate(layout)}
+        cls.__field_count__ = len(layout)
+        cls.__field_layout__ = tuple(layout)
+        cls.__field_slots__ = None if all(field.index == index for field, index in slots.items()) else slots
+        cls.__vodml_fields__ = _collect_fields(cls)
 
     def __init__(self):
         self.__parent__ = None
         self.__count = 0
+        self.__field_values__ = [_UNSET] * self.__field_count__
 
     def set_field(self, field_name, field_instance):
         setattr(self, field_name, field_instance)
@@ -213,8 +336,31 @@ class BaseType:
     def cardinality(self, value):
         self.__count = value
 
-    def unroll(self):
-        return [self.__class__._unroll(self, instance_index) for instance_index in range(self.cardinality)]
+    def unroll(self, materialize=False):
+        """
+        Split a template instance into one instance per row.
+
+        By default the result is a lazy sequence of row views (see `Rows`), which resolve their fields by indexing
+        the columns of the template when they are accessed. With `materialize` a list of independent instances is
+        built, with all their fields resolved.
+        """
+        rows = Rows(self)
+        if materialize:
+            return rows.materialize()
+        return rows
+
+    def __getstate__(self):
+        # Lazy columns are decoded first, their loaders cannot be sent to another process.
+        state = self.__dict__.copy()
+        # Fields overridden by a subclass leave an unused value behind, with no field.
+        state['__field_values__'] = [_UNSET if value is _UNSET or field is None else field.get_state(self)
+                                     for field, value in zip(self._fields_by_index(), self.__field_values__)]
+        return state
+
+    @classmethod
+    def _fields_by_index(cls):
+        fields = {field_info.field for field_info in cls.__vodml_fields__}
+        return [field if field in fields else None for field in cls.__field_layout__]
 
     @classmethod
     def find(cls, function, iterable):
@@ -222,22 +368,29 @@ class BaseType:
 
     @classmethod
     def find_fields(cls):
-        def is_field(attr):
-            return inspect.isdatadescriptor(attr) and isinstance(attr, VodmlDescriptor)
-
-        return inspect.getmembers(cls, is_field)
+        return [(field_info.name, field_info.field) for field_info in cls.__vodml_fields__]
 
     @classmethod
     def _unroll(cls, template_instance, instance_index):
+        return row_class(cls)(template_instance, instance_index)
+
+    @classmethod
+    def _materialize(cls, template_instance, instance_index):
         instance = cls()
-        for field_name, field_object in cls.find_fields():
-            value = field_object.get_index(template_instance, instance_index)
+        for field_name, field_object, kind, _, get_index in cls.__vodml_fields__:
+            try:
+                value = get_index(template_instance, instance_index)
+            except KeyError:
+                value = field_object.default
+            if kind is not Reference:
+                value = _materialize(value)
             instance.set_field(field_name, value)
         return instance
 
     @classmethod
     def all_subclasses(cls):
-        return set(cls.__subclasses__()).union([s for c in cls.__subclasses__() for s in c.all_subclasses()])
+        subclasses = [c for c in cls.__subclasses__() if not issubclass(c, RowView)]
+        return set(subclasses).union([s for c in subclasses for s in c.all_subclasses()])
 
     def __repr__(self):
         original = numpy.get_printoptions()['threshold']
@@ -252,7 +405,7 @@ class BaseType:
                 return value
         try:
             type_name = '.'.join((self.__class__.__module__, self.__class__.__name__))
-            contents = [(p[0], getattr(self, p[0])) for p in self.find_fields()]
+            contents = [(field_info.name, getattr(self, field_info.name)) for field_info in self.__vodml_fields__]
             contents = {elem[0]: what_to_display(elem[1]) for elem in contents}
             string = pformat({type_name: contents}, width=160)
         finally:
@@ -261,6 +414,156 @@ class BaseType:
         return string
 
 
+class RowView:
+    """
+    Row of a template instance, resolving its fields on access by indexing the fields of the template.
+
+    Row views are instances of a subclass of the template class (see `row_class`), so they can be used wherever the
+    model class is expected. Resolved fields are kept by the view, and fields can be assigned like on any instance,
+    without affecting the template. Nested instances are row views too. `materialize` builds an independent instance.
+    """
+    def __init__(self, template_instance, instance_index):
+        self.__parent__ = None
+        self.__template__ = template_instance
+        self.__row__ = instance_index
+
+    @property
+    def cardinality(self):
+        return 0
+
+    def materialize(self):
+        return self.__template__.__class__._materialize(self.__template__, self.__row__)
+
+    def __eq__(self, other):
+        if isinstance(other, RowView):
+            return self.__template__ is other.__template__ and self.__row__ == other.__row__
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.__template__), self.__row__))
+
+    def __reduce__(self):
+        return self.__template__.__class__._unroll, (self.__template__, self.__row__)
+
+
+class RowField:
+    """
+    Field of a row view class, resolving the value of the field for the row from its template on first access.
+    """
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+
+    def __get__(self, row, owner):
+        if row is None:
+            return self.field
+        try:
+            value = self.field.get_index(row.__template__, row.__row__)
+        except KeyError:
+            value = self.field.default
+        if isinstance(value, RowView):
+            value.__parent__ = row
+        # The value is kept in the instance dictionary, which takes precedence over this non-data descriptor
+        row.__dict__[self.name] = value
+        return value
+
+
+_ROW_CLASSES = {}
+
+
+def row_class(cls):
+    """
+    Row view class for the rows of `cls` templates: a subclass of RowView and `cls` with a RowField for each field
+    """
+    row_cls = _ROW_CLASSES.get(cls)
+    if row_cls is None:
+        namespace = {field_info.name: RowField(field_info.name, field_info.field)
+                     for field_info in cls.__vodml_fields__}
+        namespace['__module__'] = cls.__module__
+        namespace['__qualname__'] = cls.__qualname__
+        row_cls = _ROW_CLASSES[cls] = type(cls.__name__, (RowView, cls), namespace)
+    return row_cls
+
+
+class Rows(Sequence):
+    """
+    Lazy sequence of the rows of a template instance, as returned by `BaseType.unroll`.
+
+    Row views are only created when they are accessed. `materialize` returns a list of independent instances.
+    """
+    def __init__(self, template_instance):
+        self.template = template_instance
+
+    def __len__(self):
+        return self.template.cardinality
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("Row index out of range")
+        return self.template.__class__._unroll(self.template, index)
+
+    def materialize(self):
+        cls = self.template.__class__
+        return [cls._materialize(self.template, index) for index in range(len(self))]
+
+    def __eq__(self, other):
+        if isinstance(other, (Rows, list, tuple)):
+            return len(self) == len(other) and all(row == item for row, item in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"Rows({self.template.__class__.__name__}, length={len(self)})"
+
+
+class LazyColumn:
+    """
+    Handle on a table column that is only decoded when the attribute holding it is first accessed.
+
+    The column metadata is available without decoding:
+      o name   - name of the column
+      o unit   - unit string of the column, None if it has no unit
+      o dtype  - numpy dtype of the column values
+      o length - number of rows, None if it is only known after decoding
+
+    `load` is a function with no arguments returning the decoded column. `close` drops it if the column is not
+    loaded yet, e.g. when the reader of the column is closed.
+    """
+    def __init__(self, load, name=None, unit=None, dtype=None, length=None):
+        self._load = load
+        self._column = None
+        self.name = name
+        self.unit = unit
+        self.dtype = dtype
+        self.length = length
+
+    @property
+    def is_loaded(self):
+        return self._load is None
+
+    def load(self):
+        if self._load is not None:
+            self._column = self._load()
+            self._load = None
+        return self._column
+
+    def close(self):
+        if self._load is not None:
+            self._load = _closed_column
+
+    def __len__(self):
+        if self.length is None:
+            return len(self.load())
+        return self.length
+
+    def __repr__(self):
+        return f"LazyColumn(name={self.name}, unit={self.unit}, dtype={self.dtype}, length={self.length})"
+
+
 class InstanceId:
     def __init__(self, id=None, keys=None):
         self.id = id
@@ -292,8 +595,64 @@ class InstanceId:
         return hash((id_to_hash, keys_to_hash))
 
 
+def _closed_column():
+    raise ValueError("Column not loaded before its reader was closed")
+
+
+def _detach_column(value):
+    # Quantities taken from a QTable keep a weak reference to the table, which cannot be pickled.
+    # A view shares the same data without it.
+    if isinstance(value, Quantity) and not value.isscalar:
+        return value.view(value.__class__)
+    return value
+
+
+FieldInfo = namedtuple('FieldInfo', ['name', 'field', 'kind', 'vodml_id', 'get_index'])
+FieldInfo.__doc__ = """
+Metadata of a field of a data model class: its name, descriptor, descriptor class (Attribute, Composition or
+Reference), vodml_id, and the function reading the value of a row of a template instance.
+"""
+
+
+def _collect_fields(cls):
+    # Fields sorted by name, like inspect.getmembers does. Row view classes shadow the fields with RowFields,
+    # and keep the fields of the template class.
+    fields = {}
+    for klass in reversed(cls.__mro__):
+        for name, attr in vars(klass).items():
+            if isinstance(attr, VodmlDescriptor):
+                fields[name] = attr
+            elif name in fields and not isinstance(attr, RowField):
+                del fields[name]
+    return tuple(FieldInfo(name, field, field.__class__, field.vodml_id, field.get_index)
+                 for name, field in sorted(fields.items()))
+
+
+def _check_field_names(cls):
+    # Fields of different base classes with the same name are ambiguous, unless the class declares the name or one
+    # of the fields overrides the others.
+    owners = {}
+    for klass in cls.__mro__[1:]:
+        for name, attr in vars(klass).items():
+            if isinstance(attr, VodmlDescriptor) and name not in vars(cls):
+                owners.setdefault(name, []).append(klass)
+    for name, klasses in owners.items():
+        for klass in klasses[1:]:
+            if not issubclass(klasses[0], klass):
+                raise TypeError(f"{cls.__name__}: field {name} is inherited from both {klasses[0].__name__} "
+                                f"and {klass.__name__}")
+
+
+def _materialize(value):
+    if isinstance(value, RowView):
+        return value.materialize()
+    if _is_list(value):
+        return [_materialize(item) for item in value]
+    return value
+
+
 def _is_list(value):
-    return isinstance(value, list)
+    return isinstance(value, (list, Rows))
 
 def _is_string(value):
     return isinstance(value, str)
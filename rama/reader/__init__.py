@@ -19,15 +19,21 @@
 # SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import asyncio
 import logging
 from abc import abstractmethod, ABCMeta
 from weakref import WeakValueDictionary
 
+import numpy
+
 from rama.framework import InstanceId
 from rama.utils.registry import TypeRegistry
 
 LOG = logging.getLogger(__name__)
 
+# Marks the end of an iterator advanced in an executor, since StopIteration cannot cross a future
+_END = object()
+
 
 class Document(metaclass=ABCMeta):
     def __init__(self, file):
@@ -37,49 +43,328 @@ class Document(metaclass=ABCMeta):
     def find_instances(self, element_class, context):
         pass
 
+    @abstractmethod
+    def iter_instances(self, element_class, context, batch_size):
+        pass
+
+    @abstractmethod
+    def explain(self, element_class, context):
+        pass
+
+    def close(self):
+        pass
+
+
+class KeyIndex:
+    """
+    Index of the rows of a column-backed instance by primary key.
+
+    The keys of each row, one value per PKFIELD, are encoded as a single sortable value: the key itself for single
+    PKFIELD keys, a packed int64 for integer keys whose ranges fit, and a fixed size byte string otherwise.
+    The encoded keys are sorted once, and looked up with numpy.searchsorted, so a whole batch of keys is searched
+    at once. Keys of object dtype cannot be encoded and are indexed with a dictionary instead.
+    Keys with a masked value are null keys: they are left out of the index, and never found.
+    """
+    def __init__(self, keys):
+        nulls = get_null_keys(keys)
+        self.keys = as_key_rows(keys)
+        # Rows of the keys without null values, None if there are no null keys
+        self._valid_rows = None if nulls is None else numpy.flatnonzero(~nulls)
+        self._encoders = {}
+        self._rows = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, keys):
+        """
+        Returns the row of each of `keys` in the index, -1 for missing keys. The last row wins for duplicated keys.
+        """
+        nulls = get_null_keys(keys)
+        keys = as_key_rows(keys)
+        missing = numpy.full(len(keys), -1, dtype=numpy.intp)
+        if keys.shape[1] != self.keys.shape[1] or not len(self.keys):
+            return missing
+        kinds = {self.keys.dtype.kind, keys.dtype.kind}
+        if kinds & set('SU') and kinds & set('biufc'):
+            # Strings and numbers are never equal, although numpy converts the numbers to strings
+            return missing
+        try:
+            dtype = numpy.result_type(self.keys.dtype, keys.dtype)
+        except TypeError:
+            # e.g. dates and numbers
+            return missing
+        if dtype.hasobject:
+            found = self._find_objects(keys)
+        else:
+            found = self._find_encoded(keys, dtype)
+        if nulls is not None:
+            found[nulls] = -1
+        return found
+
+    def _find_encoded(self, keys, dtype):
+        missing = numpy.full(len(keys), -1, dtype=numpy.intp)
+        encoder = self._get_encoder(dtype)
+        if not len(encoder.sorted_keys):
+            return missing
+        encoded, valid = encoder.encode(keys.astype(dtype, copy=False))
+        positions = numpy.searchsorted(encoder.sorted_keys, encoded, side='right') - 1
+        clipped = numpy.maximum(positions, 0)
+        found = (positions >= 0) & (encoder.sorted_keys[clipped] == encoded)
+        if valid is not None:
+            found &= valid
+        return numpy.where(found, encoder.order[clipped], missing)
+
+    def _get_encoder(self, dtype):
+        encoder = self._encoders.get(dtype, None)
+        if encoder is None:
+            keys = self.keys if self._valid_rows is None else self.keys[self._valid_rows]
+            encoder = self._encoders[dtype] = KeyEncoder(keys.astype(dtype, copy=False), self._valid_rows)
+        return encoder
+
+    def _find_objects(self, keys):
+        if self._rows is None:
+            rows = range(len(self.keys)) if self._valid_rows is None else self._valid_rows.tolist()
+            self._rows = {tuple(self.keys[index].tolist()): index for index in rows}
+        return numpy.array([self._rows.get(tuple(row), -1) for row in keys.tolist()], dtype=numpy.intp)
+
+
+class KeyEncoder:
+    """
+    Encoding of the keys of a KeyIndex as a 1D sortable array, chosen from the keys of the index.
+    `rows` is the row of each key in the index, by default its position.
+    """
+    def __init__(self, keys, rows=None):
+        self.packing = None
+        if keys.shape[1] > 1 and keys.dtype.kind in 'biu' and numpy.can_cast(keys.dtype, numpy.int64):
+            self.packing = get_packing(keys)
+        encoded, _ = self.encode(keys)
+        order = numpy.argsort(encoded, kind='stable')
+        self.order = order if rows is None else rows[order]
+        self.sorted_keys = encoded[order]
+
+    def encode(self, keys):
+        """
+        Returns the encoded keys, and a boolean mask of the keys that can be encoded, None if they all can
+        """
+        if self.packing is not None:
+            minimums, sizes = self.packing
+            offsets = keys.astype(numpy.int64) - minimums
+            valid = numpy.all((offsets >= 0) & (offsets < sizes), axis=1)
+            multipliers = numpy.cumprod(numpy.concatenate(([1], sizes[:0:-1])))[::-1]
+            return numpy.where(valid, offsets @ multipliers, 0), valid
+        if keys.dtype.kind in 'fc':
+            # -0.0 and 0.0 are equal keys, but have different bytes
+            keys = keys + 0
+        if keys.shape[1] == 1:
+            return keys[:, 0], None
+        keys = numpy.ascontiguousarray(keys)
+        return keys.view(numpy.dtype((numpy.void, keys.dtype.itemsize * keys.shape[1]))).ravel(), None
+
+
+def get_packing(keys):
+    """
+    Minimum value and size of the range of each column of integer keys, if the keys can be packed in an int64
+    """
+    if not len(keys):
+        return None
+    minimums = keys.min(axis=0).astype(numpy.int64)
+    sizes = [int(maximum) - int(minimum) + 1 for minimum, maximum in zip(minimums, keys.max(axis=0))]
+    if numpy.prod(sizes, dtype=object) >= 2 ** 63:
+        return None
+    return minimums, numpy.array(sizes, dtype=numpy.int64)
+
+
+def as_key_rows(keys):
+    """
+    Keys as a 2D array, with one row per key and one column per PKFIELD. 1D arrays hold keys with a single PKFIELD.
+    """
+    keys = numpy.asarray(keys)
+    if keys.ndim < 2:
+        keys = keys.reshape(-1, 1)
+    return keys
+
+
+def get_null_keys(keys):
+    """
+    Boolean mask of the keys with a masked value, for keys as accepted by `as_key_rows`. None if no value is masked.
+    """
+    mask = getattr(keys, 'mask', None)
+    if mask is None or not numpy.any(mask):
+        return None
+    mask = numpy.asarray(mask)
+    return mask.reshape(len(mask), -1).any(axis=1)
+
 
 class InstanceRegistry:
     def __init__(self):
         self.id_instances = {}
         self.pk_instances = {}
+        self.key_indexes = []
+        self._key_indexes_by_instance = {}
 
     def set(self, instance_id, instance):
         if instance_id.keys is not None:
             if instance_id.is_column:
-                for keys in instance_id.keys:
-                    self.pk_instances[tuple(keys.tolist())] = instance
+                if id(instance) not in self._key_indexes_by_instance:
+                    key_index = KeyIndex(instance_id.keys)
+                    self.key_indexes.append((key_index, instance))
+                    self._key_indexes_by_instance[id(instance)] = key_index
             else:
                 self.pk_instances[tuple(instance_id.keys.tolist())] = instance
         self.id_instances[instance_id] = instance
 
     def get(self, instance_id):
-        if not instance_id.is_column:
-            return self.id_instances.get(instance_id, None)
+        instance = self.id_instances.get(instance_id, None)
+        if instance is not None or not instance_id.is_column:
+            return instance
 
-        possible_instances = [self.pk_instances.get(tuple(keys.tolist()), None) for keys in instance_id.keys]
+        # Position in key_indexes of the instance holding each key, later registrations take precedence
+        keys = instance_id.keys
+        owners = numpy.full(len(keys), -1, dtype=numpy.intp)
+        for position, (key_index, _) in enumerate(self.key_indexes):
+            owners[key_index.find(keys) >= 0] = position
+        instances = [instance for _, instance in self.key_indexes] + [None]
+        possible_instances = [instances[owner] for owner in owners.tolist()]
+        if self.pk_instances:
+            for position, key in enumerate(keys.tolist()):
+                if possible_instances[position] is None:
+                    possible_instances[position] = self.pk_instances.get(tuple(key), None)
         if not any(possible_instances):
             return None
         return possible_instances
 
+    def get_key_index(self, instance):
+        """
+        Returns the KeyIndex of a column-backed instance, None if it has no PRIMARYKEY
+        """
+        return self._key_indexes_by_instance.get(id(instance), None)
+
 
 class Reader:
-    def __init__(self, document: Document):
+    def __init__(self, document: Document, workers=None):
+        """
+        Inputs:
+          o document - the Document to read instances from
+          o workers  - number of processes decoding large tables, None to decode them in the current process
+        """
         self.instance_registry = InstanceRegistry()
         self.tables = {}
         self.column_mappings = {}
         self.registry = TypeRegistry.instance
         self.document = document
+        self.workers = workers
 
     @property
     def file(self):
         return self.document.file
 
+    @property
+    def buffer(self):
+        return self.document.buffer
+
+    def close(self):
+        """
+        Release the input buffer of the document, e.g. the memory map of the file it was read from.
+
+        The columns of the instances already found that were accessed stay usable. The ones not accessed yet are not
+        decoded, they become unavailable: accessing them raises ValueError.
+        """
+        self.document.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def get_type_by_id(self, type_id):
         return self.registry.get_by_id(type_id)
 
     def find_instances(self, cls):
         return self.document.find_instances(cls, context=self)
 
+    def iter_instances(self, cls, batch_size=10000):
+        """
+        Iterate over the instances of `cls` like `find_instances` does, but decode the table rows they are built from
+        in batches: template instances are yielded once per batch of at most `batch_size` rows.
+        """
+        return self.document.iter_instances(cls, context=self, batch_size=batch_size)
+
+    async def aiter_instances(self, cls, batch_size=10000):
+        """
+        Asynchronous iterator over `iter_instances`, for code running in an event loop. Each step of the blocking
+        iterator, i.e. decoding a batch and building its instances, is offloaded to the default executor of the loop,
+        so that the loop stays responsive. The decoding itself is not asynchronous.
+        """
+        loop = asyncio.get_running_loop()
+        instances = self.iter_instances(cls, batch_size=batch_size)
+        while True:
+            instance = await loop.run_in_executor(None, next, instances, _END)
+            if instance is _END:
+                return
+            yield instance
+
+    def lookup(self, cls, keys, indices=False):
+        """
+        Find the rows of the template instances of `cls` with the given PRIMARYKEY values, for a batch of keys at once.
+
+        Inputs:
+          o cls     - class of the instances, as passed to `find_instances`
+          o keys    - keys to look up, a 2D array with one row per key and one column per PKFIELD.
+                      A 1D array holds keys with a single PKFIELD.
+          o indices - return the indices of the rows rather than row views
+
+        Returns a list with the row of each key (see BaseType.unroll), None for missing keys. Instances of `cls`
+        that are not templates are returned as they are when their PRIMARYKEY matches. With `indices`, a numpy
+        array with the index of the row of each key, -1 for missing keys. Indices need a single template of `cls`
+        with a PRIMARYKEY.
+        """
+        templates = []
+        instances = {}
+        for instance in self.find_instances(cls):
+            key_index = self.instance_registry.get_key_index(instance)
+            if key_index is not None:
+                templates.append((key_index, instance))
+            elif instance.__vo_id__.keys is not None:
+                instances[tuple(instance.__vo_id__.keys.tolist())] = instance
+
+        if indices:
+            if len(templates) > 1:
+                raise ValueError(f"{len(templates)} instances of {cls.__name__} have a PRIMARYKEY, "
+                                 f"row indices need a single one")
+            if not templates:
+                return numpy.full(len(as_key_rows(keys)), -1, dtype=numpy.intp)
+            return templates[0][0].find(keys)
+
+        rows = [None] * len(as_key_rows(keys))
+        for key_index, instance in templates:
+            vo_instance = getattr(instance, "__vo_object__", instance)
+            found = key_index.find(keys)
+            for position in numpy.flatnonzero(found >= 0):
+                row_index = int(found[position])
+                row = vo_instance._unroll(vo_instance, row_index)
+                if vo_instance is not instance:
+                    # Wrapped in the adapter of the template, like the instances found by find_instances
+                    adapted_row = instance.__class__(row)
+                    adapted_row.__vo_object__ = row
+                    adapted_row.__vo_id__ = InstanceId(instance.__vo_id__.id, key_index.keys[row_index])
+                    row = adapted_row
+                rows[position] = row
+        if instances:
+            nulls = get_null_keys(keys)
+            for position, key in enumerate(as_key_rows(keys).tolist()):
+                if rows[position] is None and (nulls is None or not nulls[position]):
+                    rows[position] = instances.get(tuple(key), None)
+        return rows
+
+    def explain(self, cls):
+        """
+        Print the steps that `find_instances` would execute for `cls`, the tables and columns they touch,
+        and the estimated materialization cost.
+        """
+        print(self.document.explain(cls, context=self))
+
     def add_instance(self, instance):
         if instance.__vo_id__ is not None:
             self.instance_registry.set(instance.__vo_id__, instance)
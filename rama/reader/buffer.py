@@ -0,0 +1,202 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Input buffer shared by the parsers of a document.
+
+The document is read once: files are memory mapped and streams are read into a single bytes object. The annotation
+loader and the table decoders then work on views of the same buffer, so no byte is read twice from the disk or the
+network, and slicing the buffer does not copy data.
+
+Documents compressed with gzip, bzip2 or xz are detected from their first bytes, and decompressed once into the
+buffer, chunk by chunk.
+"""
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import mmap
+import os
+
+LOG = logging.getLogger(__name__)
+
+# Size of the chunks read from streams and decompressed documents
+READ_CHUNK_SIZE = 1 << 20
+
+# Magic bytes of the compression formats and the functions opening the compressed streams
+COMPRESSIONS = [
+    (b"\x1f\x8b", gzip.open),
+    (b"BZh", bz2.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+]
+
+
+class InputBuffer:
+    """
+    Read-only bytes of a document.
+
+      o source - file name, file-like object read from its current position, or iterable over chunks of bytes, e.g.
+                 a network response. Text streams are encoded as UTF-8, and compressed documents are decompressed.
+
+    `view` is a memoryview over the whole document, and `open` returns a file-like object over a part of it.
+    `name` is the file name of the document, if any, used to resolve the files it refers to.
+    """
+    def __init__(self, source):
+        self._mmap = None
+        name = getattr(source, 'name', None)
+        self.name = name if isinstance(name, str) else None
+        if isinstance(source, (str, bytes, os.PathLike)):
+            self.name = os.fsdecode(source)
+            data = self._map(source)
+        elif isinstance(source, io.BytesIO):
+            data = source.getbuffer()[source.tell():]
+        elif hasattr(source, 'read'):
+            data = join_chunks(iter_chunks(source))
+        else:
+            data = join_chunks(source)
+        self.view = memoryview(data)
+
+        open_compressed = get_decompressor(self.view)
+        if open_compressed is not None:
+            self.view = self._decompress(open_compressed)
+
+    def _decompress(self, open_compressed):
+        with ViewStream([self.view]) as compressed, open_compressed(compressed, 'rb') as stream:
+            data = join_chunks(iter_chunks(stream))
+
+        # The compressed bytes are not needed anymore
+        self.view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        return memoryview(data)
+
+    def _map(self, file_name):
+        try:
+            with open(file_name, 'rb') as stream:
+                if os.fstat(stream.fileno()).st_size == 0:
+                    return b""
+                self._mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as exc:
+            raise type(exc)(exc.errno, f"Error reading file '{os.fsdecode(file_name)}': {exc.strerror}") from exc
+        return self._mmap
+
+    def __len__(self):
+        return len(self.view)
+
+    @property
+    def is_mapped(self):
+        return self._mmap is not None
+
+    def open(self, start=0, end=None):
+        """
+        Returns a binary file-like object reading the [start, end) range of the buffer
+        """
+        return ViewStream([self.view[start:end]])
+
+    def close(self):
+        self.view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Some views of the buffer are still in use, the mapping is closed when they are released.
+                LOG.debug("Input buffer still in use, leaving the memory map open")
+            self._mmap = None
+
+
+def iter_chunks(stream, chunk_size=READ_CHUNK_SIZE):
+    chunk = stream.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = stream.read(chunk_size)
+
+
+def join_chunks(chunks):
+    """
+    Returns the chunks as a single bytearray, growing it in place rather than holding all the chunks in memory.
+    Text chunks are encoded as UTF-8.
+    """
+    data = bytearray()
+    for chunk in chunks:
+        data += chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+    return data
+
+
+def get_decompressor(data):
+    """
+    Returns the function opening the decompressed stream of compressed bytes, or None if the bytes are not compressed
+    """
+    for magic, open_compressed in COMPRESSIONS:
+        if bytes(data[:len(magic)]) == magic:
+            return open_compressed
+    return None
+
+
+class ViewStream(io.RawIOBase):
+    """
+    Seekable binary stream over a sequence of bytes-like parts, read in turn without joining them.
+    """
+    def __init__(self, parts):
+        super().__init__()
+        self._parts = [memoryview(part).cast('B') for part in parts]
+        self._size = sum(len(part) for part in self._parts)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def close(self):
+        for part in self._parts:
+            part.release()
+        super().close()
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        target = memoryview(buffer).cast('B')
+        written = 0
+        start = 0
+        for part in self._parts:
+            end = start + len(part)
+            if self._position < end and written < len(target):
+                offset = self._position - start
+                size = min(len(part) - offset, len(target) - written)
+                target[written:written + size] = part[offset:offset + size]
+                written += size
+                self._position += size
+            start = end
+        return written
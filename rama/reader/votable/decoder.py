@@ -0,0 +1,320 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Decoding of VOTable <TABLE> data.
+
+A table is decoded on its own by handing astropy a minimal document, made of the TABLE metadata from the annotation
+skeleton and the raw bytes of its <DATA> section. Only the requested columns are decoded, and the bytes of the other
+tables of the file are never read again.
+
+TABLEDATA, BINARY and BINARY2 tables with inline data can also be decoded in batches of rows, so that tables larger
+than the available memory can be processed one batch at a time.
+"""
+import base64
+import binascii
+import copy
+import logging
+import re
+import struct
+
+from astropy.io import votable
+from lxml import etree
+
+from rama.reader.buffer import ViewStream
+from rama.reader.votable.fields import get_array_size, get_field_layout, get_fields
+from rama.reader.votable.loader import CHUNK_SIZE, local_name
+
+LOG = logging.getLogger(__name__)
+
+_DATA_PLACEHOLDER = "DATA"
+
+def decode_table(buffer, table_info, field_ids=None):
+    """
+    Decode the <DATA> section of a TABLE
+
+    Inputs:
+      o buffer      - InputBuffer of the document
+      o table_info  - TableInfo of the TABLE, from the annotation loader
+      o field_ids   - IDs of the FIELDs to decode, all of them if None
+
+    Returns an astropy votable Table, or None if the table can't be decoded on its own:
+      o the DATA section was not located
+      o the TABLE refers to the FIELDs of another TABLE
+      o the data is serialized as FITS, which astropy can't decode column by column
+    """
+    if not can_decode(table_info):
+        return None
+
+    section = table_info.data_section
+    document = open_table_document(table_info.element, buffer.view[section.start:section.end])
+    return votable.parse(document, columns=field_ids or None).get_first_table()
+
+
+def can_decode(table_info):
+    table_element = table_info.element
+    if table_info.data_section is None or table_element.get("ref") is not None:
+        return False
+    for data_element in table_element.iterchildren(etree.Element):
+        if local_name(data_element.tag) != "DATA":
+            continue
+        if any(local_name(child.tag) == "FITS" for child in data_element.iterchildren(etree.Element)):
+            return False
+    return True
+
+
+def open_table_document(table_element, data, nrows=True):
+    """
+    Returns a binary stream over a VOTable document with a single RESOURCE, containing the TABLE metadata and the
+    given <DATA> bytes, which are not copied. The nrows attribute of the TABLE is dropped if `nrows` is False.
+    """
+    root = table_element.getroottree().getroot()
+    namespace = etree.QName(table_element).namespace
+    votable_element = etree.Element(root.tag, nsmap=table_element.nsmap)
+    if root.get("version") is not None:
+        votable_element.set("version", root.get("version"))
+    resource_element = etree.SubElement(votable_element, etree.QName(namespace, "RESOURCE"))
+
+    table_copy = copy.deepcopy(table_element)
+    table_copy.tail = None
+    if not nrows:
+        table_copy.attrib.pop("nrows", None)
+    for child in table_copy.iterchildren(etree.Element):
+        if local_name(child.tag) == "DATA":
+            table_copy.remove(child)
+    table_copy.append(etree.Comment(_DATA_PLACEHOLDER))
+    resource_element.append(table_copy)
+
+    encoding = table_element.getroottree().docinfo.encoding or "UTF-8"
+    header, footer = etree.tostring(votable_element, encoding=encoding, xml_declaration=True)\
+        .split(f"<!--{_DATA_PLACEHOLDER}-->".encode(encoding), 1)
+    return ViewStream([header, data, footer])
+
+
+def iter_table_batches(buffer, table_info, batch_size, field_ids=None):
+    """
+    Decode the <DATA> section of a TABLE in batches of rows
+
+    Inputs:
+      o buffer      - InputBuffer of the document
+      o table_info  - TableInfo of the TABLE, from the annotation loader
+      o batch_size  - maximum number of rows in each batch
+      o field_ids   - IDs of the FIELDs to decode, all of them if None
+
+    Returns an iterator over astropy votable Tables with at most `batch_size` rows each, or None if the table
+    can't be decoded in batches. Only one batch of raw rows is held in memory at a time.
+    """
+    if not can_decode(table_info):
+        return None
+
+    table_element = table_info.element
+    serialization = get_serialization(table_element)
+    if serialization is None:
+        return None
+
+    tag, stream_element = serialization
+    chunks = iter_section(buffer, table_info.data_section)
+    if tag == "TABLEDATA":
+        batches = iter_tabledata_batches(chunks, table_element.prefix, batch_size)
+    else:
+        layouts = [get_field_layout(field) for field in get_fields(table_element)]
+        if stream_element is None or stream_element.get("href") is not None or \
+                stream_element.get("encoding", "base64") != "base64" or None in layouts:
+            return None
+        batches = iter_binary_batches(chunks, table_element.prefix, tag, layouts, batch_size)
+
+    return (_decode_batch(table_element, data, field_ids) for data in batches)
+
+
+def _decode_batch(table_element, data, field_ids):
+    document = open_table_document(table_element, data, nrows=False)
+    return votable.parse(document, columns=field_ids or None).get_first_table()
+
+
+def get_serialization(table_element):
+    """
+    Returns the (serialization tag, STREAM element) pair of a TABLE, or None if it has no DATA
+    """
+    for data_element in table_element.iterchildren(etree.Element):
+        if local_name(data_element.tag) != "DATA":
+            continue
+        for serialization_element in data_element.iterchildren(etree.Element):
+            tag = local_name(serialization_element.tag)
+            if tag in ("TABLEDATA", "BINARY", "BINARY2", "FITS"):
+                streams = [child for child in serialization_element.iterchildren(etree.Element)
+                           if local_name(child.tag) == "STREAM"]
+                return tag, streams[0] if streams else None
+    return None
+
+
+def iter_section(buffer, section, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over the bytes of a DataSection of the buffer, in chunks
+    """
+    for position in range(section.start, section.end, chunk_size):
+        yield bytes(buffer.view[position:min(position + chunk_size, section.end)])
+
+
+def qualified_tag(prefix, tag):
+    return f"{prefix}:{tag}" if prefix else tag
+
+
+def iter_tabledata_batches(chunks, prefix, batch_size):
+    """
+    Split the bytes of a TABLEDATA <DATA> section into <DATA> elements of at most batch_size <TR> rows
+    """
+    tr = re.escape(qualified_tag(prefix, "TR").encode())
+    row_start = re.compile(rb"<" + tr + rb"[\s/>]")
+    row_end = re.compile(rb"</" + tr + rb"\s*>|<" + tr + rb"\s*/>")
+    header = "<{data}><{tabledata}>".format(data=qualified_tag(prefix, "DATA"),
+                                             tabledata=qualified_tag(prefix, "TABLEDATA")).encode()
+    footer = "</{tabledata}></{data}>".format(data=qualified_tag(prefix, "DATA"),
+                                              tabledata=qualified_tag(prefix, "TABLEDATA")).encode()
+
+    buffer = b""
+    started = False
+    rows = []
+    for chunk in chunks:
+        buffer += chunk
+        if not started:
+            match = row_start.search(buffer)
+            if match is None:
+                continue
+            buffer = buffer[match.start():]
+            started = True
+
+        position = 0
+        for match in row_end.finditer(buffer):
+            rows.append(buffer[position:match.end()])
+            position = match.end()
+            if len(rows) == batch_size:
+                yield header + b"".join(rows) + footer
+                rows = []
+        buffer = buffer[position:]
+
+    if rows:
+        yield header + b"".join(rows) + footer
+
+
+def iter_binary_batches(chunks, prefix, tag, layouts, batch_size):
+    """
+    Split the bytes of a BINARY or BINARY2 <DATA> section with an inline base64 STREAM into <DATA> elements of at
+    most batch_size rows
+    """
+    header = '<{data}><{binary}><{stream} encoding="base64">'.format(
+        data=qualified_tag(prefix, "DATA"), binary=qualified_tag(prefix, tag),
+        stream=qualified_tag(prefix, "STREAM")).encode()
+    footer = "</{stream}></{binary}></{data}>".format(
+        data=qualified_tag(prefix, "DATA"), binary=qualified_tag(prefix, tag),
+        stream=qualified_tag(prefix, "STREAM")).encode()
+    # BINARY2 rows start with a bit mask flagging the null values of the row
+    null_mask_size = (len(layouts) + 7) // 8 if tag == "BINARY2" else 0
+
+    buffer = b""
+    rows = 0
+    batch_end = 0
+    position = 0
+    for data in _iter_base64_stream(chunks, prefix):
+        buffer += data
+        while True:
+            row_end = _find_row_end(buffer, position, layouts, null_mask_size)
+            if row_end is None:
+                break
+            position = batch_end = row_end
+            rows += 1
+            if rows == batch_size:
+                yield header + base64.b64encode(buffer[:batch_end]) + footer
+                buffer = buffer[batch_end:]
+                rows = position = batch_end = 0
+
+    if rows:
+        yield header + base64.b64encode(buffer[:batch_end]) + footer
+
+
+def count_binary_rows(chunks, prefix, tag, layouts):
+    """
+    Count the rows of a BINARY or BINARY2 <DATA> section with an inline base64 STREAM. Only the sizes of the variable
+    length arrays are read from the rows, the values are not decoded.
+    """
+    null_mask_size = (len(layouts) + 7) // 8 if tag == "BINARY2" else 0
+
+    buffer = b""
+    rows = 0
+    for data in _iter_base64_stream(chunks, prefix):
+        buffer += data
+        position = 0
+        while True:
+            row_end = _find_row_end(buffer, position, layouts, null_mask_size)
+            if row_end is None:
+                break
+            position = row_end
+            rows += 1
+        buffer = buffer[position:]
+    return rows
+
+
+def _find_row_end(buffer, position, layouts, null_mask_size):
+    position += null_mask_size
+    for layout in layouts:
+        size = layout.size
+        if size is None:
+            # Variable length arrays are prefixed with their number of elements
+            if position + 4 > len(buffer):
+                return None
+            count, = struct.unpack_from(">I", buffer, position)
+            size = 4 + get_array_size(count, layout.element_size, layout.bits)
+        position += size
+        if position > len(buffer):
+            return None
+    return position
+
+
+def _iter_base64_stream(chunks, prefix):
+    """
+    Decode the base64 content of the <STREAM> element found in a stream of chunks
+    """
+    stream = re.escape(qualified_tag(prefix, "STREAM").encode())
+    stream_start = re.compile(rb"<" + stream + rb"(?:\s[^>]*)?>")
+    stream_end = re.compile(rb"</" + stream + rb"\s*>")
+
+    text = b""
+    started = False
+    for chunk in chunks:
+        text += chunk
+        if not started:
+            match = stream_start.search(text)
+            if match is None:
+                continue
+            text = text[match.end():]
+            started = True
+
+        match = stream_end.search(text)
+        if match is not None:
+            text = text[:match.start()]
+        encoded = re.sub(rb"\s+", b"", text)
+        usable = len(encoded) - len(encoded) % 4 if match is None else len(encoded)
+        try:
+            yield base64.b64decode(encoded[:usable])
+        except binascii.Error as exc:
+            raise ValueError(f"Invalid base64 STREAM: {exc}") from exc
+        text = encoded[usable:]
+        if match is not None:
+            return
@@ -0,0 +1,108 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Metadata of VOTable <FIELD> elements, shared by the table decoders.
+
+The VOTable primitive datatypes are described once, in `DATATYPES`: the size of their binary serialization and the
+numpy type of their decoded values. The decoders derive from it the types they handle, e.g. the big endian types of
+the mapped binary streams.
+"""
+from collections import namedtuple
+
+import numpy
+from lxml import etree
+
+from rama.reader.votable.loader import local_name
+
+# Size in bytes of the binary serialization of a VOTable primitive datatype, and numpy type of the decoded values,
+# the same as astropy's. Character columns are converted to unicode strings.
+Datatype = namedtuple('Datatype', ['size', 'dtype'])
+
+DATATYPES = {
+    "boolean": Datatype(1, "bool"), "bit": Datatype(1, "bool"), "unsignedByte": Datatype(1, "u1"),
+    "short": Datatype(2, "i2"), "int": Datatype(4, "i4"), "long": Datatype(8, "i8"),
+    "char": Datatype(1, "U"), "unicodeChar": Datatype(2, "U"),
+    "float": Datatype(4, "f4"), "double": Datatype(8, "f8"),
+    "floatComplex": Datatype(8, "c8"), "doubleComplex": Datatype(16, "c16"),
+}
+
+# Binary layout of a FIELD: size in bytes of a value (None for variable length arrays), size in bytes of an array
+# element, and whether the values are bit arrays.
+FieldLayout = namedtuple('FieldLayout', ['size', 'element_size', 'bits'])
+
+
+def get_fields(table_element):
+    """
+    Returns the FIELD elements of a TABLE, in order
+    """
+    return [field for field in table_element.iterchildren(etree.Element) if local_name(field.tag) == "FIELD"]
+
+
+def get_column_name(field_element):
+    # Same naming as astropy votable tables
+    return field_element.get("ID") or field_element.get("name")
+
+
+def get_null_value(field_element):
+    """
+    Returns the null attribute of the VALUES of a FIELD, or None
+    """
+    for values_element in field_element.iterchildren(etree.Element):
+        if local_name(values_element.tag) == "VALUES" and values_element.get("null") is not None:
+            return values_element.get("null")
+    return None
+
+
+def get_field_dtype(field_element):
+    """
+    Returns the numpy dtype of the values of a FIELD, as they are stored in the decoded column
+    """
+    datatype = DATATYPES.get(field_element.get("datatype"), None)
+    return numpy.dtype(datatype.dtype) if datatype is not None else None
+
+
+def get_field_layout(field_element):
+    """
+    Returns the binary layout of a FIELD as a FieldLayout, or None for layouts that are not supported, i.e. variable
+    length multidimensional arrays.
+    """
+    datatype = field_element.get("datatype")
+    if datatype not in DATATYPES:
+        return None
+    element_size = DATATYPES[datatype].size
+
+    arraysize = field_element.get("arraysize")
+    count = 1
+    if arraysize:
+        dimensions = arraysize.split("x")
+        if dimensions[-1].endswith("*"):
+            if len(dimensions) > 1:
+                return None
+            return FieldLayout(None, element_size, datatype == "bit")
+        for dimension in dimensions:
+            count *= int(dimension)
+
+    return FieldLayout(get_array_size(count, element_size, datatype == "bit"), element_size, datatype == "bit")
+
+
+def get_array_size(count, element_size, bits):
+    return (count + 7) // 8 if bits else count * element_size
@@ -0,0 +1,240 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Streaming loader for annotated VOTables.
+
+The loader feeds the document to an incremental lxml parser and only keeps in memory what the annotation parser
+needs: the VODML block and the RESOURCE/TABLE/FIELD/PARAM skeleton. Table rows are dropped as soon as they have
+been parsed, since table contents are decoded separately.
+
+Before reaching the parser, the document goes through a byte scanner that records the offsets of each ``<DATA>``
+section, so that table decoders can seek straight to the serialized rows. The scanner also cuts out the content of
+``<STREAM>`` elements: lxml collects the text of an element in full before reporting it, so an inline base64
+stream would otherwise be held in memory as a whole while loading.
+"""
+import logging
+import os
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+DataSection = namedtuple('DataSection', ['start', 'end'])
+
+
+class TableInfo:
+    """
+    Skeleton information for a VOTable <TABLE> element, in document order.
+
+      o element      - the <TABLE> element (without rows)
+      o index        - position of the TABLE in the document
+      o nrows        - number of <TR> rows seen in TABLEDATA, None for other serializations until the rows are
+                       counted from the binary data, see `mapped.count_rows`
+      o data_section - byte offsets of the <DATA> element, None if unknown
+    """
+    def __init__(self, element, index):
+        self.element = element
+        self.index = index
+        self.nrows = None
+        self.data_section = None
+
+    def __repr__(self):
+        return f"TableInfo(index={self.index}, nrows={self.nrows}, data_section={self.data_section})"
+
+
+class AnnotationLoader:
+    """
+    Incrementally build the annotation tree of a VOTable document.
+
+    Chunks of the document are passed to `feed`, and `close` returns the root of the resulting tree.
+    `load` does both for a file name or a file-like object.
+    """
+    _TAGS = tuple(f"{{*}}{tag}" for tag in ('TABLE', 'DATA', 'TABLEDATA', 'TR', 'STREAM'))
+
+    def __init__(self):
+        self._parser = etree.XMLPullParser(events=('start', 'end'), tag=self._TAGS,
+                                           ns_clean=True, remove_comments=True, huge_tree=True)
+        self._scanner = _DataSectionScanner()
+        self._data_tables = []
+        self.tables = []
+        self.root = None
+
+    def load(self, source, chunk_size=CHUNK_SIZE):
+        if isinstance(source, (str, bytes, os.PathLike)):
+            try:
+                stream = open(source, 'rb')
+            except OSError as exc:
+                raise type(exc)(exc.errno, f"Error reading file '{os.fsdecode(source)}': {exc.strerror}") from exc
+            with stream:
+                return self._load_stream(stream, chunk_size)
+        return self._load_stream(source, chunk_size)
+
+    def _load_stream(self, stream, chunk_size):
+        chunk = stream.read(chunk_size)
+        while chunk:
+            self.feed(chunk)
+            chunk = stream.read(chunk_size)
+        return self.close()
+
+    def feed(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = self._scanner.feed(chunk)
+        if data:
+            self._parser.feed(data)
+        self._handle_events()
+
+    def close(self):
+        data = self._scanner.close()
+        if data:
+            self._parser.feed(data)
+        self.root = self._parser.close()
+        self._handle_events()
+        self._attach_data_sections()
+        return self.root
+
+    def _handle_events(self):
+        for event, element in self._parser.read_events():
+            tag = local_name(element.tag)
+            if event == 'start':
+                if tag == 'TABLE':
+                    self.tables.append(TableInfo(element, len(self.tables)))
+                elif tag == 'DATA' and self.tables:
+                    self._data_tables.append(self.tables[-1])
+                elif tag == 'TABLEDATA' and self.tables:
+                    self.tables[-1].nrows = 0
+            elif tag == 'TR':
+                if self.tables:
+                    self.tables[-1].nrows += 1
+                _discard(element)
+            elif tag == 'TABLEDATA':
+                element.clear(keep_tail=True)
+            elif tag == 'STREAM':
+                element.text = None
+
+    def _attach_data_sections(self):
+        sections = self._scanner.sections
+        if len(sections) != len(self._data_tables):
+            LOG.warning(f"Found {len(sections)} DATA sections in the byte stream, "
+                        f"but the document has {len(self._data_tables)}. Ignoring DATA offsets.")
+            return
+        for table, section in zip(self._data_tables, sections):
+            table.data_section = section
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def _discard(element):
+    # The parser might still be holding on to the element itself, so we only empty it and remove the
+    # previous siblings, which are complete.
+    element.clear(keep_tail=True)
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+class _DataSectionScanner:
+    """
+    Find the byte offsets of <DATA> elements in a stream of chunks, skipping comments and CDATA sections.
+
+    `feed` returns the bytes that should be passed on to the XML parser, i.e. the chunk without the content of
+    <STREAM> elements. Since the scanner holds back the end of a chunk that might hold a partial token, `close`
+    returns whatever is left once the whole document has been fed.
+    """
+    _TOKENS = re.compile(rb"<!--|<!\[CDATA\[|</(?:[\w.-]+:)?DATA\s*>|<(?:[\w.-]+:)?DATA[\s/>]"
+                         rb"|<(?:[\w.-]+:)?STREAM[\s/>]")
+    _CLOSING = {b"<!--": b"-->", b"<![CDATA[": b"]]>"}
+    _MAX_TOKEN = 64
+
+    def __init__(self):
+        self.sections = []
+        self._offset = 0
+        self._tail = b""
+        self._closing = None
+        self._start = None
+        self._in_stream = False
+
+    def feed(self, chunk):
+        buffer = self._tail + chunk
+        base = self._offset - len(self._tail)
+        self._offset += len(chunk)
+
+        output = []
+        emitted = 0
+        position = 0
+        while True:
+            if self._in_stream:
+                # Base64 content has no markup, the stream ends at the next tag.
+                end = buffer.find(b"<", position)
+                if end < 0:
+                    position = emitted = len(buffer)
+                    break
+                position = emitted = end
+                self._in_stream = False
+                continue
+
+            if self._closing is not None:
+                end = buffer.find(self._closing, position)
+                if end < 0:
+                    position = max(position, len(buffer) - len(self._closing) + 1)
+                    break
+                position = end + len(self._closing)
+                if self._closing == b">" and buffer[end - 1:end] != b"/":
+                    # End of a <STREAM> start tag, drop the content that follows.
+                    output.append(buffer[emitted:position])
+                    emitted = position
+                    self._in_stream = True
+                self._closing = None
+                continue
+
+            match = self._TOKENS.search(buffer, position)
+            if match is None:
+                position = max(position, len(buffer) - self._MAX_TOKEN)
+                break
+
+            token = match.group()
+            position = match.end()
+            if token in self._CLOSING:
+                self._closing = self._CLOSING[token]
+            elif token.startswith(b"</"):
+                if self._start is not None:
+                    self.sections.append(DataSection(self._start, base + match.end()))
+                    self._start = None
+            elif b"STREAM" in token:
+                # Look for the end of the start tag, which might be the last character of the token.
+                position -= 1
+                self._closing = b">"
+            else:
+                self._start = base + match.start()
+
+        output.append(buffer[emitted:position])
+        self._tail = buffer[position:]
+        return b"".join(output)
+
+    def close(self):
+        tail, self._tail = self._tail, b""
+        return tail
@@ -0,0 +1,398 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Zero-copy decoding of binary VOTable <TABLE> data.
+
+The rows of a BINARY or BINARY2 stream made of fixed width FIELDs have the layout of a numpy structured array, so
+the columns of the table are exposed as views over the stream instead of being decoded value by value:
+  o an inline base64 STREAM is decoded once, straight from the input buffer
+  o a STREAM referring to a local file without encoding is memory mapped
+  o a FITS table referring to a local file is memory mapped by astropy
+
+The numeric columns keep the big endian byte order of the stream, numpy computes with them as they are, and
+`get_column_dtype` reports that dtype before the table is mapped. Null values are not resolved when the table is
+mapped: the null mask of a column is computed when the column is first loaded, see `load_mapped_column`.
+"""
+import binascii
+import logging
+import os
+import re
+from urllib.parse import unquote, urlparse
+
+import numpy
+from astropy import units
+from astropy.io import fits
+from astropy.table import Column, MaskedColumn, QTable
+from astropy.units import Quantity
+from astropy.utils.masked import Masked
+
+from rama.reader.votable.decoder import count_binary_rows, get_serialization, iter_section, qualified_tag
+from rama.reader.votable.fields import (DATATYPES, get_column_name, get_field_dtype, get_field_layout, get_fields,
+                                        get_null_value)
+from rama.reader.votable.loader import DataSection
+
+LOG = logging.getLogger(__name__)
+
+# Key of the table metadata holding the functions computing the null masks of the columns not loaded yet
+NULL_MASKS = "null_masks"
+
+
+
+def map_table(buffer, table_info, field_ids=None):
+    """
+    Map the binary <DATA> section of a TABLE
+
+    Inputs:
+      o buffer      - InputBuffer of the document
+      o table_info  - TableInfo of the TABLE, from the annotation loader
+      o field_ids   - IDs of the FIELDs to map, all of them if None
+
+    Returns an AstroPy QTable whose numeric columns are views over the table data, or None if the table can't be
+    mapped:
+      o the data is serialized as TABLEDATA
+      o a FIELD has a variable length, or a datatype without a numpy equivalent
+      o the STREAM is compressed or refers to a remote file
+    """
+    if not can_map(buffer, table_info):
+        return None
+
+    table_element = table_info.element
+    tag, stream_element = get_serialization(table_element)
+    fields = get_fields(table_element)
+    if tag == "FITS":
+        columns = map_fits_columns(buffer, stream_element, fields)
+    else:
+        columns = map_binary_columns(buffer, table_info, tag, stream_element, fields)
+    if columns is None:
+        return None
+
+    names = []
+    values = []
+    null_masks = {}
+    for field, (column, null_mask) in zip(fields, columns):
+        name = get_column_name(field)
+        if field_ids and field.get("ID") not in field_ids:
+            continue
+        names.append(name)
+        values.append(make_column(field, column))
+        if null_mask is not None:
+            null_masks[name] = null_mask
+
+    return QTable(values, names=names, meta={NULL_MASKS: null_masks}, copy=False)
+
+
+def can_map(buffer, table_info):
+    """
+    Returns whether the <DATA> section of a TABLE can be mapped by `map_table`, judging from the document metadata
+    """
+    table_element = table_info.element
+    serialization = get_serialization(table_element)
+    if table_element.get("ref") is not None or serialization is None:
+        return False
+    tag, stream_element = serialization
+    if tag not in ("BINARY", "BINARY2", "FITS") or stream_element is None:
+        return False
+
+    if tag != "FITS":
+        fields = get_fields(table_element)
+        if not fields or any(get_field_format(field) is None for field in fields):
+            return False
+    if stream_element.get("href") is not None:
+        return get_stream_path(buffer, stream_element) is not None and \
+            stream_element.get("encoding", "none") == "none"
+    return tag != "FITS" and stream_element.get("encoding") == "base64"
+
+
+def get_column_dtype(buffer, table_info, field_element):
+    """
+    Returns the numpy dtype of the column of a FIELD once its TABLE is decoded: the numeric columns of mapped tables
+    are views over the big endian stream.
+    """
+    dtype = get_field_dtype(field_element)
+    if dtype is not None and dtype.kind in "iufc" and can_map(buffer, table_info):
+        return dtype.newbyteorder(">")
+    return dtype
+
+
+def load_mapped_column(table, column_name):
+    """
+    Returns a column of a table. The first time a column of a mapped table with null values is loaded, it is
+    replaced by a masked column over the same values.
+    """
+    column = table[column_name]
+    null_masks = table.meta.get(NULL_MASKS)
+    if not null_masks or column_name not in null_masks:
+        return column
+
+    mask = null_masks.pop(column_name)()
+    if mask.ndim < column.ndim:
+        # Null flags of array values apply to all the elements of the array
+        mask = numpy.broadcast_to(mask.reshape(mask.shape + (1,) * (column.ndim - mask.ndim)), column.shape).copy()
+    if isinstance(column, Quantity):
+        column = Masked(column, mask=mask, copy=False)
+    else:
+        column = MaskedColumn(column, mask=mask, copy=False)
+    table[column_name] = column
+    return column
+
+
+def make_column(field_element, values):
+    """
+    Returns the values of a FIELD as a Quantity if the FIELD has a unit, as a Column otherwise.
+    Fixed width strings are the only values that are copied.
+    """
+    if values.dtype.kind == "S":
+        values = numpy.char.decode(values, "ascii")
+    unit = field_element.get("unit")
+    if unit and values.dtype.kind in "iufc":
+        return Quantity(values, units.Unit(unit, format="vounit", parse_strict="silent"), copy=False)
+    return Column(values, copy=False)
+
+
+def map_binary_columns(buffer, table_info, tag, stream_element, fields):
+    """
+    Returns a (values, null mask function) pair for each FIELD of a BINARY or BINARY2 table, or None if the stream
+    can't be mapped
+    """
+    formats = [get_field_format(field) for field in fields]
+    if not fields or None in formats:
+        return None
+    data = read_stream(buffer, table_info, stream_element)
+    if data is None:
+        return None
+
+    names = [f"f{index}" for index in range(len(fields))]
+    if tag == "BINARY2":
+        # BINARY2 rows start with a bit mask flagging the null values of the row
+        names.insert(0, "nulls")
+        formats.insert(0, ("u1", ((len(fields) + 7) // 8,)))
+    dtype = numpy.dtype({"names": names, "formats": formats})
+    rows = len(data) // dtype.itemsize
+    if len(data) % dtype.itemsize:
+        LOG.warning(f"Ignoring {len(data) % dtype.itemsize} trailing bytes in the binary stream of a TABLE")
+    records = numpy.frombuffer(data, dtype=dtype, count=rows)
+
+    columns = []
+    for index, field in enumerate(fields):
+        values = records[f"f{index}"]
+        if tag == "BINARY2":
+            null_mask = _bit_mask(records["nulls"], index)
+        else:
+            null_mask = _value_mask(values, get_null_value(field))
+        columns.append((values, null_mask))
+    return columns
+
+
+def map_fits_columns(buffer, stream_element, fields):
+    """
+    Returns a (values, null mask function) pair for each FIELD of a FITS table, or None if the file can't be mapped
+    """
+    path = get_stream_path(buffer, stream_element)
+    if path is None or stream_element.get("encoding", "none") != "none":
+        return None
+    extension = int(stream_element.getparent().get("extnum", 1))
+    try:
+        with fits.open(path, memmap=True) as hdus:
+            data = hdus[extension].data
+            fits_columns = hdus[extension].columns
+            if data is None or len(fits_columns) != len(fields):
+                return None
+            # The columns keep the memory map open
+            return [(data.field(index), _value_mask(data.field(index), fits_columns[index].null))
+                    for index in range(len(fields))]
+    except (OSError, IndexError, AttributeError) as exc:
+        LOG.warning(f"Can't map FITS table {path}: {exc}")
+        return None
+
+
+def get_field_format(field_element):
+    """
+    Returns the numpy format of a FIELD, or None if it can't be mapped
+    """
+    datatype = field_element.get("datatype")
+    arraysize = field_element.get("arraysize")
+    value_format = get_stream_format(datatype)
+    if value_format is None or (arraysize and "*" in arraysize):
+        return None
+
+    # VOTable arrays are in column major order
+    shape = [int(dimension) for dimension in reversed(arraysize.split("x"))] if arraysize else []
+    if datatype == "char":
+        value_format = f"S{shape.pop() if shape else 1}"
+    return (value_format, tuple(shape)) if shape else value_format
+
+
+def get_stream_format(datatype):
+    """
+    Returns the big endian numpy type of a VOTable datatype in a binary stream, or None if it can't be mapped.
+    Booleans, bits and UCS-2 strings have no numpy equivalent.
+    """
+    if datatype == "char":
+        return "S"
+    if datatype not in DATATYPES:
+        return None
+    dtype = numpy.dtype(DATATYPES[datatype].dtype)
+    return dtype.newbyteorder(">").str if dtype.kind in "iufc" else None
+
+
+def read_stream(buffer, table_info, stream_element):
+    """
+    Returns the bytes of a binary STREAM, or None if they can't be read without decoding the whole document
+    """
+    encoding = stream_element.get("encoding")
+    if stream_element.get("href") is not None:
+        path = get_stream_path(buffer, stream_element)
+        if path is None or encoding not in (None, "none"):
+            return None
+        if os.path.getsize(path) == 0:
+            return b""
+        return numpy.memmap(path, mode="r")
+
+    if encoding != "base64":
+        return None
+    content = find_stream_content(buffer, table_info, stream_element)
+    if content is None:
+        return None
+    try:
+        return binascii.a2b_base64(buffer.view[content.start:content.end])
+    except binascii.Error as exc:
+        raise ValueError(f"Invalid base64 STREAM: {exc}") from exc
+
+
+def find_stream_content(buffer, table_info, stream_element):
+    """
+    Returns the DataSection holding the text of an inline STREAM, or None if the STREAM can't be located
+    """
+    section = table_info.data_section
+    if section is None:
+        return None
+    # The STREAM text is dropped from the annotation tree, it is read from the buffer
+    stream = re.escape(qualified_tag(stream_element.prefix, "STREAM").encode())
+    data = buffer.view[section.start:section.end]
+    start = re.search(rb"<" + stream + rb"(?:\s[^>]*)?>", data)
+    end = re.search(rb"</" + stream + rb"\s*>", data)
+    if start is None or end is None:
+        return None
+    return DataSection(section.start + start.end(), section.start + end.start())
+
+
+def count_rows(buffer, table_info):
+    """
+    Returns the number of rows of a TABLE, without decoding the table, or None if it is not known. The number of
+    rows is read from:
+      o the nrows attribute of the TABLE
+      o the header of a local FITS file
+      o the size of a BINARY or BINARY2 stream, for FIELDs of fixed width
+      o the sizes of the variable length arrays of an inline BINARY or BINARY2 stream, see `count_binary_rows`
+    """
+    table_element = table_info.element
+    nrows = table_element.get("nrows")
+    if nrows is not None and nrows.strip().isdigit():
+        return int(nrows)
+
+    serialization = get_serialization(table_element)
+    if table_element.get("ref") is not None or serialization is None:
+        return None
+    tag, stream_element = serialization
+    if tag not in ("BINARY", "BINARY2", "FITS") or stream_element is None:
+        return None
+    if tag == "FITS":
+        return count_fits_rows(buffer, stream_element)
+
+    layouts = [get_field_layout(field) for field in get_fields(table_element)]
+    if not layouts or None in layouts:
+        return None
+    if any(layout.size is None for layout in layouts):
+        if stream_element.get("href") is not None or stream_element.get("encoding") != "base64" or \
+                table_info.data_section is None:
+            return None
+        return count_binary_rows(iter_section(buffer, table_info.data_section), table_element.prefix, tag, layouts)
+
+    row_size = sum(layout.size for layout in layouts)
+    if tag == "BINARY2":
+        row_size += (len(layouts) + 7) // 8
+    size = get_stream_size(buffer, table_info, stream_element)
+    return size // row_size if size is not None and row_size else None
+
+
+def get_stream_size(buffer, table_info, stream_element):
+    """
+    Returns the number of bytes of a binary STREAM, counted without decoding it, or None if it is not known
+    """
+    encoding = stream_element.get("encoding")
+    if stream_element.get("href") is not None:
+        path = get_stream_path(buffer, stream_element)
+        if path is None or encoding not in (None, "none"):
+            return None
+        return os.path.getsize(path)
+
+    if encoding != "base64":
+        return None
+    content = find_stream_content(buffer, table_info, stream_element)
+    if content is None:
+        return None
+    characters = 0
+    last = b""
+    for chunk in iter_section(buffer, content):
+        chunk = chunk.translate(None, b" \t\r\n")
+        characters += len(chunk)
+        last = (last + chunk)[-2:]
+    return characters // 4 * 3 - (len(last) - len(last.rstrip(b"=")))
+
+
+def count_fits_rows(buffer, stream_element):
+    path = get_stream_path(buffer, stream_element)
+    if path is None or stream_element.get("encoding", "none") != "none":
+        return None
+    extension = int(stream_element.getparent().get("extnum", 1))
+    try:
+        return fits.getheader(path, extension).get("NAXIS2")
+    except (OSError, IndexError) as exc:
+        LOG.warning(f"Can't read the header of FITS table {path}: {exc}")
+        return None
+
+
+def get_stream_path(buffer, stream_element):
+    """
+    Returns the path of the local file a STREAM refers to, relative to the document, or None
+    """
+    url = urlparse(stream_element.get("href", ""))
+    if not url.path or url.scheme not in ("", "file"):
+        return None
+    path = unquote(url.path)
+    if not os.path.isabs(path):
+        if buffer.name is None:
+            return None
+        path = os.path.join(os.path.dirname(buffer.name), path)
+    return path
+
+
+def _bit_mask(null_bits, index):
+    return lambda: (null_bits[:, index // 8] & (0x80 >> index % 8)).astype(bool)
+
+
+def _value_mask(values, null_value):
+    if values.dtype.kind in "fc":
+        return lambda: numpy.isnan(values)
+    if null_value in (None, "") or values.dtype.kind not in "iu":
+        return None
+    return lambda: values == int(null_value)
@@ -20,10 +20,15 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------
-import itertools
+import hashlib
+import heapq
 import logging
+import threading
 import uuid
 import warnings
+import weakref
+from collections import Counter, OrderedDict
+from operator import attrgetter
 
 import numpy
 from astropy.io import votable
@@ -31,9 +36,16 @@ from astropy.table import QTable
 from lxml import etree
 
 from rama.framework import BaseType, InstanceId, Attribute, Reference, Composition, SingleReferenceWrapper, \
-    RowReferenceWrapper
-from rama.reader import Document, Reader
+    RowReferenceWrapper, LazyColumn
+from rama.reader import Document, InstanceRegistry, Reader, get_null_keys
+from rama.reader.buffer import InputBuffer
+from rama.reader.votable.decoder import decode_table, iter_table_batches
+from rama.reader.votable.fields import DATATYPES
+from rama.reader.votable.loader import AnnotationLoader, local_name
+from rama.reader.votable.mapped import count_rows, get_column_dtype, load_mapped_column, map_table
+from rama.reader.votable.tabledata import decode_tabledata
 from rama.utils import ADAPTER_PROPERTY_NAME
+from rama.utils.registry import TypeRegistry
 
 LOG = logging.getLogger(__name__)
 
@@ -41,365 +53,629 @@ LOG = logging.getLogger(__name__)
 class Votable(Document):
     def __init__(self, xml):
         super().__init__(xml)
-        # TBD Maybe I should remove TABLEDATA to reduce the size of the tree. TABLEDATA will be parsed by astropy.
-        parser = etree.XMLParser(ns_clean=True)
-        tree = etree.parse(xml, parser)
-        self.document = tree.getroot()
+        # The document is read once, the annotation loader and the table decoders share the same buffer.
+        self.buffer = InputBuffer(xml)
+        # Table rows are left out of the tree, TABLEDATA will be parsed by astropy.
+        loader = AnnotationLoader()
+        self.document = loader.load(self.buffer.open())
+        self.tables = loader.tables
+        self._table_infos = {table_info.element: table_info for table_info in self.tables}
+        self._plan = None
+        # Number of groups of the EXTINSTANCES grouped by the rows of a table decoded in batches, by GroupingStep
+        self.group_widths = {}
+        # Columns handed out before being decoded, which need the buffer until they are loaded or closed
+        self.lazy_columns = weakref.WeakSet()
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """
+        Index the elements that the parser looks up by ID or by type, in a single pass over the tree.
+        """
+        self._elements_by_id = {}
+        self._instances_by_type = {}
+        self._instance_positions = {}
+        self._vodml_elements = []
+        self._params_by_id = {}
+        self._fields_by_id = {}
+        self.column_refs = set()
+
+        for element in self.document.iter(etree.Element):
+            tag = local_name(element.tag)
+            element_id = element.get(ID)
+            if element_id is not None:
+                self._elements_by_id.setdefault(element_id, element)
+                if tag == PARAM:
+                    self._params_by_id.setdefault(element_id, element)
+                elif tag == FIELD:
+                    table_info = self.get_table_info(element.getparent())
+                    table_index = table_info.index if table_info is not None else None
+                    self._fields_by_id.setdefault(element_id, (element, table_index))
+            if tag == VODML:
+                self._vodml_elements.append(element)
+            elif tag == INSTANCE:
+                self._instances_by_type.setdefault(element.get(DMTYPE), []).append(element)
+                self._instance_positions[element] = len(self._instance_positions)
+            elif tag == COLUMN:
+                self.column_refs.add(element.get(REF))
+
+    def get_table_info(self, table_element):
+        return self._table_infos.get(table_element, None)
+
+    def get_element_by_id(self, element_id):
+        return self._elements_by_id.get(element_id, None)
+
+    def get_instance_by_id(self, element_id):
+        element = self.get_element_by_id(element_id)
+        if element is not None and local_name(element.tag) == INSTANCE:
+            return element
+        return None
+
+    def find_instances_by_type(self, type_id):
+        return self._instances_by_type.get(type_id, [])
+
+    def iter_instances_by_type(self):
+        """
+        Iterate over the (dmtype, INSTANCE elements) pairs of the document, each list being in document order
+        """
+        return iter(self._instances_by_type.items())
+
+    def get_instance_position(self, element):
+        """
+        Position of an INSTANCE element among all the INSTANCE elements of the document
+        """
+        return self._instance_positions[element]
+
+    def get_param(self, param_id):
+        return self._params_by_id.get(param_id, None)
+
+    def get_field(self, field_id):
+        """
+        Returns the (FIELD element, TABLE index) pair for the FIELD with the given ID, or (None, None)
+        """
+        return self._fields_by_id.get(field_id, (None, None))
+
+    def get_plan(self):
+        """
+        Returns the AnnotationPlan of the document. The VODML block is compiled the first time the plan is requested,
+        unless a document with the same VODML block has already been compiled in this process.
+        """
+        if self._plan is None:
+            key = self.get_annotation_key()
+            plan = PLAN_CACHE.get(key) if key is not None else None
+            if plan is None:
+                plan = PlanCompiler(self).compile()
+                if key is not None:
+                    PLAN_CACHE.put(key, plan)
+            self._plan = plan
+        return self._plan
+
+    def get_annotation_key(self):
+        """
+        Returns a hash of the canonicalized VODML elements of the document, or None if the document has none
+        """
+        if not self._vodml_elements:
+            return None
+        digest = hashlib.sha256()
+        for element in self._vodml_elements:
+            digest.update(etree.tostring(element, method="c14n", with_comments=False))
+        return digest.hexdigest()
 
     def find_instances(self, element_class, context):
         return find_instances(self, element_class, context)
 
-
-def get_local_name(tag_name):
-    return f"*[local-name() = '{tag_name}']"
-
-
-TEMPLATES = get_local_name("TEMPLATES")
-EXTINSTANCES = get_local_name("EXTINSTANCES")
-INSTANCE = get_local_name("INSTANCE")
-CONTAINER = get_local_name("CONTAINER")
-LITERAL = get_local_name("LITERAL")
-CONSTANT = get_local_name("CONSTANT")
-COLUMN = get_local_name("COLUMN")
-REFERENCE = get_local_name("REFERENCE")
-COMPOSITION = get_local_name("COMPOSITION")
-ATTRIBUTE = get_local_name("ATTRIBUTE")
-TABLE = get_local_name("TABLE")
-FIELD = get_local_name("FIELD")
-PARAM = get_local_name("PARAM")
-PRIMARYKEY = get_local_name("PRIMARYKEY")
-FOREIGNKEY = get_local_name("FOREIGNKEY")
-PKFIELD = get_local_name("PKFIELD")
-IDREF = get_local_name("IDREF")
-TARGETID = get_local_name("TARGETID")
+    def iter_instances(self, element_class, context, batch_size):
+        return iter_instances(self, element_class, context, batch_size)
+
+    def explain(self, element_class, context):
+        return explain(self, element_class, context)
+
+    def close(self):
+        # The columns that were not accessed yet would decode from the buffer, they are not decoded now as it could
+        # cost more than the whole read
+        for column in list(self.lazy_columns):
+            column.close()
+        self.lazy_columns.clear()
+        self.buffer.close()
+
+
+VODML = "VODML"
+TEMPLATES = "TEMPLATES"
+EXTINSTANCES = "EXTINSTANCES"
+INSTANCE = "INSTANCE"
+CONTAINER = "CONTAINER"
+LITERAL = "LITERAL"
+CONSTANT = "CONSTANT"
+COLUMN = "COLUMN"
+REFERENCE = "REFERENCE"
+COMPOSITION = "COMPOSITION"
+ATTRIBUTE = "ATTRIBUTE"
+TABLE = "TABLE"
+RESOURCE = "RESOURCE"
+FIELD = "FIELD"
+PARAM = "PARAM"
+PRIMARYKEY = "PRIMARYKEY"
+FOREIGNKEY = "FOREIGNKEY"
+PKFIELD = "PKFIELD"
+IDREF = "IDREF"
+TARGETID = "TARGETID"
+ROLE_TAGS = {ATTRIBUTE, COMPOSITION, REFERENCE}
+CHILD_TAGS = (TEMPLATES, EXTINSTANCES, INSTANCE, CONTAINER, LITERAL, CONSTANT, COLUMN, TABLE, RESOURCE, FIELD,
+              PRIMARYKEY, FOREIGNKEY, PKFIELD, IDREF, TARGETID)
 ID = "ID"
-REF_ATTR = "@ref"
-ID_ATTR = f"@{ID}"
-NAME_ATTR = "@name"
-VALUE_ATTR = "@value"
-TYPE_ATTR = "@dmtype"
-ROLE_ATTR = "@dmrole"
-UNIT_ATTR = "@unit"
+REF = "ref"
+NAME = "name"
+VALUE = "value"
+DMTYPE = "dmtype"
+DMROLE = "dmrole"
+UNIT = "unit"
+DATATYPE = "datatype"
+ARRAYSIZE = "arraysize"
 
+PLAN_CACHE_SIZE = 128
 
-def find_instances(votable: Votable, element_class: BaseType, context: Reader):
-    return [read_instance(element, context) for element in find(votable, element_class)]
+FIELD_TAGS = {Attribute: ATTRIBUTE, Composition: COMPOSITION, Reference: REFERENCE}
 
+VOTABLE_1_3 = "http://www.ivoa.net/xml/VOTable/v1.3"
+VOTABLE_1_4 = "http://www.ivoa.net/xml/VOTable/v1.4"
 
-def find(votable: Votable, element_class: BaseType):
-    type_id = [element_class.vodml_id, ]
-    subtype_ids = [subtype.vodml_id for subtype in element_class.all_subclasses()]
-    all_ids = type_id + subtype_ids
-    elements = [find_instance_elements(votable.document, id) for id in all_ids]
-    elements_flat = list(itertools.chain(*elements))
-    return elements_flat
 
+class VodmlXPath:
+    """
+    Precompiled XPath queries for the VODML grammar, bound to the namespace of the annotated document.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._namespaces = {"vo": namespace} if namespace else None
+        self._prefix = "vo:" if namespace else ""
 
-def find_instance_elements(xml_document, vodml_id):
-    return xml_document.xpath(get_instance_element_by_id(vodml_id))
-
+        self.children = {tag: self._compile(f"child::{{vo}}{tag}") for tag in CHILD_TAGS}
+        self.template_ancestors = self._compile("ancestor::{vo}TEMPLATES")
+        self.container_foreign_keys = self._compile("child::{vo}CONTAINER/{vo}FOREIGNKEY")
 
-def get_instance_element_by_id(vodml_id):
-    return get_type_xpath_expression("INSTANCE", vodml_id)
+    def _compile(self, path):
+        return etree.XPath(path.format(vo=self._prefix), namespaces=self._namespaces)
 
 
-def read_instance(xml_element, context):
-    type_id = resolve_type(xml_element)
-    element_class = context.get_type_by_id(type_id)
-    return make(element_class, xml_element, context)
+XPATHS = {namespace: VodmlXPath(namespace) for namespace in (VOTABLE_1_3, VOTABLE_1_4, None)}
 
 
-def parse_table(context, column_element):
+def get_xpath(element):
     """
-    Parse VOTable <TABLE> Element
+    Returns the VodmlXPath queries for the namespace of the element. Queries for namespaces other than the
+    VOTable 1.3 and 1.4 ones are compiled on first use.
+    """
+    namespace = etree.QName(element).namespace
+    xpath = XPATHS.get(namespace, None)
+    if xpath is None:
+        xpath = XPATHS[namespace] = VodmlXPath(namespace)
+    return xpath
 
-    Inputs:
-      o context        - Reader
-      o column_element - VOTable <FIELD> node
 
-    Returns new/updated table as:
-      o AstroPy QTable
-    """
-    # Get VOTable TABLE element..
-    table_elements = column_element.xpath(f"parent::{TABLE}")
-    if not table_elements:
-        raise RuntimeError("COLUMN points to FIELD that does not have a TABLE parent")
-    table_element = table_elements[0]
+def find_instances(votable: Votable, element_class: BaseType, context: Reader):
+    return [step.execute(context) for step in find(votable.get_plan(), element_class)]
 
-    # Which TABLE in the file?
-    table_index = int(table_element.xpath(f"count(preceding-sibling::{TABLE})"))
 
-    # Get or generate ID tag for this table (for storing)
-    table_ids = table_element.xpath(ID_ATTR)
-    if table_ids:
-        table_id = table_ids[0]
-    else:
-        # NOTE: this only serves to create a no-match condition
-        #       the actual table id is assigned within the table processing clause
-        table_id = f"_GENERATED_ID_{table_index}"
+def find(plan, element_class: BaseType):
+    """
+    Returns the steps building the instances of a class or of its registered subclasses, in document order
+    """
+    return plan.find_instance_steps(TypeRegistry.instance.get_subtype_ids(element_class))
 
-    # Pull stored table from reader, or generate it and add it to reader
-    table = context.get_table_by_id(table_id)
-    if table is None:
-        # Process table
-        table = QTable(votable.parse_single_table(context.file, table_number=table_index).to_table())
-        table_id = str(id(table)) # MCD TEMP: ACTUAL CODE CHANGE!!
 
-        # Store table in context
-        context.add_table(table_id, table)
+def iter_instances(votable: Votable, element_class: BaseType, context: Reader, batch_size):
+    """
+    Iterate over the instances of a class, decoding the rows of the table they are built from in batches
 
-        # Set the ID attribute in the XML so we have an handle if see it again
-        table_element.attrib[ID] = table_id
+    Inputs:
+      o votable        - Votable document
+      o element_class  - class of the instances, its subclasses are included
+      o context        - Reader
+      o batch_size     - maximum number of rows of each batch
 
-    return table
+    The first TABLE referenced by the instances, in document order, is decoded in batches of rows. Each batch is
+    bound to a new Reader, and the instances built from its columns are yielded once per batch, with a cardinality
+    of at most `batch_size`. Instances that don't depend on the rows of that table are only yielded once, and
+    the instances which are not templates are shared by all the batches. The other TABLEs are decoded once.
 
-def parse_id(context, xml_element, instance_class):
-    keys = None
-    primary_key_elements = xml_element.xpath(f"./{PRIMARYKEY}")
-    if primary_key_elements:
-        keys = parse_identifier_field(context, primary_key_elements[0])
-    ids = xml_element.xpath(ID_ATTR)
-    if not ids:
-        # Randomly generate an ID for each instance that doesn't have any.
-        id = f"{instance_class.vodml_id}-{str(uuid.uuid4())}"
-    else:
-        id = ids[0]
+    EXTINSTANCES grouped by the rows of the table are padded to the same number of groups in all the batches, see
+    `compute_group_widths`.
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be a positive integer, got {batch_size}")
 
-    return InstanceId(id, keys)
+    steps = find(votable.get_plan(), element_class)
+    step_tables = [find_step_tables(votable, [step]) for step in steps]
+    table_indexes = sorted(set().union(*step_tables))
+    if not table_indexes:
+        yield from (step.execute(context) for step in steps)
+        return
 
+    streamed_index = table_indexes[0]
+    streamed_info = votable.tables[streamed_index]
+    parse_tables(context, [votable.tables[table_index] for table_index in table_indexes[1:]])
+    compute_group_widths(votable, context, steps, streamed_info, batch_size)
 
-def parse_identifier_field(context, xml_element):
-    pk_fields = xml_element.xpath(f"./{PKFIELD}")
-    keys_array = numpy.array([parse_primary_key_field(context, pk_field) for pk_field in pk_fields]).T
-    return keys_array
+    first_batch = True
+    for table in iter_table_rows(context, streamed_info, batch_size):
+        batch_context = make_batch_context(context, streamed_info, table)
+        share_instances(context.instance_registry, batch_context.instance_registry)
 
+        for step, tables in zip(steps, step_tables):
+            if first_batch or streamed_index in tables:
+                yield step.execute(batch_context)
 
-def parse_primary_key_field(context, xml_element):
-    literal_elements = xml_element.xpath(f"./{LITERAL}")
-    if literal_elements:
-        return parse_literal(context, literal_elements[0])
-    constant_elements = xml_element.xpath(f"./{CONSTANT}")
-    if constant_elements:
-        return parse_constant(context, constant_elements[0])
-    column_elements = xml_element.xpath(f"./{COLUMN}")
-    if column_elements:
-        return parse_column(context, column_elements[0]).data
+        share_instances(batch_context.instance_registry, context.instance_registry)
+        first_batch = False
 
+    if first_batch:
+        # The table has no rows
+        yield from (step.execute(context) for step, tables in zip(steps, step_tables) if streamed_index not in tables)
 
-def get_type_xpath_expression(tag_name, type_id):
-    tag_selector = get_local_name(tag_name)
-    return f"//{tag_selector}[{TYPE_ATTR}='{type_id}']"
 
+def make_batch_context(context, table_info, table):
+    """
+    Returns a new Reader on the document of `context`, sharing its tables, with the rows of a batch for the TABLE
+    """
+    batch_context = Reader(context.document, workers=context.workers)
+    batch_context.tables = dict(context.tables)
+    batch_context.column_mappings = context.column_mappings
+    batch_context.add_table(get_table_id(table_info), table)
+    return batch_context
 
-def get_role_xpath_expression(tag_name, role_id):
-    return f".//{tag_name}[{ROLE_ATTR}='{role_id}']"
 
+def compute_group_widths(votable: Votable, context, steps, table_info, batch_size):
+    """
+    Compute the number of groups of the EXTINSTANCES grouped by the rows of a TABLE decoded in batches
 
-def get_local_name(tag_name):
-    return f"*[local-name() = '{tag_name}']"
+    The instances matching each row are padded to the largest number of matches of any row, which has to be known
+    for the whole table so that all the batches are padded alike. The key columns of the table are read in
+    batches, the other columns are not decoded. The widths are stored in `votable.group_widths`.
+    """
+    for step in iter_steps(steps):
+        if not isinstance(step, GroupingStep) or step.target_primary_key is None or step in votable.group_widths:
+            continue
+        if table_info.index in find_step_tables(votable, [step.keys]):
+            # The instances are built from the same batches, they can't be grouped over the whole table
+            continue
+        key_refs = [key.column_ref for key in iter_steps([step.target_primary_key])
+                    if isinstance(key, ColumnStep) and votable.get_field(key.column_ref)[1] == table_info.index]
+        if not key_refs:
+            continue
+
+        matches = Counter(as_key_tuples(step.keys.execute(context)))
+        width = 0
+        for table in iter_table_rows(context, table_info, batch_size, key_refs):
+            target_keys = step.target_primary_key.execute(make_batch_context(context, table_info, table))
+            width = max([width] + [matches[key] for key in as_key_tuples(target_keys) if key is not None])
+        votable.group_widths[step] = width
+
+
+def iter_table_rows(context, table_info, batch_size, field_ids=None):
+    """
+    Iterate over the rows of a TABLE in QTables of at most `batch_size` rows. Only the given FIELDs are decoded,
+    by default the FIELDs referenced by COLUMN elements.
 
+    Tables that can't be decoded in batches are decoded in full, and then sliced.
+    """
+    if field_ids is None:
+        field_ids = find_referenced_fields(context.document, table_info)
+    batches = iter_table_batches(context.document.buffer, table_info, batch_size, field_ids)
+    if batches is not None:
+        for batch in batches:
+            yield QTable(batch.to_table(), copy=False)
+        return
+
+    LOG.info(f"Table {get_table_id(table_info)} can't be decoded in batches, decoding the whole table")
+    table_context = Reader(context.document, workers=context.workers)
+    parse_tables(table_context, [table_info])
+    table = table_context.get_table_by_id(get_table_id(table_info))
+    for start in range(0, len(table), batch_size):
+        yield table[start:start + batch_size]
+
+
+def find_step_tables(votable: Votable, steps):
+    """
+    The indexes of the TABLEs with a FIELD referenced by the given steps or by the steps they depend on
+    """
+    table_indexes = {votable.get_field(step.column_ref)[1]
+                     for step in iter_steps(steps) if isinstance(step, ColumnStep)}
+    table_indexes.discard(None)
+    return table_indexes
 
-def get_child_selector(tag_name):
-    return f"child::{tag_name}"
 
+def iter_steps(steps):
+    """
+    Iterate over the given steps and the steps they depend on, each step only once
+    """
+    visited = set()
+    pending = list(reversed(steps))
+    while pending:
+        step = pending.pop()
+        if step in visited:
+            continue
+        visited.add(step)
+        yield step
+        pending.extend(reversed(step.children()))
+
+
+def share_instances(source: InstanceRegistry, target: InstanceRegistry):
+    """
+    Copy the instances of a registry that are not templates, i.e. that don't depend on table rows, to another one
+    """
+    for source_instances, target_instances in ((source.id_instances, target.id_instances),
+                                               (source.pk_instances, target.pk_instances)):
+        for key, instance in source_instances.items():
+            vo_instance = getattr(instance, "__vo_object__", instance)
+            if not getattr(vo_instance, "is_template", False):
+                target_instances.setdefault(key, instance)
 
-def get_children(element, child_tag_name):
-    return element.xpath(get_child_selector(child_tag_name))
 
+def explain(votable: Votable, element_class: BaseType, context: Reader):
+    """
+    Describe how the instances of a class would be built from the document
 
-def resolve_type(xml_element):
-    element_type = xml_element.xpath(TYPE_ATTR)[0]
-    return element_type
+    Inputs:
+      o votable        - Votable document
+      o element_class  - class to explain, its subclasses are included
+      o context        - Reader
 
+    Returns a text listing:
+      o the build steps for each instance, nested by role
+      o the tables and columns touched by the steps
+      o the estimated materialization cost
+    """
+    steps = find(votable.get_plan(), element_class)
+    lines = [f"Plan for {element_class.vodml_id}: {len(steps)} instance(s)"]
+    visited = set()
+    for step in steps:
+        describe_step(step, lines, visited, 1)
+
+    columns = {}
+    for step in visited:
+        if isinstance(step, ColumnStep):
+            columns.setdefault(step.column_ref, step)
+
+    lines.append("Tables:")
+    touched = {}
+    for column_ref in sorted(columns):
+        field, table_index = votable.get_field(column_ref)
+        touched.setdefault(table_index, []).append((column_ref, field))
+
+    n_values = 0
+    n_bytes = 0
+    exact_values = exact_bytes = True
+    for table_index in sorted(touched, key=lambda index: -1 if index is None else index):
+        if table_index is None:
+            lines.append("  (unresolved): " + ", ".join(column_ref for column_ref, _ in touched[table_index]))
+            continue
+        table_info = votable.tables[table_index]
+        nrows = get_table_length(context, table_info)
+        rows = f"{nrows} rows" if nrows is not None else "unknown number of rows"
+        lines.append(f"  {get_table_id(table_info)} ({rows}):")
+        for column_ref, field in touched[table_index]:
+            datatype = field.get(DATATYPE)
+            arraysize = field.get(ARRAYSIZE)
+            shape = f"[{arraysize}]" if arraysize else ""
+            lines.append(f"    {column_ref} -> FIELD {field.get(NAME)} ({datatype}{shape})")
+            size, fixed = estimate_value_size(datatype, arraysize)
+            if nrows is None:
+                exact_values = exact_bytes = False
+                continue
+            n_values += nrows
+            n_bytes += nrows * size
+            exact_bytes = exact_bytes and fixed
+
+    if not touched:
+        lines.append("  (none)")
+
+    n_instances = sum(1 for step in visited if isinstance(step, InstanceStep))
+    values = f"{n_values}" if exact_values else f"at least {n_values}"
+    size = f"{n_bytes}" if exact_bytes else f"at least {n_bytes}"
+    lines.append(f"Estimated cost: {n_instances} instance(s), {len(columns)} column(s), "
+                 f"{values} column value(s), {size} bytes")
+    return "\n".join(lines)
+
+
+def describe_step(step, lines, visited, depth):
+    indent = "  " * depth
+    if step in visited and isinstance(step, InstanceStep):
+        lines.append(f"{indent}{step.describe()} (see above)")
+        return
+    visited.add(step)
+    lines.append(f"{indent}{step.describe()}")
+    for child in step.children():
+        describe_step(child, lines, visited, depth + 1)
+
+
+def estimate_value_size(datatype, arraysize):
+    """
+    Returns the estimated size in bytes of a FIELD value, and whether the estimate is exact
+    """
+    size = DATATYPES[datatype].size if datatype in DATATYPES else None
+    fixed = size is not None
+    size = size or 0
+    if arraysize:
+        for dimension in arraysize.split("x"):
+            if dimension.endswith("*"):
+                fixed = False
+                dimension = dimension[:-1]
+            if dimension:
+                size *= int(dimension)
+    return size, fixed
+
+
+def parse_table(context, table_index):
+    """
+    Parse VOTable <TABLE> Element
 
-def find_element_for_role(xml_element, tag_name, role_id):
-    elements = xml_element.xpath(get_role_xpath_expression(tag_name, role_id))
-    n_elements = len(elements)
+    Inputs:
+      o context        - Reader
+      o table_index    - index of the TABLE in the document
 
-    if n_elements > 1:
-        warnings.warn(SyntaxWarning, f"Too many elements with dmrole = {role_id}")
+    Returns new/updated table as:
+      o AstroPy QTable
+    """
+    # Get VOTable TABLE element..
+    if table_index is None:
+        raise RuntimeError("COLUMN points to FIELD that does not have a TABLE parent")
+    table_info = context.document.tables[table_index]
 
-    if n_elements:
-        return elements[0]
+    # Pull stored table from reader, or decode all the referenced tables and add them to reader
+    table_id = get_table_id(table_info)
+    table = context.get_table_by_id(table_id)
+    if table is None:
+        parse_tables(context)
+        table = context.get_table_by_id(table_id)
 
-    return None
+    return table
 
 
-def is_template(xml_element):
-    """
-    Is Element within TEMPLATES node?
+def parse_tables(context, table_infos=None):
     """
-    has_template_ancestor = len(xml_element.xpath(f'./ancestor::{TEMPLATES}')) > 0
-    return has_template_ancestor
-
+    Decode all the VOTable <TABLE> Elements referenced by COLUMN elements.
 
-def decorate_with_adapter(instance_info):
-    decorated_instance = instance_info.instance
-    if hasattr(instance_info.instance_class, ADAPTER_PROPERTY_NAME):
-        vo_instance = instance_info.instance
-        adapter = getattr(instance_info.instance_class, ADAPTER_PROPERTY_NAME)
-        decorated_instance = adapter(vo_instance)
-        decorated_instance.__vo_object__ = vo_instance
-    decorated_instance.__vo_id__ = instance_info.instance_id
-    return decorated_instance
+    Inputs:
+      o context        - Reader
+      o table_infos    - TableInfo of the TABLEs to decode, defaults to all the referenced TABLEs
 
+    Only the FIELDs referenced by COLUMN elements (including those of PKFIELDs) are decoded, each table being
+    decoded from its own DATA section. Binary tables of fixed width FIELDs are mapped rather than decoded, see
+    `map_table`, and TABLEDATA columns of numbers and strings are converted in bulk, see `decode_tabledata`.
+    Other tables are decoded by astropy, and tables that can't be decoded on their own are decoded in full, in a
+    single pass over the file.
 
-def attach_fields(instance_info):
-    field_readers = {
-        Attribute: parse_attributes,
-        Reference: parse_references,
-        Composition: parse_composed_instances
-    }
-    fields = instance_info.instance_class.find_fields()
-    for field_name, field_object in fields:
-        field_reader = field_readers[field_object.__class__]
-        field_instance = field_reader(instance_info.xml_element, field_object, instance_info.context)
-        instance_info.instance.set_field(field_name, field_instance)
-    return instance_info
-#
-# ----------------------------------------------------------------------
-def parse_attributes(xml_element, field_object, context):
-    xml_element = find_element_for_role(xml_element, ATTRIBUTE, field_object.vodml_id)
-    if xml_element is not None:
-        values = parse_structured_instances(xml_element, context) +\
-                 parse_literals(xml_element, context) +\
-                 parse_constants(xml_element, context) +\
-                 parse_columns(xml_element, context)
-        return field_object.select_return_value(values)
+    Each table is stored in the context as an AstroPy QTable.
+    """
+    document = context.document
+    if table_infos is None:
+        table_infos = find_referenced_tables(document)
+    table_infos = [table_info for table_info in table_infos
+                   if context.get_table_by_id(get_table_id(table_info)) is None]
+    if not table_infos:
+        return
+
+    tables = {}
+    for table_info in table_infos:
+        field_ids = find_referenced_fields(document, table_info)
+        table = map_table(document.buffer, table_info, field_ids)
+        if table is None:
+            table = decode_tabledata(document.buffer, table_info, field_ids, workers=context.workers)
+        if table is None:
+            table = decode_table(document.buffer, table_info, field_ids)
+            table = QTable(table.to_table(), copy=False) if table is not None else None
+        if table is not None:
+            tables[table_info] = table
+
+    remaining_table_infos = [table_info for table_info in table_infos if table_info not in tables]
+    if remaining_table_infos:
+        for table_info, table in parse_full_tables(context, remaining_table_infos).items():
+            tables[table_info] = QTable(table.to_table(), copy=False)
+
+    for table_info in table_infos:
+        context.add_table(get_table_id(table_info), tables[table_info])
+
+
+def parse_full_tables(context, table_infos):
+    """
+    Decode all the FIELDs of the given TABLEs, reading the file only once.
 
+    Inputs:
+      o context        - Reader
+      o table_infos    - TableInfo of the TABLEs to decode
 
-def parse_composed_instances(xml_element, field_object, context):
-    xml_element = find_element_for_role(xml_element, COMPOSITION, field_object.vodml_id)
-    if xml_element is not None:
-        values = parse_structured_instances(xml_element, context) +\
-                 parse_extinstances(xml_element, context)
-        result = field_object.select_return_value(values)
-        return result
+    Returns a TableInfo -> astropy votable Table dictionary
+    """
+    buffer = context.document.buffer
 
+    if len(table_infos) == 1:
+        # The parser can skip all the other tables
+        table_info = table_infos[0]
+        return {table_info: votable.parse_single_table(buffer.open(), table_number=table_info.index)}
 
-def parse_references(xml_element, field_object, context):
-    # In the votable 1.4 schema there is a choice among IDREF, FOREIGNKEY, and REMOREREFERENCE (currently
-    # unsupported). In invalid cases where multiple elements are given, we give precedence to IDREF.
+    votable_file = votable.parse(buffer.open())
+    table_infos_in_parse_order = [context.document.get_table_info(element)
+                                  for element in iter_table_elements(context.document.document)]
+    tables = dict(zip(table_infos_in_parse_order, votable_file.iter_tables()))
+    return {table_info: tables[table_info] for table_info in table_infos}
 
-    xml_element = find_element_for_role(xml_element, REFERENCE, field_object.vodml_id)
-    if xml_element is not None:
-        idref_instances = parse_idref_instances(xml_element, context)
-        if idref_instances:
-            return field_object.select_return_value(idref_instances)
 
-        foreign_key_instances = parse_foreign_key_instances(xml_element, context)
-        if foreign_key_instances:
-            return field_object.select_return_value(foreign_key_instances)
+def find_referenced_tables(votable: Votable):
+    """
+    The TABLEs with at least one FIELD referenced by a COLUMN element, in document order
+    """
+    table_indexes = {votable.get_field(column_ref)[1] for column_ref in votable.column_refs}
+    table_indexes.discard(None)
+    return [votable.tables[table_index] for table_index in sorted(table_indexes)]
 
-def parse_structured_instances(xml_element, context):
-    elements = get_children(xml_element, INSTANCE)
-    return [read_instance(element, context) for element in elements]
 
-def parse_literals(xml_element, context):
-    elements = get_children(xml_element, LITERAL)
-    return [parse_literal(context, element) for element in elements]
+def find_referenced_fields(votable: Votable, table_info):
+    """
+    The IDs of the FIELDs of a TABLE referenced by a COLUMN element, in FIELD order
+    """
+    return [field.get(ID) for field in get_children(table_info.element, FIELD) if field.get(ID) in votable.column_refs]
 
-def parse_constants(xml_element, context):
-    elements = get_children(xml_element, CONSTANT)
-    return [parse_constant(context, element) for element in elements]
 
-def parse_columns(xml_element, context):
-    elements = get_children(xml_element, COLUMN)
-    return [parse_column(context, element) for element in elements]
+def iter_table_elements(element):
+    """
+    Iterate over the TABLE elements in the same order as astropy does, i.e. the TABLEs of a RESOURCE come before
+    the TABLEs of its nested RESOURCEs.
+    """
+    for child in get_children(element, TABLE):
+        yield child
+    for child in get_children(element, RESOURCE):
+        yield from iter_table_elements(child)
 
-def parse_idref_instances(xml_element, context):
-    elements = get_children(xml_element, IDREF)
-    return [parse_idref(element, context) for element in elements]
 
-def parse_foreign_key_instances(xml_element, context):
-    elements = get_children(xml_element, FOREIGNKEY)
-    return [parse_foreign_key(element, context) for element in elements]
+def get_table_id(table_info):
+    table_id = table_info.element.get(ID)
+    if table_id is None:
+        table_id = f"_GENERATED_ID_{table_info.index}"
+    return table_id
 
-def parse_extinstances(xml_element, context):
-    elements = get_children(xml_element, EXTINSTANCES)
-    instances = []
-    for element in elements:
-        instances += parse_extinstance(element, context)
-    return instances
 
-#
-# ----------------------------------------------------------------------
-def parse_extinstance(xml_element, context):
-    # get extinstance reference id
-    ref = InstanceId(xml_element.text, None)
-    
-    # pull referred instance element
-    referred_elements = xml_element.xpath(f"//{INSTANCE}[{ID_ATTR}='{ref.id}']")
-    if not referred_elements:
-        # TODO make a single call?
-        msg = f"Dangling reference {ref}"
-        warnings.warn(msg, SyntaxWarning)
-        LOG.warning(msg)
-        return None
-    referred_element = referred_elements[0]
+def get_children(element, child_tag_name):
+    return get_xpath(element).children[child_tag_name](element)
 
-    # process extinstance template
-    #  - we want the individual instances in this case.
-    #    may be getting appended to local instances and needs to be a list of instances
-    instance = read_instance( referred_element, context )
-    instances = instance.unroll()
 
-    # FOREIGNKEY = constrains returned instance set
-    has_foreign_key = len(referred_element.xpath(f'./child::{CONTAINER}/{FOREIGNKEY}')) > 0
+def is_template(xml_element):
+    """
+    Is Element within TEMPLATES node?
+    """
+    has_template_ancestor = len(get_xpath(xml_element).template_ancestors(xml_element)) > 0
+    return has_template_ancestor
 
-    if not has_foreign_key:
-        # No screening criteria, return List of resolved instances
-        result = instances
-    else:
-        element = get_children(referred_element, CONTAINER)[0]
-        result = group_extinstances( instances, element, context )
 
-    return result
+def decorate_with_adapter(instance, instance_id, instance_class):
+    decorated_instance = instance
+    if hasattr(instance_class, ADAPTER_PROPERTY_NAME):
+        vo_instance = instance
+        adapter = getattr(instance_class, ADAPTER_PROPERTY_NAME)
+        decorated_instance = adapter(vo_instance)
+        decorated_instance.__vo_object__ = vo_instance
+    decorated_instance.__vo_id__ = instance_id
+    return decorated_instance
 
 
-def group_extinstances( instances, xml_element, context ):
+def group_extinstances( instances, instance_keys, target_instance_keys, width=None ):
     # ----------------------------------------------------------------------
     # instances: List of resolved EXTINSTANCEs
-    # xml_element: CONTAINER element
+    # instance_keys: FOREIGNKEY values of each instance
+    # target_instance_keys: PRIMARYKEY values of the target instance
+    # width: number of slices to return, defaults to the maximum # matches of the target instance keys
     #----------------------------------------------------------------------
     # CONTAINER is a backward connection to a parent instance.
     #   - Contains one of: IDREF, FOREIGNKEY, REMOTEREF
     #      - implementing FOREIGNKEY
 
-    fk_elements = get_children(xml_element, FOREIGNKEY)
-    for fk_element in fk_elements:
-        target_id = fk_element.xpath(f"./{TARGETID}")[0].text
-        
-        # Get keys associated with each instance
-        instance_keys = parse_identifier_field(context, fk_element)
-        #print("DEBUG: EXTINSTANCE KEYS = %s"%(str(instance_keys)))
-        
-        # Get target keys
-        target = context.get_instance_by_id( InstanceId( target_id, None ) )
-        if target is not None:
-            # Untested
-            target_instance_keys = target.__vo_id__.keys
-        else:
-            # Target instance not already processed..
-            # NOTE: do not want to 'make' it, can set up recursive loop
-            #  ie: we are currently processing the Target instance.
-            target_elements = xml_element.xpath(f"//*[{ID_ATTR}='{target_id}']")
-            target_element = target_elements[0]
-            
-            # Resolve PRIMARYKEY value set from target element:
-            #   pulled from read_instance() and make()
-            type_id = resolve_type(target_element)
-            element_class = context.get_type_by_id(type_id)
-            target_instance_id = parse_id(context, target_element, element_class)
-            target_instance_keys = target_instance_id.keys
-            #print("DEBUG: TARGET instance keys = %s"%(str(target_instance_keys)))
-            
     # Have keys resolved.. sort instances
     # target instance keys are the selection criteria
+    # Null keys never match, the groups of null target keys are padding only
+    target_instance_keys = as_key_tuples(target_instance_keys)
+    instance_keys = as_key_tuples(instance_keys)
     sorted_instances = {}
     for key in target_instance_keys:
-        matches = [instances[n] for n in range(len(instances)) if ( tuple(key) == tuple(instance_keys[n]) )]
-        sorted_instances[ tuple(key) ] = matches
+        matches = [instances[n] for n in range(len(instances)) if key is not None and key == instance_keys[n]]
+        sorted_instances[ key ] = matches
                 
     # We want to return slices of the sorted_instances, with 1 instance per target 'row'
     #   - determine maximumn # matches; this is # slices to return`
@@ -407,52 +683,55 @@ def group_extinstances( instances, xml_element, context ):
     #   - generate slices
     result = []
     max_matches = max( [len(matches) for matches in sorted_instances.values() ] )
+    if width is not None:
+        max_matches = max( max_matches, width )
 
     for values in sorted_instances.values():
         values += [None]*(max_matches - len(values))
 
     for n in range(max_matches):
-        group = [ sorted_instances[ tuple(key) ][n] for key in target_instance_keys ]
+        group = [ sorted_instances[ key ][n] for key in target_instance_keys ]
         result.append(group)
 
     return result
 
 
-def parse_literal(context, xml_element):
-    value = xml_element.xpath(VALUE_ATTR)[0]
-    value_type = xml_element.xpath(TYPE_ATTR)[0]
-    units = xml_element.xpath(UNIT_ATTR)
-    unit = units[0] if units else None
+def as_key_tuples(keys):
+    """
+    Returns the keys of a PRIMARYKEY or FOREIGNKEY as tuples, one per row. Keys with a null value are None.
+    """
+    nulls = get_null_keys(keys)
+    return [None if nulls is not None and nulls[index] else tuple(key) for index, key in enumerate(numpy.asarray(keys))]
+
+
+def parse_literal(context, value_type, value, unit):
     return context.get_type_by_id(value_type)(value, unit)
 
-def parse_constant(context, xml_element):
+
+def parse_constant(context, value_type, param_ref):
     """
-    Interpret input VODML <CONSTANT> element and associated VOTable <PARAM>
+    Interpret a VODML <CONSTANT> and its associated VOTable <PARAM>
 
     Inputs:
       o context        - Reader
-      o xml_element    - VODML <COLUMN> node
+      o value_type     - dmtype of the CONSTANT
+      o param_ref      - ID of the PARAM referenced by the CONSTANT
 
     Returns
       o value as type mapping to specified vodml-id
          - interpretation done by Reader
     """
     # Find VOTable PARAM element referenced by CONSTANT
-    param_ref = xml_element.xpath(REF_ATTR)[0]
-    find_param_xpath = f"//{PARAM}[{ID_ATTR}='{param_ref}']"
-    param_elements = xml_element.xpath(find_param_xpath)
-    if not param_elements:
+    param_element = context.document.get_param(param_ref)
+    if param_element is None:
         msg = f"Can't find param with ID {param_ref}.  Setting value to NaN"
         LOG.warning(msg)
         warnings.warn(msg, SyntaxWarning)
-        return numpy.NaN
-    param_element = param_elements[0]
+        return numpy.nan
 
-    # Pull desired type, and param data
-    value_type = xml_element.xpath(TYPE_ATTR)[0]
-    value = param_element.xpath(VALUE_ATTR)[0]
-    units = param_element.xpath(UNIT_ATTR)
-    unit = units[0] if units else None
+    # Pull param data
+    value = param_element.get(VALUE)
+    unit = param_element.get(UNIT)
 
     # Create instance of specified type
     #   - resulting type determined by Reader
@@ -469,37 +748,78 @@ def parse_constant(context, xml_element):
     
     return result
 
-def parse_column(context, xml_element):
+def parse_column(context, column_ref):
     """
-    Interpret input VODML <COLUMN> element and associated VOTable <FIELD>
+    Interpret a VODML <COLUMN> and its associated VOTable <FIELD>
 
     Inputs:
       o context     - Reader
-      o xml_element - VODML <COLUMN> node to process
+      o column_ref  - ID of the FIELD referenced by the COLUMN
 
-    Returns column as:
+    Returns a LazyColumn with the FIELD metadata, decoded on first access as:
       o AstroPy Quantity if FIELD has units
       o AstroPy MaskedColumn if FIELD does not have units
     """
     # Find VOTable FIELD element referenced by COLUMN
-    column_ref = xml_element.xpath(REF_ATTR)[0]
-    find_column_xpath = f"//{FIELD}[{ID_ATTR}='{column_ref}']"
-    column_elements = xml_element.xpath(find_column_xpath)
-    if not column_elements:
+    column_element, table_index = context.document.get_field(column_ref)
+    if column_element is None:
         msg = f"Can't find column with ID {column_ref}. Setting values to NaN"
         LOG.warning(msg)
         warnings.warn(msg, SyntaxWarning)
-        return numpy.NaN
-    column_element = column_elements[0]
+        return numpy.nan
+    if table_index is None:
+        raise RuntimeError("COLUMN points to FIELD that does not have a TABLE parent")
+
+    def load():
+        return load_column(context, column_ref, column_element, table_index)
+
+    table_info = context.document.tables[table_index]
+    column = LazyColumn(load,
+                        name=column_element.get(NAME),
+                        unit=column_element.get(UNIT),
+                        dtype=get_column_dtype(context.document.buffer, table_info, column_element),
+                        length=get_table_length(context, table_info))
+    context.document.lazy_columns.add(column)
+    return column
+
 
+def get_table_length(context, table_info):
+    """
+    The number of rows of a TABLE, from the decoded table if any, or from the document without decoding the table
+    """
+    table = context.get_table_by_id(get_table_id(table_info))
+    if table is not None:
+        return len(table)
+    if table_info.nrows is None:
+        table_info.nrows = count_rows(context.document.buffer, table_info)
+    return table_info.nrows
+
+
+def load_column(context, column_ref, column_element, table_index):
+    """
+    Decode the column of a VOTable <FIELD>
+
+    Inputs:
+      o context        - Reader
+      o column_ref     - ID of the FIELD
+      o column_element - VOTable <FIELD> element
+      o table_index    - index of the TABLE containing the FIELD
+
+    Returns column as:
+      o AstroPy Quantity if FIELD has units
+      o AstroPy MaskedColumn if FIELD does not have units
+    """
     # Get Table containing the column
     #  - will either process table or pull from storage in context.
-    table = parse_table(context, column_element)
+    table = parse_table(context, table_index)
     
     # Pull column from table
     #  - check column mapping in case ID is an alias for a different column (see below).
-    column_ref = context.get_column_mapping(column_ref)
-    column = table[column_ref]
+    #    Tables decoded in batches are new tables, where the column still has its ID.
+    #  - columns of mapped tables are only converted and masked when they are first loaded.
+    if context.get_column_mapping(column_ref) in table.colnames:
+        column_ref = context.get_column_mapping(column_ref)
+    column = load_mapped_column(table, column_ref)
 
     # We want the column to contain the FIELD name.. BUT changing it can
     # affect future access to the same column.  For example, if the same
@@ -520,7 +840,7 @@ def parse_column(context, xml_element):
     #   + this has no affect on the table access
     # ======================================================================
     # Get name from FIELD element.. assign to column
-    name = column_element.xpath(NAME_ATTR)[0]
+    name = column_element.get(NAME)
     column.name = name
     try:
         # check if the assignment affected access.
@@ -541,55 +861,503 @@ def parse_column(context, xml_element):
 
     return column
 
-def parse_idref(xml_element, context):
-    ref = InstanceId(xml_element.text, None)
 
-    referred_elements = xml_element.xpath(f"//{INSTANCE}[{ID_ATTR}='{ref.id}']")
+#
+# ----------------------------------------------------------------------
+# Annotation plan
+#
+# The VODML block is compiled once into a tree of build steps. Steps only hold the values they need
+# from the annotation (types, roles, literal values and references to PARAMs, FIELDs and other steps), so building
+# instances does not go back to the XML tree. PARAMs and FIELDs are bound to the document when the steps are
+# executed against a Reader, and a plan can be shared by all the documents with the same VODML block.
+class AnnotationPlan:
+    def __init__(self, instance_steps):
+        self.instance_steps = instance_steps
+
+    def find_instance_steps(self, type_ids):
+        """
+        Returns the steps building the INSTANCEs with the given dmtype, or with any of a set of dmtypes,
+        in document order
+        """
+        if isinstance(type_ids, str):
+            return list(self.instance_steps.get(type_ids, []))
+        groups = [self.instance_steps[type_id] for type_id in type_ids if type_id in self.instance_steps]
+        if len(groups) == 1:
+            return list(groups[0])
+        return list(heapq.merge(*groups, key=attrgetter('position')))
+
+
+class PlanCache:
+    """
+    Least recently used cache of AnnotationPlans, keyed by the hash of the VODML block they were compiled from.
 
-    if not referred_elements:
-        # TODO make a single call?
-        msg = f"Dangling reference {ref}"
-        warnings.warn(msg, SyntaxWarning)
-        LOG.warning(msg)
-        return None
+    A single cache is shared by the whole process, see `PLAN_CACHE`. Setting `maxsize` to 0 disables caching.
+    """
+    def __init__(self, maxsize=PLAN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
 
-    referred_element = referred_elements[0]
-    return SingleReferenceWrapper(read_instance(referred_element, context))
+    def get(self, key):
+        with self._lock:
+            plan = self._plans.get(key, None)
+            if plan is not None:
+                self._plans.move_to_end(key)
+            return plan
 
+    def put(self, key, plan):
+        with self._lock:
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > max(self.maxsize, 0):
+                self._plans.popitem(last=False)
 
-def parse_foreign_key(xml_element, context):
-    ref = InstanceId(None, parse_identifier_field(context, xml_element))
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
 
-    target_id = xml_element.xpath(f"./{TARGETID}")[0].text
-    referred_elements = xml_element.xpath(f"//*[{ID_ATTR}='{target_id}']/{INSTANCE}")
+    def __len__(self):
+        return len(self._plans)
 
-    instances = [read_instance(referred_element, context)
-                 for referred_element in referred_elements]
-    instances_index = {tuple(instance.__vo_id__.keys): instance for instance in instances}
-    references = [instances_index.get(tuple(key), None) for key in ref.keys]
-    return RowReferenceWrapper(references)
+    def __contains__(self, key):
+        return key in self._plans
+
+
+class PlanCompiler:
+    """
+    Compile the VODML annotation of a Votable document into an AnnotationPlan.
+
+    Each INSTANCE element is compiled only once, so that references to the same INSTANCE share their steps.
+    """
+    def __init__(self, votable):
+        self.votable = votable
+        self._instance_steps = {}
+
+    def compile(self):
+        instance_steps = {}
+        for type_id, elements in self.votable.iter_instances_by_type():
+            steps = instance_steps[type_id] = []
+            for element in elements:
+                step = self.compile_instance(element)
+                step.position = self.votable.get_instance_position(element)
+                steps.append(step)
+        return AnnotationPlan(instance_steps)
+
+    def compile_instance(self, xml_element):
+        step = self._instance_steps.get(xml_element, None)
+        if step is not None:
+            return step
+
+        step = InstanceStep(xml_element.get(DMTYPE), xml_element.get(ID), is_template(xml_element))
+        # Register the step before compiling the roles, which may refer back to this INSTANCE.
+        self._instance_steps[xml_element] = step
+        step.primary_key = self.compile_primary_key(xml_element)
+
+        role_compilers = {
+            ATTRIBUTE: self.compile_attribute,
+            COMPOSITION: self.compile_composition,
+            REFERENCE: self.compile_reference,
+        }
+        for child in xml_element.iterchildren(etree.Element):
+            tag = local_name(child.tag)
+            if tag not in ROLE_TAGS:
+                continue
+            key = (tag, child.get(DMROLE))
+            if key in step.roles:
+                step.duplicate_roles.add(key)
+                continue
+            step.roles[key] = role_compilers[tag](child)
+        return step
+
+    def compile_attribute(self, xml_element):
+        values = [self.compile_instance(element) for element in get_children(xml_element, INSTANCE)] +\
+                 [self.compile_literal(element) for element in get_children(xml_element, LITERAL)] +\
+                 [self.compile_constant(element) for element in get_children(xml_element, CONSTANT)] +\
+                 [self.compile_column(element) for element in get_children(xml_element, COLUMN)]
+        return AttributeStep(xml_element.get(DMROLE), values)
+
+    def compile_composition(self, xml_element):
+        values = [self.compile_instance(element) for element in get_children(xml_element, INSTANCE)] +\
+                 [self.compile_extinstances(element) for element in get_children(xml_element, EXTINSTANCES)]
+        return CompositionStep(xml_element.get(DMROLE), values)
+
+    def compile_reference(self, xml_element):
+        # In the votable 1.4 schema there is a choice among IDREF, FOREIGNKEY, and REMOREREFERENCE (currently
+        # unsupported). In invalid cases where multiple elements are given, we give precedence to IDREF.
+        idrefs = [self.compile_idref(element) for element in get_children(xml_element, IDREF)]
+        foreign_keys = [self.compile_foreign_key(element) for element in get_children(xml_element, FOREIGNKEY)]
+        return ReferenceStep(xml_element.get(DMROLE), idrefs, foreign_keys)
+
+    def compile_literal(self, xml_element):
+        return LiteralStep(xml_element.get(DMTYPE), xml_element.get(VALUE), xml_element.get(UNIT))
+
+    def compile_constant(self, xml_element):
+        return ConstantStep(xml_element.get(DMTYPE), xml_element.get(REF))
+
+    def compile_column(self, xml_element):
+        return ColumnStep(xml_element.get(DMTYPE), xml_element.get(REF))
+
+    def compile_idref(self, xml_element):
+        target_element = self.votable.get_instance_by_id(xml_element.text)
+        target = self.compile_instance(target_element) if target_element is not None else None
+        return IdrefStep(xml_element.text, target)
+
+    def compile_foreign_key(self, xml_element):
+        target_id = get_children(xml_element, TARGETID)[0].text
+        target_element = self.votable.get_element_by_id(target_id)
+        referred_elements = get_children(target_element, INSTANCE) if target_element is not None else []
+        targets = [self.compile_instance(element) for element in referred_elements]
+        return ForeignKeyStep(target_id, self.compile_identifier(xml_element), targets)
+
+    def compile_extinstances(self, xml_element):
+        ref = xml_element.text
+        referred_element = self.votable.get_instance_by_id(ref)
+        if referred_element is None:
+            return ExtInstancesStep(ref, None)
+
+        # FOREIGNKEY = constrains returned instance set
+        # NOTE: do not want to compile the target INSTANCE here, we may be compiling it right now.
+        #  Only its PRIMARYKEY is needed to group the instances.
+        grouping = None
+        fk_elements = get_xpath(referred_element).container_foreign_keys(referred_element)
+        if fk_elements:
+            fk_element = fk_elements[-1]
+            target_id = get_children(fk_element, TARGETID)[0].text
+            target_element = self.votable.get_element_by_id(target_id)
+            target_primary_key = self.compile_primary_key(target_element) if target_element is not None else None
+            grouping = GroupingStep(target_id, self.compile_identifier(fk_element), target_primary_key)
+
+        return ExtInstancesStep(ref, self.compile_instance(referred_element), grouping)
+
+    def compile_primary_key(self, xml_element):
+        primary_key_elements = get_children(xml_element, PRIMARYKEY)
+        if primary_key_elements:
+            return self.compile_identifier(primary_key_elements[0])
+        return None
+
+    def compile_identifier(self, xml_element):
+        return IdentifierStep([self.compile_key_field(element) for element in get_children(xml_element, PKFIELD)])
+
+    def compile_key_field(self, xml_element):
+        value_compilers = (
+            (LITERAL, self.compile_literal),
+            (CONSTANT, self.compile_constant),
+            (COLUMN, self.compile_column),
+        )
+        for tag, value_compiler in value_compilers:
+            elements = get_children(xml_element, tag)
+            if elements:
+                return value_compiler(elements[0])
+        return None
+
+
+class InstanceStep:
+    """
+    Build an instance of the class mapped to `type_id`, or return the instance already built for the same ID.
+
+    The class and its fields are resolved the first time the step is executed.
+    """
+    def __init__(self, type_id, instance_id, is_template):
+        self.type_id = type_id
+        self.instance_id = instance_id
+        self.is_template = is_template
+        self.primary_key = None
+        self.roles = {}
+        self.duplicate_roles = set()
+        self.position = None
+        self._binding = None
+
+    def bind(self, context):
+        instance_class = context.get_type_by_id(self.type_id)
+        if self._binding is None or self._binding[0] is not instance_class:
+            fields = [(field_info.name, field_info.field, (FIELD_TAGS[field_info.kind], field_info.vodml_id))
+                      for field_info in instance_class.__vodml_fields__]
+            self._binding = (instance_class, fields)
+        return self._binding
+
+    def execute(self, context):
+        instance_class, fields = self.bind(context)
+        instance_id = self.make_id(context, instance_class)
+        instance = context.get_instance_by_id(instance_id)
+        if instance is not None:
+            return instance
 
-#
-# ----------------------------------------------------------------------
-def make(instance_class, xml_element, context):
-    instance_id = parse_id(context, xml_element, instance_class)
-    instance = context.get_instance_by_id(instance_id)
-    if instance is not None:
-        return instance
-    else:
         instance = instance_class()
-        instance.is_template = is_template(xml_element)
-        instance_info = InstanceInfo(instance, instance_id, instance_class, xml_element, context)
-        instance_info = attach_fields(instance_info)
-        decorated_instance = decorate_with_adapter(instance_info)
+        instance.is_template = self.is_template
+        for field_name, field_object, role_key in fields:
+            if role_key in self.duplicate_roles:
+                warnings.warn(f"Too many elements with dmrole = {role_key[1]}", SyntaxWarning)
+            role_step = self.roles.get(role_key, None)
+            field_instance = role_step.execute(field_object, context) if role_step is not None else None
+            instance.set_field(field_name, field_instance)
+        decorated_instance = decorate_with_adapter(instance, instance_id, instance_class)
         context.add_instance(decorated_instance)
         return decorated_instance
 
+    def make_id(self, context, instance_class):
+        keys = self.primary_key.execute(context) if self.primary_key is not None else None
+        id = self.instance_id
+        if id is None:
+            # Randomly generate an ID for each instance that doesn't have any.
+            id = f"{instance_class.vodml_id}-{str(uuid.uuid4())}"
+        return InstanceId(id, keys)
+
+    def describe(self):
+        description = f"{INSTANCE} {self.type_id}"
+        if self.instance_id is not None:
+            description += f" ID={self.instance_id}"
+        if self.is_template:
+            description += " [template]"
+        return description
+
+    def children(self):
+        steps = list(self.roles.values())
+        if self.primary_key is not None:
+            steps.insert(0, self.primary_key)
+        return steps
+
+
+class AttributeStep:
+    def __init__(self, role, values):
+        self.role = role
+        self.values = values
+
+    def execute(self, field_object, context):
+        values = [value.execute(context) for value in self.values]
+        return field_object.select_return_value(values)
 
-class InstanceInfo:
-    def __init__(self, instance, instance_id, instance_class, xml_element, context):
-        self.context = context
-        self.xml_element = xml_element
-        self.instance_class = instance_class
-        self.instance_id = instance_id
-        self.instance = instance
+    def describe(self):
+        return f"{ATTRIBUTE} {self.role}"
+
+    def children(self):
+        return self.values
+
+
+class CompositionStep(AttributeStep):
+    def execute(self, field_object, context):
+        values = []
+        for value in self.values:
+            if isinstance(value, ExtInstancesStep):
+                values += value.execute(context)
+            else:
+                values.append(value.execute(context))
+        return field_object.select_return_value(values)
+
+    def describe(self):
+        return f"{COMPOSITION} {self.role}"
+
+
+class ReferenceStep:
+    def __init__(self, role, idrefs, foreign_keys):
+        self.role = role
+        self.idrefs = idrefs
+        self.foreign_keys = foreign_keys
+
+    def execute(self, field_object, context):
+        idref_instances = [idref.execute(context) for idref in self.idrefs]
+        if idref_instances:
+            return field_object.select_return_value(idref_instances)
+
+        foreign_key_instances = [foreign_key.execute(context) for foreign_key in self.foreign_keys]
+        if foreign_key_instances:
+            return field_object.select_return_value(foreign_key_instances)
+
+    def describe(self):
+        return f"{REFERENCE} {self.role}"
+
+    def children(self):
+        return self.idrefs + self.foreign_keys
+
+
+class LiteralStep:
+    def __init__(self, value_type, value, unit):
+        self.value_type = value_type
+        self.value = value
+        self.unit = unit
+
+    def execute(self, context):
+        return parse_literal(context, self.value_type, self.value, self.unit)
+
+    def execute_key(self, context):
+        return self.execute(context)
+
+    def describe(self):
+        unit = f" {self.unit}" if self.unit else ""
+        return f"{LITERAL} {self.value_type} = {self.value}{unit}"
+
+    def children(self):
+        return []
+
+
+class ConstantStep:
+    def __init__(self, value_type, param_ref):
+        self.value_type = value_type
+        self.param_ref = param_ref
+
+    def execute(self, context):
+        return parse_constant(context, self.value_type, self.param_ref)
+
+    def execute_key(self, context):
+        return self.execute(context)
+
+    def describe(self):
+        return f"{CONSTANT} {self.value_type} -> PARAM {self.param_ref}"
+
+    def children(self):
+        return []
+
+
+class ColumnStep:
+    def __init__(self, value_type, column_ref):
+        self.value_type = value_type
+        self.column_ref = column_ref
+
+    def execute(self, context):
+        return parse_column(context, self.column_ref)
+
+    def execute_key(self, context):
+        # Keys are needed right away to identify the instances
+        return self.execute(context).load().data
+
+    def describe(self):
+        return f"{COLUMN} {self.value_type} -> FIELD {self.column_ref}"
+
+    def children(self):
+        return []
+
+
+class IdentifierStep:
+    """
+    Compute the keys of a PRIMARYKEY or FOREIGNKEY, one PKFIELD per key component
+    """
+    def __init__(self, fields):
+        self.fields = fields
+
+    def execute(self, context):
+        values = [field.execute_key(context) if field is not None else None for field in self.fields]
+        keys_array = numpy.array(values).T
+        if any(numpy.ma.is_masked(value) for value in values):
+            # Null values stay masked, null keys never match
+            mask = numpy.array([numpy.ma.getmaskarray(value) for value in values]).T
+            keys_array = numpy.ma.array(keys_array, mask=mask)
+        return keys_array
+
+    def describe(self):
+        return f"KEY ({len(self.fields)} {PKFIELD})"
+
+    def children(self):
+        return [field for field in self.fields if field is not None]
+
+
+class IdrefStep:
+    def __init__(self, ref, target):
+        self.ref = ref
+        self.target = target
+
+    def execute(self, context):
+        if self.target is None:
+            # TODO make a single call?
+            msg = f"Dangling reference {InstanceId(self.ref, None)}"
+            warnings.warn(msg, SyntaxWarning)
+            LOG.warning(msg)
+            return None
+
+        return SingleReferenceWrapper(self.target.execute(context))
+
+    def describe(self):
+        return f"{IDREF} {self.ref}" + (" (dangling)" if self.target is None else "")
+
+    def children(self):
+        return [self.target] if self.target is not None else []
+
+
+class ForeignKeyStep:
+    def __init__(self, target_id, keys, targets):
+        self.target_id = target_id
+        self.keys = keys
+        self.targets = targets
+
+    def execute(self, context):
+        ref = InstanceId(None, self.keys.execute(context))
+        instances = [target.execute(context) for target in self.targets]
+        instances_index = {tuple(instance.__vo_id__.keys): instance for instance in instances}
+        references = [instances_index.get(key, None) for key in as_key_tuples(ref.keys)]
+        return RowReferenceWrapper(references)
+
+    def describe(self):
+        return f"{FOREIGNKEY} -> {self.target_id}"
+
+    def children(self):
+        return [self.keys] + self.targets
+
+
+class ExtInstancesStep:
+    def __init__(self, ref, target, grouping=None):
+        self.ref = ref
+        self.target = target
+        self.grouping = grouping
+
+    def execute(self, context):
+        if self.target is None:
+            # TODO make a single call?
+            msg = f"Dangling reference {InstanceId(self.ref, None)}"
+            warnings.warn(msg, SyntaxWarning)
+            LOG.warning(msg)
+            return []
+
+        # process extinstance template
+        #  - we want the individual instances in this case.
+        #    may be getting appended to local instances and needs to be a list of instances
+        instance = self.target.execute(context)
+        instances = instance.unroll()
+
+        if self.grouping is None:
+            # No screening criteria, return List of resolved instances
+            return instances
+        return self.grouping.execute(instances, context)
+
+    def describe(self):
+        return f"{EXTINSTANCES} {self.ref}" + (" (dangling)" if self.target is None else "")
+
+    def children(self):
+        steps = [self.target] if self.target is not None else []
+        if self.grouping is not None:
+            steps.append(self.grouping)
+        return steps
+
+
+class GroupingStep:
+    """
+    Group the instances of an EXTINSTANCES by the rows of the target of their CONTAINER FOREIGNKEY
+    """
+    def __init__(self, target_id, keys, target_primary_key):
+        self.target_id = target_id
+        self.keys = keys
+        self.target_primary_key = target_primary_key
+
+    def execute(self, instances, context):
+        # Get keys associated with each instance
+        instance_keys = self.keys.execute(context)
+
+        # Get target keys
+        target = context.get_instance_by_id(InstanceId(self.target_id, None))
+        if target is not None:
+            # Untested
+            target_instance_keys = target.__vo_id__.keys
+        elif self.target_primary_key is not None:
+            # Target instance not already processed, resolve the PRIMARYKEY value set from the target element
+            target_instance_keys = self.target_primary_key.execute(context)
+        else:
+            target_instance_keys = None
+
+        return group_extinstances(instances, instance_keys, target_instance_keys,
+                                  context.document.group_widths.get(self))
+
+    def describe(self):
+        return f"{CONTAINER} {FOREIGNKEY} -> {self.target_id}"
+
+    def children(self):
+        return [self.keys]
+
+
+PLAN_CACHE = PlanCache()
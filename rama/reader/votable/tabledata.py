@@ -0,0 +1,351 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Vectorized decoding of VOTable TABLEDATA.
+
+The astropy parser converts each <TD> on its own. For the common datatypes, this decoder only collects the text of
+the cells of the requested columns, and converts each column in bulk with numpy. Tables with other datatypes or with
+array values are left to astropy.
+
+The cells are read straight from the bytes of the DATA section when its markup is regular, which is much faster than
+building an element for each <TD>. Otherwise, e.g. when the rows hold comments, the section is parsed with
+lxml.etree.iterparse, one row at a time.
+
+Large sections with regular markup can also be split into ranges of rows, decoded by a pool of processes.
+"""
+import html
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from astropy.table import MaskedColumn, QTable, Table
+from lxml import etree
+
+from rama.reader.buffer import InputBuffer
+from rama.reader.votable.decoder import get_serialization, open_table_document, qualified_tag
+from rama.reader.votable.fields import get_column_name, get_field_dtype, get_fields, get_null_value
+
+LOG = logging.getLogger(__name__)
+
+# Whether a byte can follow the name of a tag
+TAG_ENDS = numpy.zeros(256, dtype=bool)
+TAG_ENDS[numpy.frombuffer(b" \t\r\n/>", dtype="u1")] = True
+
+# Minimum size in bytes of a DATA section decoded by several processes
+PARALLEL_MIN_SIZE = 1 << 24
+
+# Maximum size of the fixed width array holding the cells of a column, relative to the size of their text. Columns
+# with a few cells much longer than the others are gathered in groups of cells of similar lengths instead.
+GATHER_MAX_PADDING = 4
+
+# numpy kinds of the decoded values converted in bulk: integers, floats and strings
+TABLEDATA_KINDS = "iufU"
+
+
+def decode_tabledata(buffer, table_info, field_ids=None, workers=None):
+    """
+    Decode the TABLEDATA <DATA> section of a TABLE
+
+    Inputs:
+      o buffer      - InputBuffer of the document
+      o table_info  - TableInfo of the TABLE, from the annotation loader
+      o field_ids   - IDs of the FIELDs to decode, all of them if None
+      o workers     - number of processes decoding sections of at least PARALLEL_MIN_SIZE bytes, None for one
+
+    Returns an AstroPy QTable with the same columns as the astropy parser, or None if the table is left to astropy:
+      o the data is not serialized as TABLEDATA, or its DATA section was not located
+      o a decoded FIELD has a datatype other than numbers and strings, or array values
+      o a value can't be converted in bulk, e.g. hexadecimal integers, or a row is missing cells
+    """
+    table_element = table_info.element
+    serialization = get_serialization(table_element)
+    section = table_info.data_section
+    if table_element.get("ref") is not None or serialization is None or serialization[0] != "TABLEDATA" \
+            or section is None:
+        return None
+
+    fields = get_fields(table_element)
+    selected = [(index, field) for index, field in enumerate(fields)
+                if not field_ids or field.get("ID") in field_ids]
+    if any(get_column_dtype(field) is None for _, field in selected):
+        return None
+
+    column_indexes = [index for index, _ in selected]
+    layouts = [(get_column_dtype(field), get_null_value(field)) for _, field in selected]
+    encoding = table_element.getroottree().docinfo.encoding or "UTF-8"
+
+    values = None
+    if workers is not None and workers > 1 and section.end - section.start >= PARALLEL_MIN_SIZE:
+        values = decode_parallel(buffer, section, table_element.prefix, len(fields), column_indexes, layouts,
+                                 encoding, workers)
+    if values is None:
+        data = buffer.view[section.start:section.end]
+        cells = scan_cells(data, table_element.prefix, len(fields), column_indexes)
+        if cells is None:
+            cells = read_cells(open_table_document(table_element, data), column_indexes)
+        if cells is None:
+            return None
+        values = convert_columns(cells, layouts, encoding)
+    if values is None:
+        return None
+
+    columns = [MaskedColumn(column_values, name=get_column_name(field), unit=field.get("unit"), mask=mask)
+               for (_, field), (column_values, mask) in zip(selected, values)]
+    return QTable(Table(columns, copy=False), copy=False)
+
+
+def decode_parallel(buffer, section, prefix, field_count, column_indexes, layouts, encoding, workers):
+    """
+    Decode a TABLEDATA <DATA> section with a pool of processes, each one decoding a range of rows
+
+    The section is split in ranges of about the same size, each range starting at the first <TR> found after its
+    offset, so that only the bytes between the offsets and the next rows are read before the workers start.
+
+    Returns a (values, mask) pair per column, or None if a range of rows can't be decoded in bulk
+    """
+    data = buffer.view[section.start:section.end]
+    row_start = re.compile(rb"<" + re.escape(qualified_tag(prefix, "TR").encode()) + rb"[\s/>]")
+    starts = []
+    for index in range(workers):
+        match = row_start.search(data, max(len(data) * index // workers, starts[-1] + 1 if starts else 0))
+        if match is None:
+            break
+        starts.append(match.start())
+    if len(starts) < 2:
+        return None
+
+    # Ranges start at a <TR>, the last one ends with the section
+    ends = starts[1:] + [len(data)]
+    # Memory mapped files are mapped again by the workers, other buffers are sent by range
+    tasks = [(buffer.name if buffer.is_mapped else bytes(data[start:end]), section.start + start, section.start + end,
+              prefix, field_count, column_indexes, layouts, encoding)
+             for start, end in zip(starts, ends)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = list(executor.map(_decode_rows, *zip(*tasks)))
+    if any(chunk is None for chunk in chunks):
+        return None
+
+    return [(numpy.concatenate([chunk[index][0] for chunk in chunks]),
+             numpy.concatenate([chunk[index][1] for chunk in chunks]))
+            for index in range(len(column_indexes))]
+
+
+def _decode_rows(source, start, end, prefix, field_count, column_indexes, layouts, encoding):
+    # Runs in a worker process: source is either the bytes of the rows, or the name of the mapped document
+    data = InputBuffer(source).view[start:end] if isinstance(source, str) else source
+    cells = scan_cells(data, prefix, field_count, column_indexes)
+    if cells is None:
+        return None
+    return convert_columns(cells, layouts, encoding)
+
+
+def get_column_dtype(field_element):
+    """
+    Returns the numpy dtype of the column of a FIELD, or None if it is not decoded in bulk
+    """
+    dtype = get_field_dtype(field_element)
+    arraysize = field_element.get("arraysize")
+    if dtype is None or dtype.kind not in TABLEDATA_KINDS or (arraysize and dtype.kind != "U"):
+        return None
+    if dtype.kind != "U":
+        return dtype
+    if not arraysize:
+        return numpy.dtype("U1")
+    if "x" in arraysize:
+        return None
+    if arraysize.endswith("*"):
+        # Variable length strings are kept as python strings, as astropy does
+        return numpy.dtype(object)
+    return numpy.dtype(f"U{int(arraysize)}")
+
+
+def scan_cells(data, prefix, field_count, column_indexes):
+    """
+    Collect the text of the cells of the given columns from the bytes of a TABLEDATA <DATA> section
+
+    The positions of the tags are found with numpy, and the text of the cells is gathered in bulk.
+
+    Returns the cell bytes of each column as (indexes, cells) groups, see `gather`, in the encoding of the document,
+    or None if the section has to be parsed as XML: comments or CDATA sections, <TD> attributes, markup in the cells,
+    or rows with a different number of cells than FIELDs.
+    """
+    td = qualified_tag(prefix, "TD").encode()
+    tr = qualified_tag(prefix, "TR").encode()
+    array = numpy.frombuffer(data, dtype="u1")
+    markup = numpy.flatnonzero(array == ord("<"))
+    if (array[numpy.minimum(markup + 1, len(array) - 1)] == ord("!")).any():
+        return None
+    cells = numpy.flatnonzero(match_tag(array, markup + 1, td))
+    rows = markup[match_tag(array, markup + 1, tr)]
+    if len(cells) != len(rows) * field_count or (len(cells) and markup[cells[0]] < rows[0]):
+        return None
+    row_cells = numpy.bincount(numpy.searchsorted(rows, markup[cells], side="right") - 1, minlength=len(rows))
+    if (row_cells != field_count).any():
+        return None
+
+    columns = []
+    for index in column_indexes:
+        column_cells = cells[index::field_count]
+        tag_end = markup[column_cells] + 1 + len(td)
+        end = markup[numpy.minimum(column_cells + 1, len(markup) - 1)]
+        # Cells are either <TD>text</TD> or <TD/>
+        empty = (array[tag_end] == ord("/")) & (array[numpy.minimum(tag_end + 1, len(array) - 1)] == ord(">"))
+        closed = (array[tag_end] == ord(">")) & (array[numpy.minimum(end + 1, len(array) - 1)] == ord("/")) \
+            & match_tag(array, end + 2, td)
+        if not (empty | closed).all():
+            return None
+        start = numpy.where(empty, end, tag_end + 1)
+        columns.append(gather(array, start, end))
+    return columns
+
+
+def match_tag(array, positions, name):
+    """
+    Returns whether the bytes of the array at the given positions are the name of a tag, e.g. b"TD"
+    """
+    matches = numpy.ones(len(positions), dtype=bool)
+    for offset, byte in enumerate(name + b" "):
+        values = array[numpy.minimum(positions + offset, len(array) - 1)]
+        # The name must not be the prefix of a longer name, e.g. TDX
+        matches &= TAG_ENDS[values] if offset == len(name) else values == byte
+    return matches
+
+
+def gather(array, start, end):
+    """
+    Returns the [start, end) ranges of an array of bytes as arrays of bytes strings, in a list of (indexes, strings)
+    groups.
+
+    The strings of an array are padded to the longest one. Usually all the ranges are gathered in a single group,
+    whose indexes are None. If that would take more than GATHER_MAX_PADDING times the size of the ranges, the ranges
+    are grouped by powers of two of their length, and the indexes are the positions of the ranges of each group.
+    """
+    lengths = end - start
+    width = int(lengths.max(initial=0))
+    if width * len(lengths) <= GATHER_MAX_PADDING * (int(lengths.sum()) + len(lengths)):
+        return [(None, gather_strings(array, start, lengths, width))]
+
+    groups = numpy.ceil(numpy.log2(numpy.maximum(lengths, 1))).astype(int)
+    strings = []
+    for group in numpy.unique(groups):
+        indexes = numpy.flatnonzero(groups == group)
+        group_lengths = lengths[indexes]
+        strings.append((indexes, gather_strings(array, start[indexes], group_lengths, int(group_lengths.max()))))
+    return strings
+
+
+def gather_strings(array, start, lengths, width):
+    if width == 0:
+        return numpy.zeros(len(start), dtype="S1")
+    offsets = numpy.arange(width)
+    chars = array[numpy.minimum(start[:, None] + offsets, len(array) - 1)]
+    chars[offsets >= lengths[:, None]] = 0
+    return chars.view(f"S{width}").ravel()
+
+
+def read_cells(document, column_indexes):
+    """
+    Collect the text of the cells of the given columns, for all the rows of a TABLEDATA document
+
+    Returns the cell texts of each column as a single (None, texts) group, or None if a row has fewer cells than
+    needed
+    """
+    cells = [[] for _ in column_indexes]
+    for _, row in etree.iterparse(document, tag="{*}TR", remove_comments=True, huge_tree=True):
+        texts = [cell.text for cell in row]
+        try:
+            for column_cells, index in zip(cells, column_indexes):
+                column_cells.append(texts[index])
+        except IndexError:
+            return None
+        # Rows that have been read are dropped from the tree
+        row.clear()
+        while row.getprevious() is not None:
+            del row.getparent()[0]
+    return [[(None, numpy.array([text or "" for text in column_cells], dtype=str))] for column_cells in cells]
+
+
+def convert_columns(cells, layouts, encoding):
+    """
+    Convert the cell texts of each column with its (dtype, null value) layout, see `convert_values`.
+    Returns a (values, mask) pair per column, or None if a column can't be converted in bulk.
+    """
+    values = [convert_groups(groups, dtype, null_value, encoding)
+              for groups, (dtype, null_value) in zip(cells, layouts)]
+    return None if any(column_values is None for column_values in values) else values
+
+
+def convert_groups(groups, dtype, null_value, encoding):
+    """
+    Convert the (indexes, texts) groups of cells of a column, see `gather`, into a single (values, mask) pair in row
+    order. Returns None if a group can't be converted in bulk.
+    """
+    if len(groups) == 1 and groups[0][0] is None:
+        return convert_values(groups[0][1], dtype, null_value, encoding)
+
+    length = sum(len(indexes) for indexes, _ in groups)
+    values = numpy.empty(length, dtype=dtype)
+    mask = numpy.empty(length, dtype=bool)
+    for indexes, texts in groups:
+        converted = convert_values(texts, dtype, null_value, encoding)
+        if converted is None:
+            return None
+        values[indexes], mask[indexes] = converted
+    return values, mask
+
+
+def convert_values(texts, dtype, null_value, encoding):
+    """
+    Convert the cell texts of a column to a numpy array, masking empty cells, NaNs and null values like astropy.
+    The texts are either str, or bytes in the given encoding with XML entities still escaped.
+    Returns a (values, mask) pair, or None if the texts can't be converted in bulk.
+    """
+    strings = numpy.char.strip(texts)
+
+    if dtype.kind in "UO":
+        if strings.dtype.kind == "S":
+            strings = decode_strings(strings, encoding)
+        return strings.astype(dtype), numpy.zeros(len(strings), dtype=bool)
+
+    empty = b"" if strings.dtype.kind == "S" else ""
+    mask = strings == empty
+    fill_value = null_value if null_value is not None and dtype.kind in "iu" else "0"
+    try:
+        values = numpy.where(mask, numpy.array(fill_value).astype(strings.dtype.kind), strings).astype(dtype)
+        if null_value is not None:
+            mask |= values == numpy.array(null_value).astype(dtype)
+    except (ValueError, OverflowError):
+        LOG.debug(f"Can't convert values of type {dtype} in bulk")
+        return None
+    if dtype.kind == "f":
+        mask |= numpy.isnan(values)
+    return values, mask
+
+
+def decode_strings(cells, encoding):
+    strings = numpy.char.decode(cells, encoding)
+    escaped = numpy.char.find(strings, "&") >= 0
+    if escaped.any():
+        strings = strings.astype(object)
+        strings[escaped] = [html.unescape(string) for string in strings[escaped]]
+    return strings
@@ -0,0 +1,128 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from io import BytesIO, StringIO
+
+import numpy
+import pytest
+from astropy.io.votable import from_table
+from astropy.table import Table, vstack
+
+from rama.reader.buffer import InputBuffer, ViewStream
+from rama.reader.votable.decoder import decode_table, iter_table_batches
+from rama.reader.votable.loader import AnnotationLoader
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<vot:VOTABLE xmlns:vot="http://www.ivoa.net/xml/VOTable/v1.3" version="1.3">
+  <vot:RESOURCE>
+    <vot:TABLE ID="first">
+      <vot:FIELD ID="_a" name="a" datatype="int"/>
+      <vot:DATA><vot:TABLEDATA><vot:TR><vot:TD>1</vot:TD></vot:TR></vot:TABLEDATA></vot:DATA>
+    </vot:TABLE>
+    <vot:TABLE ID="second">
+      <vot:FIELD ID="_b" name="b" datatype="int"/>
+      <vot:FIELD ID="_c" name="c" datatype="char" arraysize="*"/>
+      <vot:FIELD ID="_d" name="d" datatype="double"/>
+      <vot:DATA><vot:TABLEDATA>
+        <vot:TR><vot:TD>2</vot:TD><vot:TD>x</vot:TD><vot:TD>2.5</vot:TD></vot:TR>
+        <vot:TR><vot:TD>3</vot:TD><vot:TD>y</vot:TD><vot:TD>3.5</vot:TD></vot:TR>
+      </vot:TABLEDATA></vot:DATA>
+    </vot:TABLE>
+  </vot:RESOURCE>
+</vot:VOTABLE>'''
+
+
+def load(buffer):
+    loader = AnnotationLoader()
+    loader.load(buffer.open())
+    return loader.tables
+
+
+@pytest.mark.parametrize("field_ids, names", [(["_b", "_d"], ["_b", "_d"]), (None, ["_b", "_c", "_d"])])
+def test_decode_table(field_ids, names):
+    buffer = InputBuffer(BytesIO(DOCUMENT.encode("utf-8")))
+    table = decode_table(buffer, load(buffer)[1], field_ids).to_table()
+
+    assert table.colnames == names
+    numpy.testing.assert_array_equal(table["_b"], [2, 3])
+    numpy.testing.assert_array_equal(table["_d"], [2.5, 3.5])
+
+
+def test_decode_table_text_source():
+    buffer = InputBuffer(StringIO(DOCUMENT))
+    table = decode_table(buffer, load(buffer)[1], ["_b"]).to_table()
+
+    numpy.testing.assert_array_equal(table["_b"], [2, 3])
+
+
+def test_input_buffer_file(tmp_path):
+    path = tmp_path / "document.xml"
+    path.write_bytes(DOCUMENT.encode("utf-8"))
+    buffer = InputBuffer(str(path))
+
+    assert buffer.view.obj is buffer._mmap
+    assert len(buffer) == len(DOCUMENT)
+    assert decode_table(buffer, load(buffer)[0], ["_a"]).to_table()["_a"][0] == 1
+    buffer.close()
+
+
+def test_input_buffer_not_copied():
+    source = BytesIO(b"<?xml version='1.0'?><VOTABLE/>")
+    source.seek(5)
+    buffer = InputBuffer(source)
+
+    assert bytes(buffer.view) == b" version='1.0'?><VOTABLE/>"
+    # The view shares the memory of the stream
+    source.getbuffer()[6] = ord("V")
+    assert bytes(buffer.view[:8]) == b" Version"
+    buffer.close()
+
+
+def test_view_stream():
+    stream = ViewStream([b"abc", memoryview(b"defg")[1:], b"h"])
+
+    assert stream.read() == b"abcefgh"
+    stream.seek(2)
+    assert stream.read(3) == b"cef"
+    stream.seek(-2, 2)
+    assert stream.read(5) == b"gh"
+    assert stream.read() == b""
+
+
+@pytest.mark.parametrize("tabledata_format", ["tabledata", "binary", "binary2"])
+@pytest.mark.parametrize("batch_size", [1, 2, 5, 10])
+def test_iter_table_batches(tabledata_format, batch_size):
+    names = numpy.array(["a", "bb", "", "dddd", "e"], dtype=object)
+    values = numpy.ma.array([1.5, 2.5, 3.5, 4.5, 5.5], mask=[False, True, False, False, False])
+    flags = numpy.array([[1, 2], [3, 4], [5, 6], [7, 8], [9, 10]], dtype="int16")
+    table = Table([names, values, flags], names=["name", "value", "flags"])
+    output = BytesIO()
+    from_table(table).to_xml(output, tabledata_format=tabledata_format)
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+
+    batches = [batch.to_table() for batch in iter_table_batches(buffer, load(buffer)[0], batch_size)]
+
+    assert [len(batch) for batch in batches] == [min(batch_size, 5 - start) for start in range(0, 5, batch_size)]
+    decoded = vstack(batches)
+    numpy.testing.assert_array_equal(decoded["name"], names)
+    numpy.testing.assert_array_equal(decoded["value"].mask, values.mask)
+    numpy.testing.assert_array_equal(decoded["value"].filled(0), values.filled(0))
+    numpy.testing.assert_array_equal(decoded["flags"], flags)
@@ -0,0 +1,129 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------
+#  Test code for the streaming annotation loader
+# ----------------------------------------------------------------------
+import io
+
+import pytest
+
+from rama.reader.votable.loader import AnnotationLoader, _DataSectionScanner
+
+DOCUMENT = b'''<?xml version="1.0" encoding="UTF-8"?>
+<VOTABLE xmlns="http://www.ivoa.net/xml/VOTable/v1.4">
+  <!-- A comment mentioning <DATA> should not confuse the loader -->
+  <VODML>
+    <GLOBALS>
+      <INSTANCE ID="_x" dmtype="foo:Bar"/>
+    </GLOBALS>
+  </VODML>
+  <RESOURCE>
+    <TABLE ID="_t1">
+      <FIELD ID="_a" name="a" datatype="int"/>
+      <DATA>
+        <TABLEDATA>
+          <TR><TD>1</TD></TR>
+          <TR><TD>2</TD></TR>
+          <TR><TD>3</TD></TR>
+        </TABLEDATA>
+      </DATA>
+    </TABLE>
+    <TABLE ID="_t2">
+      <PARAM ID="_p" name="p" datatype="int" value="4"/>
+    </TABLE>
+    <TABLE ID="_t3">
+      <FIELD ID="_b" name="b" datatype="int"/>
+      <DATA><BINARY2><STREAM encoding="base64">AAAAAQ==</STREAM></BINARY2></DATA>
+    </TABLE>
+  </RESOURCE>
+</VOTABLE>
+'''
+
+
+def load(chunk_size):
+    loader = AnnotationLoader()
+    root = loader.load(io.BytesIO(DOCUMENT), chunk_size=chunk_size)
+    return loader, root
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_rows_are_dropped(chunk_size):
+    loader, root = load(chunk_size)
+
+    assert not root.xpath("//*[local-name() = 'TR' or local-name() = 'TD']")
+    assert root.xpath("//*[local-name() = 'INSTANCE']/@ID") == ['_x']
+    assert root.xpath("//*[local-name() = 'FIELD']/@ID") == ['_a', '_b']
+    assert root.xpath("//*[local-name() = 'PARAM']/@value") == ['4']
+
+    stream = root.xpath("//*[local-name() = 'STREAM']")[0]
+    assert stream.text is None
+    assert stream.get('encoding') == 'base64'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_tables_skeleton(chunk_size):
+    loader, _ = load(chunk_size)
+
+    assert [table.element.get('ID') for table in loader.tables] == ['_t1', '_t2', '_t3']
+    assert [table.index for table in loader.tables] == [0, 1, 2]
+    assert [table.nrows for table in loader.tables] == [3, None, None]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_data_sections(chunk_size):
+    loader, _ = load(chunk_size)
+    first, second, third = loader.tables
+
+    assert second.data_section is None
+
+    data = DOCUMENT[first.data_section.start:first.data_section.end]
+    assert data.startswith(b'<DATA>')
+    assert data.endswith(b'</DATA>')
+    assert data.count(b'<TR>') == 3
+
+    data = DOCUMENT[third.data_section.start:third.data_section.end]
+    assert data == b'<DATA><BINARY2><STREAM encoding="base64">AAAAAQ==</STREAM></BINARY2></DATA>'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_stream_content_not_parsed(chunk_size):
+    scanner = _DataSectionScanner()
+    chunks = [DOCUMENT[i:i + chunk_size] for i in range(0, len(DOCUMENT), chunk_size)]
+    parsed = b"".join(scanner.feed(chunk) for chunk in chunks) + scanner.close()
+
+    assert parsed == DOCUMENT.replace(b'AAAAAQ==', b'')
+    assert len(scanner.sections) == 2
+
+
+def test_text_stream():
+    loader = AnnotationLoader()
+    root = loader.load(io.StringIO(DOCUMENT.decode('utf-8').split('\n', 1)[1]))
+
+    assert loader.tables[0].nrows == 3
+    assert root.xpath("//*[local-name() = 'INSTANCE']/@ID") == ['_x']
+
+
+def test_missing_file():
+    with pytest.raises(OSError) as exc:
+        AnnotationLoader().load('does-not-exist.vot.xml')
+
+    assert "Error reading file" in str(exc.value)
@@ -0,0 +1,205 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import mmap
+from io import BytesIO
+
+import numpy
+import pytest
+from astropy.io import fits
+from astropy.io.votable import from_table, parse_single_table
+from astropy.table import MaskedColumn, Table
+from astropy.units import Quantity
+
+from rama.reader.buffer import InputBuffer
+from rama.reader.votable.fields import get_fields
+from rama.reader.votable.loader import AnnotationLoader
+from rama.reader.votable.mapped import NULL_MASKS, count_rows, get_column_dtype, load_mapped_column, map_table
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<VOTABLE xmlns="http://www.ivoa.net/xml/VOTable/v1.3" version="1.3">
+  <RESOURCE>
+    <TABLE ID="mapped">
+      <FIELD ID="_id" name="id" datatype="int"><VALUES null="-1"/></FIELD>
+      <FIELD ID="_flux" name="flux" datatype="double" unit="mJy"/>
+      <FIELD ID="_name" name="name" datatype="char" arraysize="4"/>
+      <DATA>{data}</DATA>
+    </TABLE>
+  </RESOURCE>
+</VOTABLE>'''
+
+
+def load(buffer):
+    loader = AnnotationLoader()
+    loader.load(buffer.open())
+    return loader.tables
+
+
+def iter_bases(array):
+    while array is not None:
+        yield array
+        array = getattr(array, "base", None)
+
+
+def make_table(null_ids=True):
+    # BINARY has no null value for integers without a VALUES element
+    ids = MaskedColumn([1, 2, 3], mask=[False, null_ids, False], dtype="int32")
+    flux = MaskedColumn([1.5, 2.5, 3.5], mask=[False, False, True], unit="mJy")
+    flags = numpy.array([[1, 2], [3, 4], [5, 6]], dtype="int16")
+    return Table([ids, flux, flags], names=["id", "flux", "flags"])
+
+
+@pytest.mark.parametrize("tabledata_format", ["binary", "binary2"])
+def test_map_table(tabledata_format):
+    output = BytesIO()
+    from_table(make_table(tabledata_format == "binary2")).to_xml(output, tabledata_format=tabledata_format)
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+
+    table = map_table(buffer, load(buffer)[0])
+
+    assert table.colnames == ["id", "flux", "flags"]
+    assert isinstance(table["flux"], Quantity)
+    assert set(table.meta[NULL_MASKS]) == {"id", "flux", "flags"} if tabledata_format == "binary2" else {"flux"}
+    numpy.testing.assert_array_equal(table["flags"], [[1, 2], [3, 4], [5, 6]])
+
+    flux = load_mapped_column(table, "flux")
+    numpy.testing.assert_array_equal(flux.mask, [False, False, True])
+    numpy.testing.assert_array_equal(flux.unmasked.value[:2], [1.5, 2.5])
+    assert "flux" not in table.meta[NULL_MASKS]
+    assert load_mapped_column(table, "flux") is table["flux"]
+    if tabledata_format == "binary2":
+        numpy.testing.assert_array_equal(load_mapped_column(table, "id").mask, [False, True, False])
+
+
+@pytest.mark.parametrize("tabledata_format", ["binary", "binary2"])
+def test_stream_byte_order(tabledata_format):
+    output = BytesIO()
+    from_table(make_table(tabledata_format == "binary2")).to_xml(output, tabledata_format=tabledata_format)
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+    expected = parse_single_table(BytesIO(output.getvalue())).to_table()
+    table_info = load(buffer)[0]
+
+    table = map_table(buffer, table_info)
+
+    # Numeric columns stay big endian views over the stream, even once masked
+    for field, name in zip(get_fields(table_info.element), table.colnames):
+        values = table[name]
+        column = load_mapped_column(table, name)
+        assert column.dtype == get_column_dtype(buffer, table_info, field)
+        if column.dtype.kind in "iuf":
+            assert column.dtype == expected[name].dtype.newbyteorder(">")
+            assert numpy.shares_memory(numpy.asarray(getattr(column, "unmasked", column)), numpy.asarray(values))
+        numpy.testing.assert_array_equal(column, expected[name])
+
+
+@pytest.mark.parametrize("tabledata_format", ["binary", "binary2"])
+@pytest.mark.parametrize("nrows", [1, 2, 3])
+def test_count_rows(tabledata_format, nrows):
+    output = BytesIO()
+    from_table(make_table(tabledata_format == "binary2")[:nrows]).to_xml(output, tabledata_format=tabledata_format)
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+
+    assert count_rows(buffer, load(buffer)[0]) == nrows
+
+
+@pytest.mark.parametrize("tabledata_format", ["binary", "binary2"])
+def test_count_rows_variable_length(tabledata_format):
+    output = BytesIO()
+    names = numpy.array(["a", "bcd", "efghij"], dtype=object)
+    table = Table([names, [1.5, 2.5, 3.5]], names=["name", "flux"])
+    from_table(table).to_xml(output, tabledata_format=tabledata_format)
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+    table_info = load(buffer)[0]
+
+    assert table_info.element.find("{*}FIELD").get("arraysize") == "*"
+    assert count_rows(buffer, table_info) == 3
+
+
+def test_count_rows_attribute():
+    document = DOCUMENT.format(data='<BINARY><STREAM href="http://example.com/rows.bin"/></BINARY>')
+    buffer = InputBuffer(BytesIO(document.replace('ID="mapped"', 'ID="mapped" nrows="42"').encode()))
+
+    assert count_rows(buffer, load(buffer)[0]) == 42
+
+
+def test_map_table_selected_fields():
+    output = BytesIO()
+    from_table(make_table()).to_xml(output, tabledata_format="binary2")
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+
+    table = map_table(buffer, load(buffer)[0], ["flags"])
+
+    assert table.colnames == ["flags"]
+    # Numeric columns are views over the decoded stream
+    assert not table["flags"].flags.owndata
+
+
+def test_map_table_tabledata():
+    output = BytesIO()
+    from_table(make_table()).to_xml(output, tabledata_format="tabledata")
+    buffer = InputBuffer(BytesIO(output.getvalue()))
+
+    assert map_table(buffer, load(buffer)[0]) is None
+
+
+def test_map_table_stream_file(tmp_path):
+    rows = numpy.array([(1, 1.5, b"ab"), (-1, numpy.nan, b"cdef")], dtype=[("id", ">i4"), ("flux", ">f8"),
+                                                                            ("name", "S4")])
+    (tmp_path / "rows.bin").write_bytes(rows.tobytes())
+    document = tmp_path / "document.xml"
+    document.write_text(DOCUMENT.format(data='<BINARY><STREAM href="rows.bin"/></BINARY>'))
+    buffer = InputBuffer(str(document))
+
+    assert count_rows(buffer, load(buffer)[0]) == 2
+
+    table = map_table(buffer, load(buffer)[0], ["_id", "_flux", "_name"])
+
+    assert any(isinstance(base, mmap.mmap) for base in iter_bases(table["_id"]))
+    assert list(table["_name"]) == ["ab", "cdef"]
+    numpy.testing.assert_array_equal(load_mapped_column(table, "_id").mask, [False, True])
+    numpy.testing.assert_array_equal(load_mapped_column(table, "_flux").mask, [False, True])
+    assert load_mapped_column(table, "_flux").unit == "mJy"
+
+
+def test_map_table_fits(tmp_path):
+    columns = [fits.Column(name="id", format="J", null=-1, array=numpy.array([1, -1, 3])),
+               fits.Column(name="flux", format="D", array=numpy.array([1.5, 2.5, 3.5])),
+               fits.Column(name="name", format="4A", array=numpy.array(["a", "b", "c"]))]
+    fits.BinTableHDU.from_columns(columns).writeto(tmp_path / "table.fits")
+    document = tmp_path / "document.xml"
+    document.write_text(DOCUMENT.format(data='<FITS extnum="1"><STREAM href="table.fits"/></FITS>'))
+    buffer = InputBuffer(str(document))
+
+    assert count_rows(buffer, load(buffer)[0]) == 3
+
+    table = map_table(buffer, load(buffer)[0], ["_id", "_flux"])
+
+    assert table.colnames == ["_id", "_flux"]
+    numpy.testing.assert_array_equal(table["_flux"].value, [1.5, 2.5, 3.5])
+    numpy.testing.assert_array_equal(load_mapped_column(table, "_id").mask, [False, True, False])
+
+
+def test_map_table_remote_stream():
+    document = DOCUMENT.format(data='<BINARY><STREAM href="http://example.com/rows.bin"/></BINARY>')
+    buffer = InputBuffer(BytesIO(document.encode()))
+
+    assert map_table(buffer, load(buffer)[0]) is None
+    assert count_rows(buffer, load(buffer)[0]) is None
@@ -22,12 +22,17 @@
 # ----------------------------------------------------------------------
 #  Test code for the parsing/interpretation of vo-dml annotation 
 # ----------------------------------------------------------------------
+from io import StringIO
+
 import numpy
 import pytest
 from astropy import units as u
 from astropy.table import MaskedColumn
 
-from rama import read, is_template, unroll
+from rama import read, is_template, unroll, count
+from rama.framework import Attribute, BaseType, Composition, LazyColumn
+from rama.reader import KeyIndex
+from rama.reader.votable.parser import group_extinstances
 from rama.models.test.sample import Source, SkyCoordinate, SkyCoordinateFrame, LuminosityMeasurement, MultiObj
 
 from rama.models.photdmalt import PhotometryFilter
@@ -187,6 +192,136 @@ def test_parsing_columns( columns_file ):
     numpy.testing.assert_array_equal( elem.b[0], MaskedColumn([[200.0, 201.0],[200.1,201.1]], dtype='float32'))
 
     
+def test_columns_decoded_on_access( columns_file ):
+    """
+    Test that COLUMN-backed attributes are only decoded when they are accessed
+    """
+    luminosity = columns_file.find_instances( LuminosityMeasurement  )[0]
+
+    # Cardinality comes from the table metadata
+    assert count(luminosity) == 2
+    assert columns_file.tables == {}
+
+    column = LuminosityMeasurement.value.values[luminosity]
+    assert isinstance(column, LazyColumn)
+    assert column.name == "luminosity"
+    assert column.unit == "mag"
+    assert column.dtype == numpy.dtype("float32")
+    assert len(column) == 2
+    assert not column.is_loaded
+
+    numpy.testing.assert_array_equal(luminosity.value, numpy.array([15.718, 14.847], dtype='float32') * u.Unit('mag'))
+    assert column.is_loaded
+    assert "_table1" in columns_file.tables
+
+    # The attribute now holds the decoded column
+    assert LuminosityMeasurement.value.values[luminosity] is luminosity.value
+
+
+@pytest.mark.parametrize("tabledata_format", ["binary", "binary2"])
+def test_binary_columns_decoded_on_access(make_data_path, make_binary_copy, tabledata_format):
+    """
+    Test that the length of binary COLUMNs is known without decoding the table
+    """
+    columns_file = read(make_binary_copy(make_data_path('columns.vot.xml'), tabledata_format, "_table1"))
+
+    luminosity = columns_file.find_instances( LuminosityMeasurement  )[0]
+
+    column = LuminosityMeasurement.value.values[luminosity]
+    assert count(luminosity) == 2
+    assert len(column) == 2
+    assert columns_file.tables == {}
+
+    numpy.testing.assert_array_equal(luminosity.value, numpy.array([15.718, 14.847], dtype='float32') * u.Unit('mag'))
+    assert "_table1" in columns_file.tables
+
+    # The mapped column is a view over the big endian stream
+    assert column.dtype == luminosity.value.dtype == numpy.dtype('>f4')
+
+
+@pytest.mark.parametrize("tabledata_format", ["tabledata", "binary2"])
+def test_columns_after_close(make_data_path, make_binary_copy, tabledata_format):
+    """
+    Test that the COLUMN-backed attributes accessed before the reader is closed stay usable, and that the others are
+    not decoded when it is closed
+    """
+    path = make_data_path('columns.vot.xml')
+    if tabledata_format != "tabledata":
+        path = make_binary_copy(path, tabledata_format, "_table1")
+
+    with read(path) as columns_file:
+        luminosity = columns_file.find_instances( LuminosityMeasurement  )[0]
+        numpy.testing.assert_array_equal(luminosity.value,
+                                         numpy.array([15.718, 14.847], dtype='float32') * u.Unit('mag'))
+        description = LuminosityMeasurement.description.values[luminosity]
+
+    assert not description.is_loaded
+    assert len(description) == 2
+    numpy.testing.assert_array_equal(luminosity.value, numpy.array([15.718, 14.847], dtype='float32') * u.Unit('mag'))
+    with pytest.raises(ValueError, match="closed"):
+        luminosity.description
+
+
+def test_field_values_stored_by_instances():
+    """
+    Test that field values are laid out in the instances, after the fields of the base class
+    """
+    class Base(BaseType):
+        a = Attribute('test:Base.a')
+
+    class Derived(Base):
+        b = Attribute('test:Derived.b')
+        c = Composition('test:Derived.c')
+
+    assert (Base.a.index, Derived.b.index, Derived.c.index) == (0, 1, 2)
+    assert Derived.__field_count__ == 3
+
+    child = Base()
+    child.a = numpy.arange(3) * u.deg
+    instance = Derived()
+    instance.b = 'b'
+    instance.c = child
+
+    assert instance.a is None
+    assert instance.b == 'b'
+    assert Derived.b.values[instance] == 'b'
+    assert instance not in Derived.a.values
+    assert child.__parent__ is instance
+    assert count(instance) == 3
+
+    del instance.b
+    assert instance.b is None
+
+    # Field metadata is collected when the class is created
+    assert [(info.name, info.kind, info.vodml_id) for info in Derived.__vodml_fields__] == [
+        ('a', Attribute, 'test:Base.a'), ('b', Attribute, 'test:Derived.b'), ('c', Composition, 'test:Derived.c')]
+    assert Derived.find_fields() == [('a', Base.a), ('b', Derived.b), ('c', Derived.c)]
+    assert Base.__vodml_fields__[0].get_index(child, 1) == 1 * u.deg
+
+    # Fields of several base classes are laid out after the ones of the first base class
+    class Other(Base):
+        d = Attribute('test:Other.d')
+
+    class Both(Derived, Other):
+        e = Attribute('test:Both.e')
+
+    assert Both.__field_count__ == 5
+    both = Both()
+    both.a, both.b, both.d, both.e = 'a', 'b', 'd', 'e'
+    assert (both.a, both.b, both.c, both.d, both.e) == ('a', 'b', None, 'd', 'e')
+    assert Other.d.values[both] == 'd'
+    assert [info.name for info in Both.__vodml_fields__] == ['a', 'b', 'c', 'd', 'e']
+    assert both.__getstate__()['__field_values__'][3:] == ['d', 'e']
+
+    # Unless fields with the same name come from unrelated classes
+    class Conflicting(BaseType):
+        b = Attribute('test:Conflicting.b')
+
+    with pytest.raises(TypeError):
+        class Ambiguous(Derived, Conflicting):
+            pass
+
+
 def test_parsing_attributes( attributes_file ):
     """
     Test parsing of ATTRIBUTE elements 
@@ -352,7 +487,7 @@ def test_invalid_refid(references_file):
     source = sources[0]
 
     assert 1 == len(sources)
-    expected_name  = numpy.array([numpy.NaN, numpy.NaN])
+    expected_name  = numpy.array([numpy.nan, numpy.nan])
     expected_class = numpy.array(['star', 'star', 'star'], dtype='|S4')
     numpy.testing.assert_array_equal(expected_name,  source.name)
     numpy.testing.assert_array_equal(expected_class, source.classification)
@@ -394,6 +529,91 @@ def test_references_orm_unroll(orm_file, recwarn):
     assert source[1].luminosity[0].filter is f814w
 
 
+def test_lookup(orm_file):
+    sources = orm_file.find_instances(Source)
+
+    rows = orm_file.lookup(Source, ["ID2", "missing", "ID1"])
+
+    assert isinstance(rows[0], Source)
+    assert rows[0].name == "ID2"
+    assert rows[0].position.longitude == sources[0].position.longitude[1]
+    assert rows[1] is None
+    assert rows[2].name == "ID1"
+    numpy.testing.assert_array_equal(orm_file.lookup(Source, ["ID2", "missing", "ID1"], indices=True), [1, -1, 0])
+
+    # Instances built again are the same
+    assert orm_file.find_instances(Source)[0] is sources[0]
+
+    # Instances that are not templates are matched by their keys
+    filters = orm_file.lookup(PhotometryFilter, [["F814W", "WFPC2"], ["F814W", "ACS"]])
+    assert filters[0].name == "F814W"
+    assert filters[1] is None
+
+
+def test_key_index():
+    keys = numpy.array([[1, 20], [3, 40], [1, 20], [5, 60]])
+    key_index = KeyIndex(keys)
+
+    # The last row wins for duplicated keys
+    numpy.testing.assert_array_equal(key_index.find([[1, 20], [5, 60], [5, 20], [-1, 20], [1.0, 20.0]]),
+                                     [2, 3, -1, -1, 2])
+    numpy.testing.assert_array_equal(key_index.find([["a", "b"]]), [-1])
+    numpy.testing.assert_array_equal(key_index.find([1, 3]), [-1, -1])
+
+    strings = KeyIndex([["a", "x"], ["bb", "y"]])
+    numpy.testing.assert_array_equal(strings.find(numpy.array([["bb", "y"], ["bbb", "y"], ["a", "y"]])), [1, -1, -1])
+    numpy.testing.assert_array_equal(KeyIndex([0.0, 2.5]).find([2.5, -0.0, 1.0]), [1, 0, -1])
+
+    objects = KeyIndex(numpy.array([[1, "a"], [2, "b"]], dtype=object))
+    numpy.testing.assert_array_equal(objects.find(numpy.array([[2, "b"], [2, "a"]], dtype=object)), [1, -1])
+
+    # Strings and numbers are never equal
+    numpy.testing.assert_array_equal(KeyIndex([1, 2, 3]).find(['2', '3']), [-1, -1])
+    numpy.testing.assert_array_equal(KeyIndex(['1', '2']).find([2]), [-1])
+
+
+def test_key_index_null_keys():
+    """
+    Test that masked keys are left out of the index, and never found
+    """
+    keys = numpy.ma.array([[1, 10], [2, 20], [3, 30]], mask=[[False, False], [False, True], [False, False]])
+    key_index = KeyIndex(keys)
+    numpy.testing.assert_array_equal(key_index.find([[2, 20], [3, 30], [1, 10]]), [-1, 2, 0])
+    queries = numpy.ma.array([[3, 30], [1, 10]], mask=[[True, False], [False, False]])
+    numpy.testing.assert_array_equal(key_index.find(queries), [-1, 0])
+    numpy.testing.assert_array_equal(KeyIndex(numpy.ma.array([1], mask=[True])).find([1]), [-1])
+
+    objects = KeyIndex(numpy.ma.array(numpy.array([1, "a"], dtype=object), mask=[True, False]))
+    numpy.testing.assert_array_equal(objects.find(numpy.array([1, "a"], dtype=object)), [-1, 1])
+
+    # EXTINSTANCES with null FOREIGNKEY values are not grouped with the target rows with null PRIMARYKEY values
+    instance_keys = numpy.ma.array([[1], [2], [0]], mask=[[False], [False], [True]])
+    target_keys = numpy.ma.array([[1], [0], [2]], mask=[[False], [True], [False]])
+    assert group_extinstances(["a", "b", "c"], instance_keys, target_keys) == [["a", None, "b"]]
+
+
+def test_lookup_adapter(make_data_path, monkeypatch):
+    """
+    Test that the rows of adapted templates are wrapped in the adapter like the instances found by find_instances
+    """
+    class SourceAdapter:
+        def __init__(self, source):
+            self.source = source
+
+    monkeypatch.setattr(Source, "__delegate__", SourceAdapter, raising=False)
+    orm_file = read(make_data_path('orm.vot.xml'))
+    template = orm_file.find_instances(Source)[0]
+    assert isinstance(template, SourceAdapter)
+
+    rows = orm_file.lookup(Source, ["ID2", "ID1"])
+    assert isinstance(rows[0], SourceAdapter)
+    assert rows[0].__vo_object__ is rows[0].source
+    assert rows[0].source.name == "ID2"
+    assert rows[0].__vo_id__.id == template.__vo_id__.id
+    assert list(rows[0].__vo_id__.keys) == ["ID2"]
+    assert not is_template(rows[1])
+
+
 def test_references_orm_hsc(hsc_data_file, recwarn):
     sources = hsc_data_file.find_instances(Detection)
     filters = hsc_data_file.find_instances(PhotometryFilter)
@@ -451,3 +671,77 @@ def test_polymorphism(hsc_data_file, recwarn):
     assert sources[0].cardinality == 7
     assert isinstance(sources[0], Detection)
     assert isinstance(sources[0], Source)
+
+
+def test_document_indexes(references_file):
+    """
+    Test the element indexes built by the Votable document at load time
+    """
+    votable = references_file.document
+
+    frame = votable.get_instance_by_id("_fk4_frame")
+    assert frame.get("dmtype") == "sample:catalog.SkyCoordinateFrame"
+    assert votable.get_element_by_id("_MY_CATALOG") is not None
+    assert votable.get_instance_by_id("_MY_CATALOG") is None
+    assert votable.get_instance_by_id("_2massJ") is None
+
+    assert len(votable.find_instances_by_type("sample:catalog.SkyCoordinate")) == 2
+    assert votable.find_instances_by_type("sample:catalog.AlignedEllipse") == []
+
+    field, table_index = votable.get_field("_classification")
+    assert field.get("name") == "class"
+    assert table_index == 0
+    assert votable.get_field("foo") == (None, None)
+    assert votable.get_param("_ra") is None
+
+
+def test_roles_resolve_to_direct_children():
+    """
+    Test that a role is only matched against the direct children of an INSTANCE,
+    not against the children of nested INSTANCEs
+    """
+    xml = StringIO('''<VOTABLE><VODML><GLOBALS>
+      <INSTANCE dmtype="sample:test.MultiObj" ID="_outer">
+        <ATTRIBUTE dmrole="sample:test.MultiObj.b">
+          <INSTANCE dmtype="sample:test.MultiObj" ID="_inner">
+            <ATTRIBUTE dmrole="sample:test.MultiObj.a">
+              <LITERAL value="1.0" dmtype="ivoa:real"/>
+            </ATTRIBUTE>
+          </INSTANCE>
+        </ATTRIBUTE>
+      </INSTANCE>
+    </GLOBALS></VODML></VOTABLE>''')
+    outer, inner = read(xml).find_instances(MultiObj)
+
+    assert outer.__vo_id__.id == "_outer"
+    assert outer.a is None
+    assert outer.b == [inner]
+    assert inner.a == 1.0
+
+
+@pytest.mark.parametrize("namespace", ["http://www.ivoa.net/xml/VOTable/v1.3",
+                                       "http://www.ivoa.net/xml/VOTable/v1.4",
+                                       "urn:example:votable"])
+def test_namespaced_documents(namespace):
+    """
+    Test that the precompiled queries are bound to the document namespace
+    """
+    from rama.reader.votable.parser import XPATHS
+
+    xml = StringIO(f'''<VOTABLE xmlns="{namespace}"><VODML><TEMPLATES>
+      <INSTANCE dmtype="sample:test.MultiObj">
+        <ATTRIBUTE dmrole="sample:test.MultiObj.a">
+          <LITERAL value="1.0" dmtype="ivoa:real"/>
+        </ATTRIBUTE>
+        <ATTRIBUTE dmrole="sample:test.MultiObj.b">
+          <LITERAL value="2.0" dmtype="ivoa:real"/>
+          <LITERAL value="3.0" dmtype="ivoa:real"/>
+        </ATTRIBUTE>
+      </INSTANCE>
+    </TEMPLATES></VODML></VOTABLE>''')
+    elem = read(xml).find_instances(MultiObj)[0]
+
+    assert is_template(elem)
+    assert elem.a == 1.0
+    assert elem.b == [2.0, 3.0]
+    assert XPATHS[namespace].namespace == namespace
@@ -0,0 +1,152 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from io import BytesIO
+
+import numpy
+import pytest
+from astropy.io import votable
+from astropy.io.votable import from_table
+from astropy.table import QTable, Table
+
+from rama.reader.buffer import InputBuffer
+from rama.reader.votable import tabledata
+from rama.reader.votable.loader import AnnotationLoader
+from rama.reader.votable.tabledata import decode_tabledata
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<VOTABLE xmlns="http://www.ivoa.net/xml/VOTable/v1.3" version="1.3">
+  <RESOURCE>
+    <TABLE>
+      <FIELD ID="i" name="i" datatype="int"><VALUES null="-1"/></FIELD>
+      <FIELD ID="s" name="s" datatype="short"/>
+      <FIELD ID="f" name="f" datatype="float" unit="deg"/>
+      <FIELD ID="c" name="c" datatype="char" arraysize="*"/>
+      <FIELD ID="c1" name="c1" datatype="char"/>
+      <FIELD ID="c5" name="c5" datatype="char" arraysize="5"/>
+      <FIELD ID="u" name="u" datatype="unicodeChar" arraysize="*"/>
+      <FIELD ID="l" name="l" datatype="long"/>
+      <FIELD ID="d" name="d" datatype="double"/>
+      <FIELD ID="b" name="b" datatype="unsignedByte"/>
+      <DATA><TABLEDATA>
+        <TR><TD> 1 </TD><TD>{short}</TD><TD>1.5</TD><TD>a&amp;c</TD><TD>a</TD><TD>abcdefg</TD><TD>été</TD>
+            <TD>12345678901</TD><TD>+Inf</TD><TD>7</TD></TR>
+        <TR><TD>-1</TD><TD></TD><TD>NaN</TD><TD></TD><TD></TD><TD></TD><TD></TD><TD></TD><TD></TD><TD/></TR>
+        {comment}
+        <TR><TD></TD><TD>3</TD><TD></TD><TD> x </TD><TD>b</TD><TD>ab</TD><TD>u</TD><TD>-3</TD><TD>1e-3</TD>
+            <TD>255</TD></TR>
+      </TABLEDATA></DATA>
+    </TABLE>
+  </RESOURCE>
+</VOTABLE>'''
+
+
+def load(document):
+    buffer = InputBuffer(BytesIO(document.encode("utf-8")))
+    loader = AnnotationLoader()
+    loader.load(buffer.open())
+    return buffer, loader.tables[0]
+
+
+@pytest.mark.parametrize("grouped", [False, True])
+@pytest.mark.parametrize("comment", ["", "<!-- rows with comments are parsed as XML -->"])
+@pytest.mark.parametrize("field_ids", [None, ["i", "c", "d"]])
+def test_decode_tabledata(monkeypatch, field_ids, comment, grouped):
+    if grouped:
+        # Cells are gathered in groups of similar lengths
+        monkeypatch.setattr(tabledata, "GATHER_MAX_PADDING", 0)
+    document = DOCUMENT.format(short="16", comment=comment)
+    expected = QTable(votable.parse(BytesIO(document.encode("utf-8")), columns=field_ids).get_first_table().to_table())
+
+    table = decode_tabledata(*load(document), field_ids)
+
+    assert table.colnames == expected.colnames
+    for name in table.colnames:
+        column, expected_column = table[name], expected[name]
+        assert type(column) is type(expected_column)
+        assert column.dtype == expected_column.dtype
+        assert getattr(column, "unit", None) == getattr(expected_column, "unit", None)
+        numpy.testing.assert_array_equal(column.mask, expected_column.mask)
+        numpy.testing.assert_array_equal(column[~column.mask], expected_column[~expected_column.mask])
+
+
+def test_gather():
+    data = b"<a>1</a><a>22</a><a>" + b"3" * 1000 + b"</a><a></a><a>55</a>"
+    array = numpy.frombuffer(data, dtype="u1")
+    starts = numpy.array([position + 3 for position in range(len(data)) if data.startswith(b"<a>", position)])
+    ends = numpy.array([data.index(b"</a>", start) for start in starts])
+
+    groups = tabledata.gather(array, starts, ends)
+
+    # The long cell does not make the others 1000 bytes wide
+    assert max(strings.dtype.itemsize * len(strings) for _, strings in groups) == 1000
+    cells = numpy.empty(len(starts), dtype=object)
+    for indexes, strings in groups:
+        cells[indexes] = list(strings)
+    assert list(cells) == [b"1", b"22", b"3" * 1000, b"", b"55"]
+
+
+def test_decode_tabledata_fallback():
+    # Hexadecimal integers are left to astropy
+    document = DOCUMENT.format(short="0x10", comment="")
+
+    assert decode_tabledata(*load(document)) is None
+    assert decode_tabledata(*load(document), ["i"]) is not None
+
+
+def test_decode_tabledata_missing_cells():
+    document = DOCUMENT.format(short="16", comment="<TR><TD>4</TD></TR>")
+
+    assert decode_tabledata(*load(document), ["i"])["i"][2] == 4
+    assert decode_tabledata(*load(document), ["i", "s"]) is None
+
+
+def test_decode_tabledata_prefix():
+    document = DOCUMENT.format(short="16", comment="").replace("<", "<vot:").replace("<vot:/", "</vot:")\
+        .replace("<vot:?xml", "<?xml").replace('xmlns=', 'xmlns:vot=')
+
+    table = decode_tabledata(*load(document), ["s", "c"])
+
+    numpy.testing.assert_array_equal(table["s"], [16, 0, 3])
+    assert list(table["c"]) == ["a&c", "", "x"]
+
+
+@pytest.mark.parametrize("mapped", [False, True])
+def test_decode_tabledata_parallel(monkeypatch, tmp_path, mapped):
+    monkeypatch.setattr(tabledata, "PARALLEL_MIN_SIZE", 0)
+    values = numpy.ma.array(numpy.arange(50) / 2, mask=numpy.arange(50) % 7 == 0)
+    names = numpy.array([f"source {index}" for index in range(50)], dtype=object)
+    output = BytesIO()
+    from_table(Table([numpy.arange(50, dtype="int32"), values, names], names=["id", "value", "name"])).to_xml(output)
+    path = tmp_path / "table.xml"
+    path.write_bytes(output.getvalue())
+    buffer = InputBuffer(str(path) if mapped else BytesIO(output.getvalue()))
+    loader = AnnotationLoader()
+    loader.load(buffer.open())
+
+    expected = decode_tabledata(buffer, loader.tables[0])
+    table = decode_tabledata(buffer, loader.tables[0], workers=3)
+
+    assert buffer.is_mapped == mapped
+    for name in ["id", "value", "name"]:
+        assert table[name].dtype == expected[name].dtype
+        numpy.testing.assert_array_equal(table[name].mask, expected[name].mask)
+        numpy.testing.assert_array_equal(table[name], expected[name])
@@ -19,6 +19,9 @@
 # SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import asyncio
+from io import BytesIO
+
 import pytest
 from astropy.table import MaskedColumn
 from astropy import units as u
@@ -29,6 +32,7 @@ from rama.models.test.filter import PhotometryFilter
 from rama.models.test.sample import SkyCoordinateFrame, Source, SkyCoordinate, LuminosityMeasurement
 from rama.reader import Reader
 from rama.reader.votable import Votable
+from rama.reader.votable import decoder, parser, tabledata
 
 import sys
 
@@ -44,6 +48,37 @@ def test_coordinate_frame(context_test5):
     assert frames[0].name == "ICRS"
 
 
+def test_tables_decoded_from_data_sections(context_test5, monkeypatch):
+    calls = []
+    decode_tabledata = parser.decode_tabledata
+
+    def counting_decode_tabledata(buffer, table_info, field_ids, workers=None):
+        table = decode_tabledata(buffer, table_info, field_ids, workers)
+        calls.append(table.colnames)
+        return table
+
+    def parse_full_tables(*args, **kwargs):
+        raise AssertionError("The whole file should not be parsed again")
+
+    def parse(*args, **kwargs):
+        raise AssertionError("The TABLEDATA should not be decoded by astropy")
+
+    monkeypatch.setattr(parser, "decode_tabledata", counting_decode_tabledata)
+    monkeypatch.setattr(parser, "parse_full_tables", parse_full_tables)
+    monkeypatch.setattr(decoder.votable, "parse", parse)
+
+    sources = context_test5.find_instances(Source)
+    assert len(sources[0].luminosity[3]) == 3
+
+    # Both the sources table and the external magnitudes table are decoded from their own DATA section
+    assert len(calls) == 2
+    assert set(context_test5.tables) == {"_table1", "_sdss_mags"}
+
+    # Only the FIELDs referenced by the annotation are decoded
+    assert calls[0] == ["_designation", "_ra", "_dec", "_magJ", "_errJ", "_magH", "_errH", "_magK", "_errK"]
+    assert calls[1] == ["_container", "_gMag", "_e_GMag"]
+
+
 def test_filters(context_test5):
     filters = context_test5.find_instances(PhotometryFilter)
 
@@ -268,3 +303,166 @@ def test_source_unroll(context_test5, recwarn):
         
 #    assert sources is None
     
+
+
+def test_plan_compiled_once(context_test5, monkeypatch):
+    calls = []
+    compile_instance = parser.PlanCompiler.compile_instance
+
+    def counting_compile_instance(self, xml_element):
+        calls.append(xml_element)
+        return compile_instance(self, xml_element)
+
+    monkeypatch.setattr(parser.PlanCompiler, "compile_instance", counting_compile_instance)
+
+    plan = context_test5.document.get_plan()
+    n_calls = len(calls)
+    context_test5.find_instances(Source)
+    context_test5.find_instances(PhotometryFilter)
+
+    assert context_test5.document.get_plan() is plan
+    assert len(calls) == n_calls
+
+
+def test_explain(context_test5, capsys):
+    context_test5.explain(Source)
+    explanation = capsys.readouterr().out
+
+    assert explanation.startswith("Plan for sample:catalog.Source: 1 instance(s)")
+    assert "IDREF _2massH" in explanation
+    assert "EXTINSTANCES SDSS_MAGS" in explanation
+    assert "_table1 (3 rows):" in explanation
+    assert "_sdss_mags (6 rows):" in explanation
+    assert "_ra -> FIELD ra (float)" in explanation
+    assert "Estimated cost: 10 instance(s), 12 column(s), 45 column value(s), at least 153 bytes" in explanation
+
+    # Explaining does not decode any table
+    assert context_test5.tables == {}
+
+
+def test_plan_shared_by_documents_with_same_annotation(make_data_path, monkeypatch):
+    monkeypatch.setattr(parser, "PLAN_CACHE", parser.PlanCache())
+
+    with open(make_data_path("test5.vot.xml"), "rb") as test5:
+        content = test5.read()
+    other_rows = BytesIO(content.replace(b"<TD>123.033734</TD>", b"<TD>100.0</TD>"))
+    other_annotation = BytesIO(content.replace(b'value="2mass:H"', b'value="2mass:Ks"'))
+
+    context = Reader(Votable(make_data_path("test5.vot.xml")))
+    context_other_rows = Reader(Votable(other_rows))
+    context_other_annotation = Reader(Votable(other_annotation))
+
+    plan = context.document.get_plan()
+    assert context_other_rows.document.get_plan() is plan
+    assert context_other_annotation.document.get_plan() is not plan
+    assert len(parser.PLAN_CACHE) == 2
+
+    # The rows are still bound to each document
+    assert context.find_instances(Source)[0].position.longitude.unmasked[0].value == pytest.approx(123.033734)
+    assert context_other_rows.find_instances(Source)[0].position.longitude.unmasked[0].value == pytest.approx(100.0)
+    assert context_other_annotation.find_instances(PhotometryFilter)[0].name == "2mass:Ks"
+
+
+def test_plan_cache_eviction():
+    cache = parser.PlanCache(maxsize=2)
+    plans = [parser.AnnotationPlan({}) for _ in range(3)]
+
+    cache.put("a", plans[0])
+    cache.put("b", plans[1])
+    assert cache.get("a") is plans[0]
+    cache.put("c", plans[2])
+
+    assert "b" not in cache
+    assert cache.get("a") is plans[0]
+    assert cache.get("c") is plans[2]
+
+
+def test_tables_decoded_by_workers(context_test5, monkeypatch):
+    monkeypatch.setattr(tabledata, "PARALLEL_MIN_SIZE", 0)
+    expected = context_test5.find_instances(Source)[0]
+
+    source = Reader(Votable(context_test5.file), workers=2).find_instances(Source)[0]
+
+    assert_array_equal(source.name, expected.name)
+    assert_array_equal(source.position.longitude, expected.position.longitude)
+    assert_array_equal(source.luminosity[0].value, expected.luminosity[0].value)
+
+
+def test_iter_instances(context_test5):
+    template_source = Reader(Votable(context_test5.file)).find_instances(Source)[0]
+
+    sources = list(context_test5.iter_instances(Source, batch_size=2))
+
+    assert [count(source) for source in sources] == [2, 1]
+    assert all(is_template(source) for source in sources)
+    assert_array_equal(sources[0].name, template_source.name[:2])
+    assert_array_equal(sources[1].name, template_source.name[2:])
+
+    # Instances that are not templates are shared by the batches
+    assert sources[0].position.frame is sources[1].position.frame
+    assert sources[0].luminosity[0].filter is sources[1].luminosity[0].filter
+
+    # External instances are grouped by the rows of each batch
+    assert unroll(sources[0])[1].luminosity[3] is None
+    assert unroll(sources[1])[0].luminosity[3].value == template_source.luminosity[3][2].value
+
+    # Only the batches of the sources table are decoded
+    assert set(context_test5.tables) == {"_sdss_mags"}
+
+
+@pytest.mark.parametrize("tabledata_format", ["tabledata", "binary2"])
+def test_iter_instances_unroll(make_data_path, make_binary_copy, tabledata_format):
+    path = make_data_path("test5.vot.xml")
+    if tabledata_format != "tabledata":
+        path = make_binary_copy(path, tabledata_format, "_table1")
+
+    def describe(source):
+        luminosity = [(lum.value, lum.error) if lum is not None else None for lum in source.luminosity]
+        return source.name, source.position.longitude, luminosity
+
+    expected = [describe(source) for source in unroll(Reader(Votable(path)).find_instances(Source)[0])]
+    batches = Reader(Votable(path)).iter_instances(Source, batch_size=2)
+
+    assert [describe(source) for batch in batches for source in unroll(batch)] == expected
+    assert any(luminosity is None for _, _, luminosity in expected for luminosity in luminosity)
+
+
+def test_unroll_views(context_test5):
+    template_source = context_test5.find_instances(Source)[0]
+
+    sources = unroll(template_source)
+    source = sources[2]
+
+    assert isinstance(source, Source)
+    assert source == sources[2]
+    assert source.luminosity[3].value == template_source.luminosity[3][2].value
+    assert isinstance(source.position, SkyCoordinate)
+    assert source.position.__parent__ is source
+    assert source.position.latitude == template_source.position.latitude[2]
+
+    # Assigning a field of a row does not change the template
+    source.name = "renamed"
+    assert template_source.name[2] != "renamed"
+
+    materialized = sources.materialize()
+    assert type(materialized[2]) is Source
+    assert type(materialized[2].position) is SkyCoordinate
+    assert materialized[2].name == template_source.name[2]
+    assert [type(lum) for lum in materialized[2].luminosity[:3]] == [LuminosityMeasurement] * 3
+    assert materialized[2].luminosity[0].filter is source.luminosity[0].filter
+
+
+def test_aiter_instances(context_test5):
+    async def collect():
+        return [source async for source in context_test5.aiter_instances(Source, batch_size=2)]
+
+    sources = asyncio.run(collect())
+
+    assert [count(source) for source in sources] == [2, 1]
+    assert_array_equal(sources[1].name, context_test5.find_instances(Source)[0].name[2:])
+
+
+def test_iter_instances_not_templates(context_test5):
+    filters = list(context_test5.iter_instances(PhotometryFilter, batch_size=2))
+
+    assert [f.name for f in filters] == ["2mass:H", "2mass:J", "2mass:K", "sdss:g", "sdss:r"]
@@ -25,10 +25,25 @@
 # Test routines for high level rama methods
 # ----------------------------------------------------------------------------------------------------
 
+import asyncio
+import bz2
+import gzip
+import lzma
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
 import pytest
+import requests
 
-from rama import read, is_template, count, unroll
+from rama import read, read_async, read_many, read_url, read_urls, is_template, count, unroll
 from rama.models.test.sample import Source, SkyCoordinate, CircleError
+from rama.utils.http_cache import ResponseCache
+from astropy import units as u
 from astropy.units import Quantity
 
 
@@ -60,6 +75,293 @@ def test_read_file_dne(recwarn):
 
     assert len(recwarn) == 0
 
+@pytest.mark.parametrize("compress", [gzip.compress, bz2.compress, lzma.compress])
+@pytest.mark.parametrize("from_stream", [False, True])
+def test_read_compressed(make_data_path, tmp_path, compress, from_stream):
+    """
+    Tests read() with compressed files
+    """
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+    path = tmp_path / 'sample.vot.xml.compressed'
+    path.write_bytes(compress(document))
+
+    reader = read(BytesIO(path.read_bytes()) if from_stream else str(path))
+
+    assert bytes(reader.buffer.view) == document
+    assert not reader.buffer.is_mapped
+    sources = reader.find_instances(Source)
+    assert len(sources) == 2
+    assert count(sources[1].position) == 3
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_read_many(make_data_path, tmp_path, workers):
+    """
+    Tests read_many() returns the instances of each document in order
+    """
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+    paths = []
+    for index in range(5):
+        path = tmp_path / f'sample{index}.vot.xml'
+        path.write_bytes(document.replace(b'<TD>122.99277</TD>', f'<TD>{100 + index}</TD>'.encode()))
+        paths.append(str(path))
+
+    results = read_many(paths, Source, workers=workers, chunksize=2)
+
+    assert len(results) == 5
+    for index, sources in enumerate(results):
+        assert len(sources) == 2
+        assert not is_template(sources[0])
+        assert count(sources[1].position) == 3
+        assert sources[1].position.longitude[0] == (100 + index) * u.deg
+        assert sources[1].position.frame is sources[0].position.frame
+        assert len(unroll(sources[1].position)) == 3
+
+
+class CountingRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler counting connections and downloaded files, sending ETags when `use_etag` is set
+    """
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    downloads = 0
+    use_etag = False
+
+    def setup(self):
+        CountingRequestHandler.connections += 1
+        super().setup()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if self.use_etag and os.path.isfile(path):
+            etag = f'"{os.stat(path).st_mtime_ns}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return None
+            self._etag = etag
+        return super().send_head()
+
+    def end_headers(self):
+        etag = getattr(self, '_etag', None)
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self._etag = None
+        super().end_headers()
+
+    def copyfile(self, source, outputfile):
+        CountingRequestHandler.downloads += 1
+        super().copyfile(source, outputfile)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(directory):
+    """
+    Local HTTP server serving `directory`, with keep-alive connections
+    """
+    CountingRequestHandler.connections = 0
+    CountingRequestHandler.downloads = 0
+    handler = partial(CountingRequestHandler, directory=str(directory))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def http_server(make_data_path):
+    """
+    Local HTTP server serving the test data directory
+    """
+    with serve(make_data_path('')) as url:
+        yield url
+
+
+def test_read_url(http_server, make_data_path):
+    """
+    Tests read_url() against a local server
+    """
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+    session = requests.Session()
+
+    readers = [read_url(f"{http_server}/sample.vot.xml", {'page': page}, session=session, chunk_size=1000)
+               for page in range(3)]
+
+    # The connection is kept alive between calls
+    assert CountingRequestHandler.connections == 1
+    for reader in readers:
+        assert bytes(reader.buffer.view) == document
+        assert len(reader.find_instances(Source)) == 2
+
+
+def test_read_url_error(http_server):
+    """
+    Tests read_url() with a missing document
+    """
+    with pytest.raises(requests.HTTPError):
+        read_url(f"{http_server}/missing.vot.xml", {})
+
+
+def test_read_urls(http_server, make_data_path):
+    """
+    Tests read_urls() reads all the documents with bounded concurrency, reporting errors per query
+    """
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+    queries = [(f"{http_server}/sample.vot.xml", {'page': page}) for page in range(10)]
+    queries[3] = (f"{http_server}/missing.vot.xml", {})
+
+    results = list(read_urls(queries, max_concurrency=3))
+
+    assert sorted(result.index for result in results) == list(range(10))
+    # Connections are kept alive, except the one the server closes after the error
+    assert CountingRequestHandler.connections <= 3 + 1
+    for result in results:
+        assert (result.base_url, result.params) == queries[result.index]
+        if result.index == 3:
+            assert result.reader is None
+            assert isinstance(result.error, requests.HTTPError)
+        else:
+            assert result.error is None
+            assert bytes(result.reader.buffer.view) == document
+            assert len(result.reader.find_instances(Source)) == 2
+
+
+def test_read_urls_stopped_early(http_server):
+    """
+    Tests read_urls() drops the queries that have not started when the caller stops iterating
+    """
+    queries = [(f"{http_server}/sample.vot.xml", {'page': page}) for page in range(20)]
+
+    results = read_urls(queries, max_concurrency=2)
+    next(results)
+    results.close()
+
+    # One query is done, at most two others were started, the queued ones are cancelled
+    assert CountingRequestHandler.downloads <= 3
+
+
+def test_read_async(http_server, make_data_path):
+    """
+    Tests read_async() with files and URLs read concurrently
+    """
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+
+    async def read_all():
+        return await asyncio.gather(read_async(make_data_path('sample.vot.xml')),
+                                    read_async(f"{http_server}/sample.vot.xml", params={'page': 1}),
+                                    read_async(f"{http_server}/sample.vot.xml", workers=2))
+
+    readers = asyncio.run(read_all())
+
+    assert readers[0].buffer.is_mapped
+    assert readers[2].workers == 2
+    for reader in readers:
+        assert bytes(reader.buffer.view) == document
+        assert len(reader.find_instances(Source)) == 2
+
+
+@pytest.mark.parametrize("use_etag", [False, True])
+def test_read_url_cache(make_data_path, tmp_path, monkeypatch, use_etag):
+    """
+    Tests read_url() with a response cache, revalidating with Last-Modified or ETag
+    """
+    monkeypatch.setattr(CountingRequestHandler, 'use_etag', use_etag)
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+    served = tmp_path / 'served'
+    served.mkdir()
+    document_path = served / 'sample.vot.xml'
+    document_path.write_bytes(document)
+    cache = ResponseCache(tmp_path / 'cache')
+
+    with serve(served) as base_url:
+        url = f"{base_url}/sample.vot.xml"
+        readers = [read_url(url, {'page': 1}, cache=cache) for _ in range(3)]
+
+        # Only the first call downloads the document, the others are revalidated
+        assert CountingRequestHandler.downloads == 1
+        for reader in readers:
+            assert reader.buffer.is_mapped
+            assert bytes(reader.buffer.view) == document
+            assert len(reader.find_instances(Source)) == 2
+
+        # A modified document is downloaded again, readers on the previous version are not affected
+        modified = document + b'<!-- modified -->\n'
+        document_path.write_bytes(modified)
+        mtime = os.stat(document_path).st_mtime + 10
+        os.utime(document_path, (mtime, mtime))
+        reader = read_url(url, {'page': 1}, cache=str(tmp_path / 'cache'))
+
+    assert CountingRequestHandler.downloads == 2
+    assert bytes(reader.buffer.view) == modified
+    assert bytes(readers[0].buffer.view) == document
+
+
+def test_read_url_cache_eviction(http_server, make_data_path, tmp_path):
+    """
+    Tests the least recently used responses are evicted from a full cache
+    """
+    size = os.stat(make_data_path('sample.vot.xml')).st_size
+    cache = ResponseCache(tmp_path, max_size=2 * size)
+    url = f"{http_server}/sample.vot.xml"
+
+    first = cache.fetch(requests.Session(), url, {'page': 1})
+    second = cache.fetch(requests.Session(), url, {'page': 2})
+    cache.fetch(requests.Session(), url, {'page': 1})
+    third = cache.fetch(requests.Session(), url, {'page': 3})
+
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert os.path.exists(third)
+    assert CountingRequestHandler.downloads == 3
+
+
+def test_read_url_cache_in_use(http_server, make_data_path, tmp_path):
+    """
+    Tests the entries in use are not evicted, by any cache of the directory
+    """
+    size = os.stat(make_data_path('sample.vot.xml')).st_size
+    cache = ResponseCache(tmp_path, max_size=size)
+    url = f"{http_server}/sample.vot.xml"
+
+    with cache.use(requests.Session(), url, {'page': 1}) as first:
+        second = ResponseCache(str(tmp_path), max_size=size).fetch(requests.Session(), url, {'page': 2})
+        assert os.path.exists(first)
+        assert os.path.exists(second)
+
+    cache.fetch(requests.Session(), url, {'page': 3})
+    assert not os.path.exists(first)
+
+
+def test_read_urls_cache_concurrent(http_server, make_data_path, tmp_path):
+    """
+    Tests concurrent reads sharing a cache that only holds one response
+    """
+    with open(make_data_path('sample.vot.xml'), 'rb') as stream:
+        document = stream.read()
+    queries = [(f"{http_server}/sample.vot.xml", {'page': index % 5}) for index in range(40)]
+
+    results = list(read_urls(queries, max_concurrency=8, cache=ResponseCache(tmp_path, max_size=len(document))))
+
+    assert len(results) == 40
+    for result in results:
+        assert result.error is None
+        assert bytes(result.reader.buffer.view) == document
+
+
 def test_is_template( sample_file, recwarn):
     """
     Tests parser.py::is_template()
@@ -150,6 +452,13 @@ def test_unroll( sample_file, recwarn):
     assert isinstance(positions[0], SkyCoordinate)
     assert isinstance(positions[1], SkyCoordinate)
     assert isinstance(positions[2], SkyCoordinate)
+    assert count(positions[0]) == 0
+    assert positions[-1].longitude == sources[1].position.longitude[2]
+
+    # Rows are views on the template, materialized rows are independent instances
+    materialized = unroll(sources[1].position, materialize=True)
+    assert [type(position) for position in materialized] == [SkyCoordinate] * 3
+    assert [position.latitude for position in materialized] == [position.latitude for position in positions]
     
     # Acting on non-VO Object
     try:
@@ -0,0 +1,242 @@
+# Copyright 2018 Smithsonian Astrophysical Observatory
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+On-disk cache of HTTP responses.
+
+Each response body is stored as a plain file named after a digest of the request URL, next to a small JSON file
+holding the validators sent by the server (ETag and Last-Modified). Cached bodies are regular files, so readers can
+map them directly instead of copying them in memory.
+
+A cached entry is always revalidated with a conditional request: a "304 Not Modified" response serves the cached file
+without downloading the body again, any other successful response replaces the entry. Bodies are first written to a
+temporary file and then renamed, so readers still holding a mapping on the previous version are not affected.
+
+The total size of the cached bodies is bounded: when it grows over `max_size`, the least recently used entries are
+evicted. Recency is tracked by the modification time of the metadata files, which is updated on each hit.
+
+A cache directory can be used by several threads at once, e.g. by read_urls. The caches of a directory share a lock
+and a count of the entries in use: an entry is in use while it is fetched, and while the caller of `use` reads it.
+Eviction holds the lock and leaves the entries in use alone.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import requests
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1 << 30
+
+BODY_SUFFIX = '.body'
+META_SUFFIX = '.json'
+
+# Lock and entries in use of each cache directory, shared by the ResponseCache instances of the directory
+_DIRECTORY_STATES = {}
+_DIRECTORY_STATES_LOCK = threading.Lock()
+
+
+class ResponseCache:
+    """
+    Cache of HTTP GET responses in `directory`, holding at most `max_size` bytes of response bodies.
+
+    `fetch` returns the path of a file with the up to date response body, `use` keeps it in the cache while it is read.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.fspath(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock, self._in_use = get_directory_state(self.directory)
+
+    def fetch(self, session, url, params=None, chunk_size=1 << 20):
+        """
+        Get the response body for a GET request, downloading it only if the cached copy is missing or stale.
+
+        Inputs:
+          o session    - requests.Session used to send the request
+          o url        - base URL of the request
+          o params     - query parameters of the request
+          o chunk_size - size of the chunks the response body is streamed in
+
+        Returns the path of the file holding the response body. Other threads fetching from the cache may evict it
+        as soon as it is returned, see `use`.
+        """
+        with self.use(session, url, params, chunk_size) as body_path:
+            return body_path
+
+    @contextmanager
+    def use(self, session, url, params=None, chunk_size=1 << 20):
+        """
+        Context manager fetching a response body like `fetch`, and yielding the path of its file. The entry is not
+        evicted before the context exits, so that it can be opened or mapped meanwhile.
+        """
+        request_url = requests.Request('GET', url, params=params).prepare().url
+        key = get_key(request_url)
+        with self._lock:
+            self._in_use[key] += 1
+        try:
+            yield self._fetch(session, request_url, key, chunk_size)
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+
+    def _fetch(self, session, request_url, key, chunk_size):
+        body_path, meta_path = self._paths(key)
+        metadata = self._load_metadata(meta_path) if os.path.exists(body_path) else None
+
+        headers = get_conditional_headers(metadata) if metadata is not None else {}
+        with session.get(request_url, headers=headers, stream=True) as response:
+            if metadata is not None and response.status_code == requests.codes.not_modified:
+                LOG.debug(f"Response for {request_url} not modified, using cached copy")
+                self._touch(meta_path)
+                return body_path
+            response.raise_for_status()
+            self._store(response, request_url, body_path, meta_path, chunk_size)
+
+        self.evict(keep=key)
+        return body_path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cached bodies fit in `max_size`.
+        The entry with the `keep` key and the entries in use are never removed.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(META_SUFFIX):
+                    continue
+                key = entry.name[:-len(META_SUFFIX)]
+                body_path, meta_path = self._paths(key)
+                try:
+                    size = os.stat(body_path).st_size
+                    last_used = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+                total += size
+                if key != keep and key not in self._in_use:
+                    entries.append((last_used, size, key))
+
+            for _, size, key in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if self._remove(key):
+                    total -= size
+
+    def clear(self):
+        """
+        Remove all the entries from the cache, except the entries in use
+        """
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                key = entry.name[:-len(META_SUFFIX)]
+                if entry.name.endswith(META_SUFFIX) and key not in self._in_use:
+                    self._remove(key)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + BODY_SUFFIX, base + META_SUFFIX
+
+    def _store(self, response, request_url, body_path, meta_path, chunk_size):
+        metadata = {
+            'url': request_url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        _write_atomic(body_path, response.iter_content(chunk_size), self.directory)
+        _write_atomic(meta_path, [json.dumps(metadata).encode('utf-8')], self.directory)
+        self._touch(meta_path)
+
+    def _remove(self, key):
+        removed = True
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                # e.g. the file is still mapped by a reader on a platform that does not allow removing it
+                LOG.warning(f"Cannot evict cache entry {path}: {exc}")
+                removed = False
+        return removed
+
+    @staticmethod
+    def _load_metadata(meta_path):
+        try:
+            with open(meta_path, 'rb') as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _touch(path):
+        # File systems usually stamp files with a coarse clock, set the time explicitly to keep the order of uses
+        now = time.time_ns()
+        try:
+            os.utime(path, ns=(now, now))
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f"ResponseCache(directory={self.directory!r}, max_size={self.max_size})"
+
+
+def get_directory_state(directory):
+    """
+    Returns the (lock, entries in use) pair shared by the caches of a directory
+    """
+    with _DIRECTORY_STATES_LOCK:
+        return _DIRECTORY_STATES.setdefault(os.path.realpath(directory), (threading.Lock(), Counter()))
+
+
+def get_key(request_url):
+    return hashlib.sha256(request_url.encode('utf-8')).hexdigest()
+
+
+def get_conditional_headers(metadata):
+    headers = {}
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+    return headers
+
+
+def _write_atomic(path, chunks, directory):
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(descriptor, 'wb') as stream:
+            for chunk in chunks:
+                stream.write(chunk)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
@@ -69,6 +69,7 @@ class TypeRegistry:
 
     def __init__(self):
         self._type_map = {}
+        self._subtype_map = {}
 
     # TODO docstrings
     def get_by_id(self, vodml_id):
@@ -77,12 +78,46 @@ class TypeRegistry:
             raise ValueError(f"Cannot find element with type id: {vodml_id}")
         return element_class
 
+    def get_subtype_ids(self, cls):
+        """
+        Returns the set of the type ids of `cls` and of its registered subclasses
+        """
+        if self._type_map.get(cls.vodml_id, None) is cls:
+            return frozenset(self._subtype_map[cls.vodml_id]) | {cls.vodml_id}
+
+        # Classes that are not registered, e.g. abstract bases without type id, need a scan of the registry
+        subtype_ids = {vodml_id for vodml_id, registered in self._type_map.items() if issubclass(registered, cls)}
+        if cls.vodml_id is not None:
+            subtype_ids.add(cls.vodml_id)
+        return frozenset(subtype_ids)
+
     def add(self, cls):
         if hasattr(cls, 'vodml_id') and inspect.isclass(cls):
+            replaced = self._type_map.get(cls.vodml_id, cls) is not cls
             self._type_map[cls.vodml_id] = cls
+            if replaced:
+                # The subtypes of the replaced class no longer apply, the closure is built again
+                self._subtype_map = {}
+                for registered in self._type_map.values():
+                    self._update_subtypes(registered)
+            else:
+                self._update_subtypes(cls)
 
     def clean(self):
         self._type_map = {}
+        self._subtype_map = {}
+
+    def _update_subtypes(self, cls):
+        # The subtype closure is kept up to date as classes are registered: the new type is a subtype of all its
+        # registered ancestors, and the registered classes extending it are its subtypes.
+        subtype_ids = self._subtype_map.setdefault(cls.vodml_id, set())
+        for vodml_id, registered in self._type_map.items():
+            if registered is cls:
+                continue
+            if issubclass(cls, registered):
+                self._subtype_map.setdefault(vodml_id, set()).add(cls.vodml_id)
+            elif issubclass(registered, cls):
+                subtype_ids.add(vodml_id)
 
 
 class VO:
@@ -51,3 +51,59 @@ def test_type_registry_singleton(registry):
     assert 'Singletons must be accessed through `instance`.' in str(exc)
 
     assert TypeRegistry.instance is registry
+
+
+def test_subtype_ids(registry):
+    @VO("foo:Base")
+    class Base:
+        pass
+
+    @VO("foo:Derived")
+    class Derived(Base):
+        pass
+
+    class Unregistered(Derived):
+        pass
+
+    # Registered out of order, after its subclass
+    class Middle(Derived):
+        pass
+
+    @VO("foo:Leaf")
+    class Leaf(Middle, Unregistered):
+        pass
+
+    VO("foo:Middle")(Middle)
+
+    assert registry.get_subtype_ids(Base) == {"foo:Base", "foo:Derived", "foo:Middle", "foo:Leaf"}
+    assert registry.get_subtype_ids(Middle) == {"foo:Middle", "foo:Leaf"}
+    assert registry.get_subtype_ids(Leaf) == {"foo:Leaf"}
+    assert registry.get_subtype_ids(Unregistered) == {"foo:Derived", "foo:Leaf"}
+
+    registry.clean()
+    assert registry.get_subtype_ids(Base) == {"foo:Base"}
+
+
+def test_subtype_ids_replaced(registry):
+    @VO("foo:Base")
+    class Base:
+        pass
+
+    @VO("foo:Derived")
+    class Derived(Base):
+        pass
+
+    # Registering another class with the same type id drops the subtypes of the replaced class
+    @VO("foo:Base")
+    class OtherBase:
+        pass
+
+    assert registry.get_subtype_ids(OtherBase) == {"foo:Base"}
+
+    @VO("foo:Derived")
+    class OtherDerived:
+        pass
+
+    VO("foo:Base")(Base)
+    assert registry.get_subtype_ids(Base) == {"foo:Base"}
+    assert registry.get_subtype_ids(OtherDerived) == {"foo:Derived"}
@@ -28,7 +28,8 @@ setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
     packages=find_packages(),
-    install_requires=['lxml', 'astropy', 'numpy', 'python-dateutil', 'matplotlib', 'requests'],
+    python_requires='>=3.9',
+    install_requires=['lxml', 'astropy>=4.3', 'numpy', 'python-dateutil', 'matplotlib', 'requests'],
     tests_require=['pytest'],
     include_package_data=True,
     entry_points={